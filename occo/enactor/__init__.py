@@ -39,11 +39,26 @@ __all__ = ['Enactor']
 import occo.util as util
 import occo.util.factory as factory
 import itertools as it
+import collections
+import threading
+import time
 import occo.infobroker as ib
 from . import scaling  as scaling
+from . import dataflow as dataflow
 
 from occo.enactor.downscale import DownscaleStrategy
 from occo.enactor.upkeep import Upkeep
+from occo.enactor.policy import ScalingPolicy, ScalingStabilizer
+from occo.enactor.instrumentation import MetricsSink, CallCounter
+from occo.enactor.description import \
+    description_version, DescriptionIndex, stored_version_key, \
+    touch_description
+from occo.enactor.requestqueue import ScalingRequestQueue
+from occo.enactor.standby import StandbyPool, standby_node
+from occo.enactor.compact import as_instance_data
+from occo.enactor.lease import EnactorLease
+from occo.enactor.enactment import \
+    InstructionBatch, EnactmentLimiter, RetryPolicy, DeadlineReached
 from occo.exceptions.orchestration import *
 import logging
 
@@ -65,67 +80,316 @@ class Enactor(object):
         instructions generated by the Enactor.
     :type infraprocessor:
         :class:`occo.infraprocessor.infraprocessor.AbstractInfraProcessor`
+
+    :param scaling_policy: The configuration of the
+        :class:`~occo.enactor.policy.ScalingPolicy` calculating the target
+        instance counts.
+
+    :param bool skip_unchanged: If set, delta calculation is skipped when the
+        inputs of the pass are identical to those of the last pass that
+        found nothing to do. See :meth:`pass_fingerprint`.
+
+    :param str enactment_mode: Either ``levels`` (default): nodes are created
+        level by level along the topological order; or ``dataflow``: each
+        node type is created as soon as the node types it depends on have
+        been created (see :mod:`occo.enactor.dataflow`). Dataflow mode
+        pushes instructions from multiple threads, so the infraprocessor must
+        be thread-safe.
+
+    :param int dataflow_workers: The maximum number of node types created
+        concurrently in dataflow mode.
+
+    :param bool bulk_create: If set, and the infraprocessor provides
+        ``cri_create_nodes(node, count)``, a single instruction is generated to
+        create multiple instances of a node type. The instruction must expose
+        the number of instances as its ``count`` attribute, so the enactment
+        limits account for each instance; bulk creations are split so that
+        none of them exceeds the size of a wave of creations.
+
+    :param metrics_sink: The configuration of the
+        :class:`~occo.enactor.instrumentation.MetricsSink` receiving the
+        instrumentation data of the passes.
+
+    :param enactment_limits: Limits of the pace of node creations and drops:
+        either an :class:`~occo.enactor.enactment.EnactmentLimiter` (which
+        may be shared by enactors using the same cloud backend), or its
+        configuration dictionary (e.g. ``dict(max_inflight_creates=20,
+        create_rate=5)``). Batches exceeding the limits are pushed in waves.
+
+    :param retry_policy: The :class:`~occo.enactor.enactment.RetryPolicy`
+        of failed operations, or its configuration dictionary. If pushing a
+        batch fails, the operations that have not been enacted are
+        determined from the infrastructure state, and retried after a
+        backoff. Operations failing persistently block only the node types
+        depending on them; the rest of the delta is still enacted, and the
+        first error is raised at the end of the pass.
+
+    :param request_queue: The
+        :class:`~occo.enactor.requestqueue.ScalingRequestQueue` holding the
+        scaling requests, or its configuration. If omitted, the requests are
+        stored in the UDS entry by entry.
+
+    :param stabilization: The configuration of the
+        :class:`~occo.enactor.policy.ScalingStabilizer` damping the target
+        counts (minimum instance age, cooldown, stabilization windows).
+
+    :param lease: The :class:`~occo.enactor.lease.EnactorLease` (shared by
+        the enactors of the process), or its configuration. If specified,
+        passes and teardowns are refused unless the enactor holds the lease
+        of the infrastructure, so multiple enactor processes can maintain the
+        same set of infrastructures, each enacting its share.
     """
     def __init__(self, infrastructure_id, infraprocessor,
                  downscale_strategy='simple',
                  upkeep_strategy='basic',
+                 scaling_policy='requests',
+                 skip_unchanged=True,
+                 enactment_mode='levels',
+                 dataflow_workers=8,
+                 bulk_create=True,
+                 metrics_sink='null',
+                 enactment_limits=None,
+                 retry_policy=None,
+                 request_queue=None,
+                 stabilization=None,
+                 lease=None,
                  **config):
+        if enactment_mode not in ('levels', 'dataflow'):
+            raise ValueError(
+                'Unknown enactment mode: {0!r}'.format(enactment_mode))
         self.infra_id = infrastructure_id
-        self.infobroker = ib.main_info_broker
-        self.uds = ib.main_uds
+        self.metrics = MetricsSink.from_config(metrics_sink)
+        self.call_counts = collections.Counter()
+        self.scaling_time = 0.0
+        self.infobroker = CallCounter(
+            ib.main_info_broker, self.call_counts, 'infobroker')
+        self.uds = CallCounter(ib.main_uds, self.call_counts, 'uds',
+                               nested=('kvstore',))
         self.ip = infraprocessor
         self.drop_strategy = DownscaleStrategy.from_config(downscale_strategy)
         self.upkeep = Upkeep.from_config(upkeep_strategy)
+        # Calls made by the upkeep are counted as part of the pass
+        self.upkeep.infobroker = self.infobroker
+        if hasattr(self.upkeep, 'uds'):
+            self.upkeep.uds = self.uds
+        self.scaling_policy = ScalingPolicy.from_config(scaling_policy)
+        self.stabilizer = ScalingStabilizer.from_config(stabilization)
+        self.skip_unchanged = skip_unchanged
+        self.enactment_mode = enactment_mode
+        self.dataflow_workers = dataflow_workers
+        self.bulk_create = bulk_create \
+            and callable(getattr(infraprocessor, 'cri_create_nodes', None))
+        self.limiter = EnactmentLimiter.from_config(enactment_limits)
+        self.retry_policy = RetryPolicy.from_config(retry_policy)
+        if request_queue is not None \
+                and not isinstance(request_queue, ScalingRequestQueue):
+            request_queue = ScalingRequestQueue.from_config(request_queue)
+        self.request_queue = request_queue
+        self.pass_targets = dict()
+        self.description = None
+        self.described = None
+        self.static_description = None
+        self.stored_version = None
+        self.standby = StandbyPool(self.uds)
+        self.lease = None if lease is None else EnactorLease.from_config(lease)
+        self.deadline = None
+        self.progressed = False
+        self.interrupted_at = None
+        self.standby_instances = dict()
+        self.converged_fingerprint = None
+        self.pass_counters = dict(full=0, skipped=0)
+        self.pass_lock = threading.Lock()
 
     def get_static_description(self, infra_id):
-        """Acquires the static description of the infrastructure."""
-        return self.infobroker.get(
-            'infrastructure.static_description', infra_id)
+        """
+        Acquires the static description of the infrastructure.
+
+        If the version of the description is stored in the UDS (see
+        :func:`~occo.enactor.description.touch_description`), the
+        description of the previous pass is used as long as the stored
+        version is unchanged; otherwise it is fetched in every pass.
+        """
+        version = self.uds.kvstore.query_item(
+            stored_version_key(infra_id), None)
+        if version is None or version != self.stored_version:
+            self.static_description = self.infobroker.get(
+                'infrastructure.static_description', infra_id)
+            self.stored_version = version
+        return self.static_description
+
+    def describe(self, static_description):
+        """
+        Returns the indexes of the static description.
+
+        The indexes are cached, and rebuilt only if the version of the
+        description changes (see
+        :func:`~occo.enactor.description.description_version`). Unless the
+        description has a ``version`` attribute, its digest is calculated
+        whenever a new description object is fetched.
+
+        :rtype: :class:`~occo.enactor.description.DescriptionIndex`
+        """
+        if static_description is self.described:
+            # Already checked in this pass
+            return self.description
+        version = description_version(static_description)
+        if self.description is None or self.description.version != version:
+            log.debug('Indexing static description of %r (version %r)',
+                      static_description.infra_id, version)
+            self.description = DescriptionIndex(static_description, version)
+        self.described = static_description
+        return self.description
+
+    def load_scaling_snapshot(self, static_description):
+        """
+        Loads the scaling requests of every node type of the infrastructure.
 
-    def calc_target(self, node, dynamic_state):
+        :rtype: :class:`occo.enactor.scaling.ScalingSnapshot`
         """
-        Calculates the target instance count for the given node
+        return scaling.ScalingSnapshot.load(
+            static_description.infra_id,
+            list(self.describe(static_description).nodes),
+            self.uds, self.request_queue)
 
-        ..todo:: This implementation uses the minimum number of nodes
-            specified. A more sophisticated version could use other
-            information, and/or scaling functions.
+    def calc_target(self, node, dynamic_state, scaling_snapshot):
         """
-        targetcount = scaling.get_act_target_count(node)
-        newtc = scaling.process_create_node_requests(node, targetcount)
-        if newtc != targetcount: return newtc
-        newtc = scaling.process_drop_node_requests_with_ids(node, targetcount, dynamic_state)
-        if newtc != targetcount: return newtc
-        newtc = scaling.process_drop_node_requests_with_no_ids(node, targetcount)
-        if newtc != targetcount: return newtc
-        return targetcount
+        Calculates the target instance count for the given node, using the
+        scaling policy of the enactor, damped by its stabilizer.
+
+        The target is calculated once per pass for each node type; the drop
+        and the create phases of the delta share it, so the policy and the
+        stabilizer see a single sample per pass.
+
+        :param dynamic_state: The existing instances of the node.
+        :param scaling_snapshot: The scaling requests loaded for this pass.
+        :type scaling_snapshot: :class:`occo.enactor.scaling.ScalingSnapshot`
+        """
+        if node['name'] in self.pass_targets:
+            return self.pass_targets[node['name']]
+        start = time.time()
+        try:
+            target = self.scaling_policy.target_count(
+                node, dynamic_state, scaling_snapshot,
+                self.upkeep.address_index)
+            target = self.stabilizer.stabilize(
+                node, dynamic_state, target, scaling_snapshot)
+        finally:
+            self.scaling_time += time.time() - start
+        self.pass_targets[node['name']] = target
+        return target
 
-    def select_nodes_to_drop(self, existing, dropcount):
+    def select_nodes_to_drop(self, existing, dropcount, scaling_snapshot):
         """
         Selects ``dropcount`` nodes to be dropped.
 
         :param int dropcount: The number of nodes to drop.
         :param list existing: Existing node(s) from which to choose.
+        :param scaling_snapshot: The scaling requests loaded for this pass.
         """
         oneinstance = existing[list(existing.keys())[0]]
-        infraid = oneinstance['infra_id']
         nodename = oneinstance['resolved_node_definition']['name']
-        destroynodes = self.uds.get_scaling_destroynode(infraid,nodename)
+        destroynodes = scaling_snapshot.get_destroynode(nodename)
         if len(list(destroynodes.values())) > 0:
         #manual scalinga
             dn_selected = [ keyid for keyid, nodeid in list(destroynodes.items()) if nodeid !="" ]
             if len(dn_selected) > 0:
                 dn_selected_nodeids = [ nodeid for keyid, nodeid in list(destroynodes.items()) if nodeid !="" ]
                 for keyid in dn_selected:
-                    self.uds.del_scaling_destroynode(infraid, nodename, keyid)
+                    scaling_snapshot.del_destroynode(nodename, keyid)
                 selection = [ item for item in list(existing.values()) if item['node_id'] in dn_selected_nodeids ]
                 selection = selection[:dropcount]
                 return selection
             else:
                 dn_unselected = [ keyid for keyid, nodeid in list(destroynodes.items()) if nodeid =="" ]
                 for keyid in dn_unselected:
-                    self.uds.del_scaling_destroynode(infraid, nodename, keyid)
+                    scaling_snapshot.del_destroynode(nodename, keyid)
         #automatic scaling
-        return self.drop_strategy.drop_nodes(existing, dropcount)
+        candidates = self.stabilizer.downscale_candidates(existing)
+        return self.drop_strategy.drop_nodes(
+            candidates, min(dropcount, len(candidates)))
+
+    def pass_fingerprint(self, static_description, dynamic_state,
+                         failed_nodes, scaling_snapshot):
+        """
+        Calculates a digest of everything the delta depends on.
+
+        The digest covers the node types, their scaling limits and their
+        topological order; the identifiers and states of the existing
+        instances, active and standby; the pending scaling requests; and any
+        further input of the scaling policy (e.g. metrics). Failed nodes always
+        require action, so no fingerprint is returned (``None``) if there are
+        any.
+        """
+        if failed_nodes:
+            return None
+        index = self.describe(static_description)
+        def digest(state):
+            return tuple(sorted(
+                (nodename, tuple(sorted(
+                    (node_id, instance.get('state'))
+                    for node_id, instance in instances.items())))
+                for nodename, instances in state.items()))
+        policy = self.scaling_policy.fingerprint(
+            static_description.infra_id, list(index.nodes))
+        return (index.fingerprint, digest(dynamic_state),
+                digest(self.standby_instances),
+                scaling_snapshot.fingerprint(), policy)
+
+    def gen_create_instructions(self, node, existing, target):
+        """
+        Generates the CreateNode instructions for a single node type, as
+        necessary.
+
+        Standby instances of the node type are promoted first; new instances
+        are created only for the rest. If bulk creation is enabled, multiple
+        instances are created by a single instruction; otherwise, one
+        instruction is generated for each instance.
+
+        :param node: The node to be acted upon.
+        :param existing: Nodes that already exists.
+        :param int target: The target number of nodes.
+        """
+        exst_count = len(existing)
+        if target > exst_count:
+            count = target - exst_count
+            count -= len(self.standby.promote(
+                self.infra_id, node['name'],
+                self.standby_instances.get(node['name']), count))
+            return self.gen_instance_creations(node, count)
+        return []
+
+    def gen_instance_creations(self, node, count):
+        """
+        Generates the instructions creating ``count`` new instances of a node
+        type.
+        """
+        if count <= 0:
+            return []
+        if self.bulk_create and count > 1:
+            # Split to fit into the waves of creations
+            size = self.limiter.wave_size('create') or count
+            chunks = [min(size, count - i) for i in range(0, count, size)]
+            return [self.ip.cri_create_nodes(node, chunk) if chunk > 1
+                    else self.ip.cri_create_node(node)
+                    for chunk in chunks]
+        return (self.ip.cri_create_node(node)
+                for i in range(count))
+
+    def gen_standby_batch(self, static_description):
+        """
+        Generates the instructions replenishing the standby pools of the node
+        types.
+
+        :rtype: :class:`~occo.enactor.enactment.InstructionBatch`
+        """
+        index = self.describe(static_description)
+        def items():
+            for nodename, size in sorted(index.standby_sizes.items()):
+                missing = size - len(self.standby_instances.get(nodename, ()))
+                node = standby_node(index.nodes[nodename])
+                for instruction in self.gen_instance_creations(node, missing):
+                    yield node, instruction
+        return InstructionBatch('create', items())
 
     def gen_bootstrap_instructions(self, infra_id):
         """
@@ -138,10 +402,17 @@ class Enactor(object):
         # the infrastructure is started, and all necessary actions can be
         # encapsulated in this abstract instruction. Nevertheless, this method
         # can be rewritten as necessary.
+        index = self.description
+        if index is not None and index.infra_id == infra_id and index.started:
+            # An infrastructure, once started, stays started
+            return
         if not self.infobroker.get('infrastructure.started', infra_id):
             yield self.ip.cri_create_infrastructure(infra_id=infra_id)
+        elif index is not None and index.infra_id == infra_id:
+            index.started = True
 
-    def calculate_delta(self, static_description, dynamic_state, failed_nodes):
+    def calculate_delta(self, static_description, dynamic_state, failed_nodes,
+                        scaling_snapshot=None, include_creations=True):
         """
         Calculates a list of instructions to be executed to bring the
         infrastructure in its desired state.
@@ -155,11 +426,20 @@ class Enactor(object):
         :type dynamic_state: See
             :meth:`occo.infobroker.dynamic_state_provider.DynamicStateProvider.infra_state`
 
+        :param scaling_snapshot: The scaling requests of the infrastructure.
+            If omitted, they are loaded by :meth:`load_scaling_snapshot`.
+        :type scaling_snapshot: :class:`occo.enactor.scaling.ScalingSnapshot`
+
+        :param bool include_creations: If unset, the node creations are left
+            out of the delta; see :meth:`calculate_create_graph`.
+
         The result is a list of lists (generator of generators).
         The main result list is called the *delta*. Each item of the delta
         is a list of instructions that can be executed asynchronously and
         independently of each other. Each such a list pertains to a level of
-        the topological ordering of the infrastructure.
+        the topological ordering of the infrastructure. The items are
+        :class:`~occo.enactor.enactment.InstructionBatch` objects, telling
+        whether they contain bootstrap, drop or create instructions.
 
         :rtype:
             .. code::
@@ -196,7 +476,7 @@ class Enactor(object):
             :param list nodelist: List of nodes.
             :param fun: Core function that is called for each node in
                 ``nodelist``.
-            :type fun: ``(node x [node] x int) -> [command]``.
+            :type fun: ``(node x [node] x int) -> [(subject, command)]``.
 
             ``fun`` returns a *set* (generator) of instructions *for each*
             node. E.g.: when multiple instances of a single node must be
@@ -209,7 +489,9 @@ class Enactor(object):
             return util.flatten( # Union
                 fun(node,
                     existing=dynamic_state.get(node['name'], dict()),
-                    target=self.calc_target(node,dynamic_state.get(node['name'], dict())))
+                    target=self.calc_target(
+                        node, dynamic_state.get(node['name'], dict()),
+                        scaling_snapshot))
                 for node in nodelist)
 
         def mkdelinst(node, existing, target):
@@ -225,9 +507,12 @@ class Enactor(object):
             """
             exst_count = len(existing)
             if target < exst_count:
-                return (self.ip.cri_drop_node(instance_data=instance_data)
+                return ((instance_data,
+                         self.ip.cri_drop_node(
+                             instance_data=as_instance_data(instance_data)))
                         for instance_data in self.select_nodes_to_drop(
-                                existing, exst_count - target))
+                                existing, exst_count - target,
+                                scaling_snapshot))
             return []
 
         def mkcrinst(node, existing, target):
@@ -241,11 +526,8 @@ class Enactor(object):
             :param existing: Nodes that already exists.
             :param int target: The target number of nodes.
             """
-            exst_count = len(existing)
-            if target > exst_count:
-                return (self.ip.cri_create_node(node)
-                        for i in range(target - exst_count))
-            return []
+            return ((node, instruction) for instruction in
+                    self.gen_create_instructions(node, existing, target))
 
         def mkdelinstforfailednode(failed_node):
             """
@@ -258,7 +540,8 @@ class Enactor(object):
             :param existing: Nodes that already exists.
             :param int target: The target number of nodes.
             """
-            return [self.ip.cri_drop_node(failed_node)]
+            return [(failed_node,
+                     self.ip.cri_drop_node(as_instance_data(failed_node)))]
 
         def mkdrinst(node):
             """
@@ -268,87 +551,547 @@ class Enactor(object):
             instructions, for nodes that are removed from the infrastructure by
             an updated infra_desc
             """
-            return [self.ip.cri_drop_node(node)]
+            return [(node, self.ip.cri_drop_node(as_instance_data(node)))]
 
         # ShorthandGG
         infra_id = static_description.infra_id
 
+        # All scaling requests are read in one sweep; calc_target and
+        # select_nodes_to_drop work only from this snapshot.
+        if scaling_snapshot is None:
+            scaling_snapshot = self.load_scaling_snapshot(static_description)
+
         # Each `yield' returns an element of the delta
         # The bootstrap elements of the delta, iff needed.
         # This is a single list.
-        yield self.gen_bootstrap_instructions(infra_id)
+        yield InstructionBatch(
+            'bootstrap', ((infra_id, instruction) for instruction in
+                          self.gen_bootstrap_instructions(infra_id)))
 
         # Node deletions.
-        # Drop instructions are generated for each node, and then they are
-        # merged in a single list (as they have no dependencies among them).
-        yield util.flatten(mk_instructions(mkdelinst, nodelist)
-                           for nodelist in static_description.topological_order)
-
-
-        # Node deletion for node types which were removed from the
-        # infrastructure by an updated infra_desc
-        static_list=[]
-        for node in static_description.nodes:
-            static_list.append(node.get('name'))
-
-        nodelist = []
+        # Drop instructions are generated for downscaled node types, for node
+        # types which were removed from the infrastructure by an updated
+        # infra_desc, and for failed nodes. These have no dependencies among
+        # them, so they are merged in a single list; i.e. they are pushed to
+        # the infraprocessor as a single batch.
+        index = self.describe(static_description)
+        removed_nodes = []
         for node in dynamic_state:
-            if node not in static_list:
+            if node not in index:
                 for key in dynamic_state.get(node):
-                    nodelist.append(dynamic_state.get(node).get(key))
-
-        yield util.flatten(mkdrinst(node) for node in nodelist)
+                    removed_nodes.append(dynamic_state.get(node).get(key))
 
-        # Failed node deletions.
-        # Drop instructions are generated for each node, and then they are
-        # merged in a single list (as they have no dependencies among them).
-        yield util.flatten(mkdelinstforfailednode(node)
-                           for node in failed_nodes)
+        yield InstructionBatch('drop', it.chain(
+            util.flatten(mk_instructions(mkdelinst, nodelist)
+                         for nodelist in static_description.topological_order),
+            util.flatten(mkdrinst(node) for node in removed_nodes),
+            util.flatten(mkdelinstforfailednode(node)
+                         for node in failed_nodes)))
 
         # Node creations.
         # Create-instructions are generated for each node.
         # Each of these lists pertains to a topological level of the dependency
         # graph, so each of these lists is returned individually.
-        for nodelist in static_description.topological_order:
-            yield mk_instructions(mkcrinst, nodelist)
+        if include_creations:
+            for nodelist in static_description.topological_order:
+                yield InstructionBatch('create',
+                                       mk_instructions(mkcrinst, nodelist))
+            # Standby instances are replenished after the active ones have
+            # been created
+            yield self.gen_standby_batch(static_description)
+
+    def calculate_create_graph(self, static_description, dynamic_state,
+                               scaling_snapshot):
+        """
+        Calculates the node creations of the delta for dataflow enactment.
+
+        :returns: For each node type: its name, the names of the node types it
+            depends on, and the generator of its CreateNode instructions
+            paired with the node type. The target count of a node type is only
+            calculated when its instructions are generated.
+        :rtype: ``[(str, set(str), generator)]``
+        """
+        def mkcrinst(node):
+            # Being a generator, the target count is only calculated when the
+            # node type becomes ready.
+            existing = dynamic_state.get(node['name'], dict())
+            target = self.calc_target(node, existing, scaling_snapshot)
+            for instruction in self.gen_create_instructions(
+                    node, existing, target):
+                yield node, instruction
+
+        dependencies = self.describe(static_description).dependencies
+        return [(node['name'], dependencies[node['name']], mkcrinst(node))
+                for nodelist in static_description.topological_order
+                for node in nodelist]
 
     def suspend_infrastructure(self, infra_id, reason):
-        ib.main_uds.suspend_infrastructure(infra_id, reason)
+        self.uds.suspend_infrastructure(infra_id, reason)
+        touch_description(infra_id, self.uds)
 
-    def enact_delta(self, delta):
+    def enact_delta(self, delta, dependencies=None, errors=None,
+                    resume_level=0):
         """
         Push instructions to the :ref:`Infrastructure Processor
         <infraprocessor>`.
+
+        If the time budget of the pass runs out, enactment stops before a
+        creation level or wave, and the index of the interrupted creation
+        level is stored in ``interrupted_at``.
+
+        :param dependencies: The names of the node types each node type
+            depends on (see :func:`occo.enactor.dataflow.node_dependencies`).
+            If specified, node types depending on node types that could not
+            be created are not created either.
+
+        :param list errors: If specified, the errors of the drops and
+            creations that could not be enacted are appended to it;
+            otherwise, the first one is raised after the rest of the delta has
+            been enacted.
+
+        :param int resume_level: The creation levels before this one are
+            skipped; see :meth:`resume_level`.
+
+        :returns: The number of instructions pushed.
         """
+        pushed, level = 0, -1
+        failed, raise_errors = set(), errors is None
+        errors = [] if errors is None else errors
         # Push each topological level individually
         for instruction_set in delta:
+            kind = getattr(instruction_set, 'kind', None)
+            if kind == 'create':
+                level += 1
+                if level < resume_level:
+                    # Elements of the delta are generated lazily, so targets
+                    # of skipped levels are not even calculated
+                    continue
+                if self.out_of_time():
+                    self.interrupted_at = level
+                    break
             # AbstractInfraProcessor.push_instructions accepts list, not
             # generator:
-            instruction_list = list(instruction_set)
+            if isinstance(instruction_set, InstructionBatch):
+                items = list(instruction_set.items)
+            else:
+                items = [(None, instruction) for instruction in instruction_set]
+            if kind == 'create' and dependencies and failed:
+                items = self.block_dependents(items, dependencies, failed)
             # Don't send empty list needlessly
-            if instruction_list:
-                log.debug('Performing operation batch: %r', instruction_list)
-                self.ip.push_instructions(self.infra_id, instruction_list)
+            if items:
+                log.debug('Performing operation batch: %r',
+                          [instruction for _, instruction in items])
+                try:
+                    count, unenacted, error = self.push_batch(kind, items)
+                except DeadlineReached:
+                    self.interrupted_at = level
+                    break
+                pushed += count
+                if error is None:
+                    continue
+                if kind not in ('create', 'drop'):
+                    raise error
+                errors.append(error)
+                if kind == 'create':
+                    failed.update(node['name'] for node in unenacted)
+        if errors and raise_errors:
+            raise errors[0]
+        return pushed
+
+    def block_dependents(self, items, dependencies, failed):
+        """
+        Leaves out the creations of node types depending on failed node types,
+        adding them to ``failed``.
+        """
+        blocked = set(node['name'] for node, _ in items
+                      if dependencies.get(node['name'], set()) & failed)
+        for nodename in sorted(blocked):
+            log.warning('Not creating node %r: a node it depends on has '
+                        'failed', nodename)
+        failed.update(blocked)
+        return [(node, instruction) for node, instruction in items
+                if node['name'] not in blocked]
+
+    def push_batch(self, kind, items, attempt=0):
+        """
+        Pushes a batch of instructions, retrying failed operations as allowed
+        by the retry policy.
+
+        After a failure, the operations not enacted yet are determined by
+        :meth:`remaining_operations`, so operations that succeeded are not
+        repeated. Remaining creations are retried per node type, so a node
+        type failing persistently does not fail its siblings.
+
+        :param int attempt: The number of retries of the operations so far.
+
+        :returns: The number of instructions pushed, the subjects of the
+            operations that could not be enacted, and the last error (or
+            ``None``).
+        """
+        pushed = 0
+        while True:
+            try:
+                pushed += len(items)
+                self.push_waves(kind, [instruction for _, instruction in items])
+                return pushed, [], None
+            except (KeyboardInterrupt, DeadlineReached):
+                raise
+            except Exception as ex:
+                error = ex
+            remaining = self.remaining_operations(kind, items)
+            if remaining is not None and not remaining:
+                return pushed, [], None
+            delay = self.retry_policy.delay(attempt) \
+                if remaining is not None else None
+            if delay is None:
+                log.error('Failed to enact %d %s operation(s): %s',
+                          len(remaining or items), kind, error)
+                return pushed, [subject for subject, _
+                                in remaining or items], error
+            if kind == 'create' and self.deadline is not None \
+                    and time.time() + delay > self.deadline:
+                # The next pass retries the remaining creations
+                log.warning('Failed to enact %s operations (%s); no time '
+                            'left to retry', kind, error)
+                raise DeadlineReached()
+            log.warning('Failed to enact %s operations (%s); retrying %d '
+                        'operation(s) in %.1fs',
+                        kind, error, len(remaining), delay)
+            self.metrics.increment('enactor_retries_total',
+                                   infra_id=self.infra_id, kind=kind)
+            time.sleep(delay)
+            attempt += 1
+            groups = self.retry_groups(kind, remaining)
+            if len(groups) > 1:
+                return self.push_groups(kind, groups, attempt, pushed)
+            items = remaining
+
+    def retry_groups(self, kind, items):
+        """
+        Splits the remaining operations of a failed batch into the groups
+        retried independently: creations by node type.
+        """
+        if kind != 'create':
+            return [items]
+        groups = collections.OrderedDict()
+        for node, instruction in items:
+            groups.setdefault(node['name'], []).append((node, instruction))
+        return list(groups.values())
+
+    def push_groups(self, kind, groups, attempt, pushed=0):
+        """
+        Pushes the groups of operations with :meth:`push_batch` one by one.
+
+        :returns: The results of the groups combined, as by
+            :meth:`push_batch`.
+        """
+        unenacted, error = [], None
+        for items in groups:
+            count, failed, group_error = self.push_batch(kind, items, attempt)
+            pushed += count
+            unenacted.extend(failed)
+            error = group_error or error
+        return pushed, unenacted, error
+
+    def remaining_operations(self, kind, items):
+        """
+        Determines which operations of a failed batch have not been enacted,
+        based on the current state of the infrastructure, and generates their
+        instructions anew.
+
+        :returns: The remaining operations, or ``None`` if they cannot be
+            determined (the batch cannot be retried).
+        """
+        if kind == 'bootstrap':
+            return [(self.infra_id, instruction) for instruction
+                    in self.gen_bootstrap_instructions(self.infra_id)]
+        if kind not in ('create', 'drop'):
+            return None
+        dynamic_state = self.infobroker.get(
+            'infrastructure.state', self.infra_id, True)
+        if kind == 'drop':
+            node_ids = set(node_id for instances in dynamic_state.values()
+                           for node_id in instances)
+            instances = collections.OrderedDict(
+                (instance_data['node_id'], instance_data)
+                for instance_data, _ in items)
+            return [(instance_data,
+                     self.ip.cri_drop_node(as_instance_data(instance_data)))
+                    for node_id, instance_data in instances.items()
+                    if node_id in node_ids]
+        dynamic_state, _ = self.standby.partition(
+            self.infra_id, list(self.description.standby_sizes),
+            dynamic_state)
+        # Standby pools are replenished in the next pass
+        nodes = collections.OrderedDict(
+            (node['name'], node) for node, _ in items
+            if not node.get('standby'))
+        return [(node, instruction)
+                for node in nodes.values()
+                for instruction in self.gen_create_instructions(
+                    node, dynamic_state.get(node['name'], dict()),
+                    self.pass_targets[node['name']])]
+
+    def push_waves(self, kind, instruction_list):
+        """
+        Pushes a batch of instructions in waves, as allowed by the enactment
+        limits.
+
+        :raises DeadlineReached: if the time budget of the pass runs out
+            before a wave of creations, or while waiting for the limits.
+        """
+        for wave in self.limiter.waves(kind, instruction_list,
+                                       self.operation_count):
+            if kind == 'create' and self.out_of_time():
+                raise DeadlineReached()
+            if len(wave) < len(instruction_list):
+                log.debug('Performing wave of %d %s instructions',
+                          len(wave), kind)
+            # The first wave of creations is pushed regardless
+            deadline = self.deadline \
+                if kind == 'create' and self.progressed else None
+            operations = sum(self.operation_count(i) for i in wave)
+            with self.limiter.acquire(kind, operations, deadline):
+                self.push_instructions(wave)
+            if kind == 'create':
+                self.progressed = True
+
+    @staticmethod
+    def operation_count(instruction):
+        """
+        Returns the number of instances an instruction acts upon: the
+        ``count`` of bulk creations, 1 otherwise.
+        """
+        count = getattr(instruction, 'count', None)
+        return count if isinstance(count, int) else 1
+
+    def out_of_time(self):
+        """
+        Returns whether the time budget of the pass has run out. The first
+        wave of creations is always pushed, so each pass makes progress.
+        """
+        return self.deadline is not None and self.progressed \
+            and time.time() >= self.deadline
+
+    def push_instructions(self, instruction_list):
+        """
+        Pushes a single batch of instructions to the :ref:`Infrastructure
+        Processor <infraprocessor>`.
+        """
+        self.metrics.observe('enactor_batch_instructions',
+                             len(instruction_list), infra_id=self.infra_id)
+        with self.metrics.timer('enactor_push_seconds',
+                                infra_id=self.infra_id):
+            self.ip.push_instructions(self.infra_id, instruction_list)
+
+    def enact_create_graph(self, create_graph):
+        """
+        Push the node creations to the :ref:`Infrastructure Processor
+        <infraprocessor>` in dataflow order.
+
+        :returns: The number of instructions pushed.
+        """
+        pushed = []
+        def push_instructions(nodename, items):
+            if self.out_of_time():
+                self.interrupted_at = 0
+                return
+            try:
+                count, _, error = self.push_batch('create', items)
+            except DeadlineReached:
+                self.interrupted_at = 0
+                return
+            pushed.append(count)
+            if error is not None:
+                raise error
+        dataflow.enact_dataflow(push_instructions, create_graph,
+                                self.dataflow_workers)
+        return sum(pushed)
 
-    def make_a_pass(self):
+    def make_a_pass(self, deadline=None, time_budget=None):
         """
         Make a maintenance pass on the infrastructure.
+
+        Passes of the same :class:`Enactor` never overlap; a concurrent call
+        waits for the running pass to finish. To maintain multiple
+        infrastructures concurrently, see :class:`occo.enactor.pool.EnactorPool`.
+
+        If the enactor has a ``lease``, the pass is refused (outcome
+        ``unleased``) unless the enactor holds the lease of the
+        infrastructure.
+
+        :param float deadline: The time (as returned by :func:`time.time`)
+            by which the pass should finish.
+        :param float time_budget: The time (in seconds) the pass may take;
+            an alternative to ``deadline``.
+
+        When the deadline is reached, the pass stops before the next level
+        or wave of creations (outcome ``interrupted``); bootstrap and drops
+        are always completed, and at least one wave of creations is pushed.
+        The next pass resumes with the interrupted level; see
+        :meth:`resume_level`. Waiting for the enactment limits or for retries
+        of creations does not exceed the deadline either.
+
+        :returns: The outcome of the pass; see :meth:`maintain`.
+        """
+        if time_budget is not None:
+            budget_deadline = time.time() + time_budget
+            deadline = budget_deadline if deadline is None \
+                else min(deadline, budget_deadline)
+        with self.pass_lock:
+            self.deadline = deadline
+            try:
+                return self._make_a_pass()
+            finally:
+                self.deadline = None
+
+    def _make_a_pass(self):
+        self.call_counts.clear()
+        self.scaling_time = 0.0
+        self.pass_targets.clear()
+        self.retry_policy.reset()
+        self.stabilizer.begin_pass()
+        self.described = None
+        self.progressed = False
+        self.interrupted_at = None
+        outcome = 'aborted'
+        try:
+            if not self.holds_lease():
+                outcome = 'unleased'
+                return outcome
+            outcome = self.maintain()
+            return outcome
+        finally:
+            self.record_pass(outcome)
+
+    def holds_lease(self):
+        """
+        Acquires or renews the lease of the infrastructure.
+
+        :returns: Whether the enactor may enact the infrastructure.
+        """
+        if self.lease is None:
+            return True
+        if self.lease.hold(self.infra_id):
+            return True
+        log.info('Infrastructure %r is not leased to this enactor (%r): '
+                 'SKIPPING Enactor pass', self.infra_id, self.lease.owner)
+        return False
+
+    def record_pass(self, outcome):
+        """
+        Reports the outcome, the scaling time and the service calls of the
+        pass to the metrics sink.
+        """
+        self.metrics.increment('enactor_passes_total',
+                               infra_id=self.infra_id, outcome=outcome)
+        self.metrics.observe('enactor_phase_seconds', self.scaling_time,
+                             infra_id=self.infra_id, phase='scaling')
+        for (service, method), count in list(self.call_counts.items()):
+            self.metrics.observe('enactor_pass_calls', count,
+                                 infra_id=self.infra_id,
+                                 service=service, method=method)
+        log.debug('Service calls of the pass of %r: %r',
+                  self.infra_id, dict(self.call_counts))
+
+    def phase(self, name):
+        """Times a phase of the pass."""
+        return self.metrics.timer('enactor_phase_seconds',
+                                  infra_id=self.infra_id, phase=name)
+
+    def maintain(self):
+        """
+        Performs the maintenance pass.
+
+        :returns: The outcome of the pass: ``full``, ``skipped``,
+            ``interrupted``, ``suspended`` or ``torn_down``.
         """
-        # TODO: if there is no queue, how to check whether it is safe to wokr?
-        #       probably need to use a Lock()
+        if self.torn_down():
+            log.info('Infrastructure %r has been torn down: SKIPPING Enactor '
+                     'pass', self.infra_id)
+            return 'torn_down'
         log.info('Start maintaining the infrastructure %s',
                  self.infra_id)
-        static_description = self.get_static_description(self.infra_id)
+        with self.phase('static_description'):
+            static_description = self.get_static_description(self.infra_id)
         if static_description.suspended:
             log.info('Infrastructure %r is suspended: SKIPPING Enactor pass',
                      self.infra_id)
-            return
+            return 'suspended'
+
+        with self.phase('upkeep'):
+            dynamic_state, failed_nodes = \
+                self.upkeep.acquire_dynamic_state(self.infra_id)
+            dynamic_state, self.standby_instances = self.standby.partition(
+                self.infra_id,
+                list(self.describe(static_description).standby_sizes),
+                dynamic_state)
+        with self.phase('scaling_snapshot'):
+            scaling_snapshot = self.load_scaling_snapshot(static_description)
+        try:
+            outcome = self.converge(static_description, dynamic_state,
+                                    failed_nodes, scaling_snapshot)
+        finally:
+            # Requests drained from the request queue; the ones not consumed
+            # are put back
+            scaling_snapshot.acknowledge()
+        if outcome == 'interrupted':
+            # Not ready yet; the next pass resumes
+            return outcome
+        log.info('Finished maintaining the infrastructure %s', self.infra_id)
+        ib.main_eventlog.infrastructure_ready(self.infra_id)
+        self.uds.finished_first_maintenance(self.infra_id)
+        return outcome
+
+    def converge(self, static_description, dynamic_state, failed_nodes,
+                 scaling_snapshot):
+        """
+        Calculates and enacts the delta, unless the inputs of the pass are
+        unchanged since the last converged pass.
+
+        :returns: The outcome of the pass: ``full``, ``skipped`` or
+            ``interrupted``.
+        """
+        dataflow_mode = self.enactment_mode == 'dataflow'
+        index = self.describe(static_description)
+        # Dataflow enactment is not resumed: the create graph covers only
+        # what is still missing anyway
+        resume_level = self.resume_level(index) if not dataflow_mode else 0
+        fingerprint = self.pass_fingerprint(static_description, dynamic_state,
+                                            failed_nodes, scaling_snapshot) \
+            if self.skip_unchanged else None
+        if fingerprint is not None and not resume_level \
+                and fingerprint == self.converged_fingerprint:
+            self.pass_counters['skipped'] += 1
+            log.info('Infrastructure %s is unchanged since the last converged '
+                     'pass: SKIPPING delta calculation', self.infra_id)
+            return 'skipped'
 
-        dynamic_state, failed_nodes = self.upkeep.acquire_dynamic_state(self.infra_id)
-        delta = self.calculate_delta(static_description, dynamic_state, failed_nodes)
+        self.pass_counters['full'] += 1
+        self.converged_fingerprint = None
+        delta = self.calculate_delta(static_description, dynamic_state,
+                                     failed_nodes, scaling_snapshot,
+                                     include_creations=not dataflow_mode)
+        dependencies = index.dependencies
         try:
             log.debug('Performing generated operations')
-            self.enact_delta(delta)
+            with self.phase('enactment'):
+                if not dataflow_mode:
+                    pushed = self.enact_delta(delta, dependencies,
+                                              resume_level=resume_level)
+                else:
+                    # Failed drops must not hold back the creations
+                    errors = []
+                    pushed = self.enact_delta(delta, dependencies, errors)
+                    pushed += self.enact_create_graph(
+                        self.calculate_create_graph(
+                            static_description, dynamic_state,
+                            scaling_snapshot))
+                    pushed += self.enact_delta(
+                        [self.gen_standby_batch(static_description)],
+                        errors=errors)
+                    if errors:
+                        raise errors[0]
         except KeyboardInterrupt:
             log.info('ABORTING Enactor pass: received KeyboardInterrupt')
             raise
@@ -359,6 +1102,166 @@ class Enactor(object):
             #log.info('SUSPENDING infrastructure %r', self.infra_id)
             #self.suspend_infrastructure(self.infra_id, ex)
             raise
-        log.info('Finished maintaining the infrastructure %s', self.infra_id)
-        ib.main_eventlog.infrastructure_ready(self.infra_id)
-        ib.main_uds.finished_first_maintenance(self.infra_id)
+        if self.interrupted_at is not None:
+            log.info('Time budget of the pass of %r has run out: stopped at '
+                     'creation level %d', self.infra_id, self.interrupted_at)
+            if not dataflow_mode:
+                self.uds.kvstore.set_item(
+                    self.resume_key(),
+                    dict(version=index.version, level=self.interrupted_at))
+            return 'interrupted'
+        if pushed == 0 and not self.stabilizer.held and not resume_level:
+            # Held back targets may be released by the mere passing of time
+            self.converged_fingerprint = fingerprint
+        return 'full'
+
+    def resume_key(self):
+        return 'infra:{0}:resume'.format(self.infra_id)
+
+    def resume_level(self, index):
+        """
+        Takes the creation level the previous pass has been interrupted at,
+        as recorded in the key-value store of the UDS under
+        ``infra:<infra_id>:resume``.
+
+        The record is cleared, so it is used by a single pass; it is ignored
+        if the static description has changed since.
+
+        :returns: The index of the creation level to resume from; 0 if the
+            previous pass has not been interrupted.
+        """
+        kvstore = self.uds.kvstore
+        record = kvstore.query_item(self.resume_key(), None)
+        if not record:
+            return 0
+        kvstore.set_item(self.resume_key(), None)
+        if record.get('version') != index.version:
+            log.info('Description of %r has changed since the interrupted '
+                     'pass: not resuming', self.infra_id)
+            return 0
+        log.info('Resuming enactment of %r at creation level %d',
+                 self.infra_id, record['level'])
+        return record['level']
+
+    def teardown_key(self):
+        return 'infra:{0}:teardown'.format(self.infra_id)
+
+    def teardown(self, progress=None):
+        """
+        Tears down the whole infrastructure.
+
+        Instances of node types no longer in the description are dropped
+        first, then the node types level by level in reverse topological
+        order, each level as a single batch: one ``cri_drop_nodes`` instruction
+        if the infraprocessor provides it, otherwise one ``cri_drop_node``
+        instruction for each instance. Finally, the infrastructure itself is
+        dropped with ``cri_drop_infrastructure``. Failed batches are retried
+        as allowed by the retry policy.
+
+        Progress is recorded in the key-value store of the UDS under
+        ``infra:<infra_id>:teardown``, so an interrupted teardown is resumed
+        from the level it stopped at; tearing down an infrastructure that has
+        already been torn down does nothing.
+
+        :param progress: Called after each level with the number of levels
+            done, the number of levels, and the number of instances dropped so
+            far.
+        :type progress: ``(int, int, int) -> None``
+
+        :returns: The teardown record: ``level`` (levels done), ``levels``,
+            ``dropped`` (instances) and ``done``; or ``None`` if the enactor
+            does not hold the lease of the infrastructure.
+        """
+        with self.pass_lock:
+            if not self.holds_lease():
+                return None
+            return self._teardown(progress)
+
+    def _teardown(self, progress):
+        self.retry_policy.reset()
+        kvstore = self.uds.kvstore
+        record = kvstore.query_item(self.teardown_key(), None)
+        if record and record.get('done'):
+            log.info('Infrastructure %r has already been torn down',
+                     self.infra_id)
+            return record
+
+        static_description = self.get_static_description(self.infra_id)
+        index = self.describe(static_description)
+        dynamic_state = self.infobroker.get(
+            'infrastructure.state', self.infra_id, True)
+        removed = [nodename for nodename in dynamic_state
+                   if nodename not in index]
+        levels = [removed] + list(reversed(index.levels))
+        if not record:
+            record = dict(level=0, levels=len(levels), dropped=0, done=False)
+        else:
+            log.info('Resuming teardown of infrastructure %r at level %d/%d',
+                     self.infra_id, record['level'], record['levels'])
+            record['levels'] = len(levels)
+
+        for level in range(record['level'], len(levels)):
+            record['dropped'] += self.teardown_level(levels[level],
+                                                     dynamic_state)
+            record['level'] = level + 1
+            kvstore.set_item(self.teardown_key(), record)
+            log.info('Teardown of infrastructure %r: %d/%d levels done, '
+                     '%d instance(s) dropped', self.infra_id, record['level'],
+                     record['levels'], record['dropped'])
+            if progress:
+                progress(record['level'], record['levels'], record['dropped'])
+
+        self.push_instructions(
+            [self.ip.cri_drop_infrastructure(infra_id=self.infra_id)])
+        record['done'] = True
+        kvstore.set_item(self.teardown_key(), record)
+        index.started = False
+        self.converged_fingerprint = None
+        log.info('Infrastructure %r has been torn down', self.infra_id)
+        return record
+
+    def torn_down(self):
+        """
+        Returns whether the infrastructure has been torn down (see
+        :meth:`teardown`). Passes are refused on torn down infrastructures,
+        until their teardown record is deleted from the UDS.
+        """
+        record = self.uds.kvstore.query_item(self.teardown_key(), None)
+        return bool(record and record.get('done'))
+
+    def teardown_level(self, nodenames, dynamic_state):
+        """
+        Drops the instances of the given node types as a single batch.
+
+        :returns: The number of instances dropped.
+        """
+        attempt = 0
+        while True:
+            instances = [instance for nodename in nodenames
+                         for instance in
+                         dynamic_state.get(nodename, dict()).values()]
+            if not instances:
+                return 0
+            if callable(getattr(self.ip, 'cri_drop_nodes', None)):
+                instructions = [self.ip.cri_drop_nodes(instances)]
+            else:
+                instructions = [self.ip.cri_drop_node(instance_data=instance)
+                                for instance in instances]
+            try:
+                self.push_waves('drop', instructions)
+                return len(instances)
+            except KeyboardInterrupt:
+                raise
+            except Exception as ex:
+                delay = self.retry_policy.delay(attempt)
+                if delay is None:
+                    log.error('Teardown of nodes %r of infrastructure %r '
+                              'failed: %s', nodenames, self.infra_id, ex)
+                    raise
+                log.warning('Teardown of nodes %r failed (%s); retrying in '
+                            '%.1fs', nodenames, ex, delay)
+                time.sleep(delay)
+                attempt += 1
+                # Only the instances still existing are dropped again
+                dynamic_state = self.infobroker.get(
+                    'infrastructure.state', self.infra_id, True)
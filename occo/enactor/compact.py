@@ -0,0 +1,196 @@
+### Copyright 2014, MTA SZTAKI, www.sztaki.hu
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###    http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+
+"""
+Compact representation of the dynamic state.
+
+Each instance in the dynamic state carries its own copy of the
+``resolved_node_definition`` and ``node_description`` of its node type, even
+though they are the same for all instances of the node type. An
+:class:`InstanceRecord` keeps the frequently used fields of an instance in
+slots, and refers to definitions shared by the instances of the node type
+(interned by :class:`SharedDefinitions`). Records are read-only mappings, so
+they can be used in place of the instance dictionaries; :meth:`as_dict`
+materializes the full dictionary when it is needed (e.g. to be sent to the
+infraprocessor).
+
+See the ``compact`` upkeep strategy in :mod:`occo.enactor.upkeep`.
+"""
+
+__all__ = ['InstanceRecord', 'SharedDefinitions', 'compact_instance',
+           'compact_state', 'as_instance_data']
+
+from collections.abc import Mapping
+import threading
+import logging
+
+log = logging.getLogger('occo.enactor.compact')
+
+_MISSING = object()
+
+class SharedDefinitions(object):
+    """
+    Interns the definitions shared by the instances of node types.
+
+    Definitions are looked up by identity first; then compared by value, so
+    instances acquired separately (and thus having distinct, but equal,
+    copies) share a single copy. As records of known instances are reused
+    (see :func:`compact_instance`), only the definitions of new instances are
+    compared.
+    """
+    SHARED = ('resolved_node_definition', 'node_description')
+
+    def __init__(self):
+        self.variants = dict()
+        self.lock = threading.Lock()
+
+    def intern(self, nodename, instance):
+        """
+        Returns the shared definitions of the instance.
+
+        :rtype: ``{str: object}``
+        """
+        definitions = dict((key, instance[key])
+                           for key in self.SHARED if key in instance)
+        with self.lock:
+            variants = self.variants.setdefault(nodename, [])
+            for variant in variants:
+                if len(variant) == len(definitions) and all(
+                        variant.get(key) is value
+                        for key, value in definitions.items()):
+                    return variant
+            for variant in variants:
+                if variant == definitions:
+                    return variant
+            variants.append(definitions)
+            return definitions
+
+    def forget(self, nodenames):
+        """Forgets the definitions of node types other than ``nodenames``."""
+        with self.lock:
+            for nodename in set(self.variants) - set(nodenames):
+                del self.variants[nodename]
+
+class InstanceRecord(Mapping):
+    """
+    Read-only, compact view of the data of an instance.
+
+    :param dict instance: The instance data.
+    :param dict definitions: The shared definitions of the instance; see
+        :meth:`SharedDefinitions.intern`.
+    """
+    FIELDS = ('node_id', 'infra_id', 'state', 'instance_start_time',
+              'resource_address')
+    __slots__ = FIELDS + ('definitions', 'extra', 'materialized')
+
+    def __init__(self, instance, definitions):
+        for field in self.FIELDS:
+            setattr(self, field, instance.get(field, _MISSING))
+        self.definitions = definitions
+        extra = dict((key, value) for key, value in instance.items()
+                     if key not in self.FIELDS and key not in definitions)
+        self.extra = extra or None
+        self.materialized = None
+
+    def __getitem__(self, key):
+        if key in self.FIELDS:
+            value = getattr(self, key)
+            if value is not _MISSING:
+                return value
+        elif key in self.definitions:
+            return self.definitions[key]
+        elif self.extra and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __iter__(self):
+        for field in self.FIELDS:
+            if getattr(self, field) is not _MISSING:
+                yield field
+        for key in self.definitions:
+            yield key
+        for key in self.extra or ():
+            yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def as_dict(self):
+        """
+        Returns the full instance data as a dictionary. The dictionary is
+        created on first use, and must not be modified.
+        """
+        if self.materialized is None:
+            self.materialized = dict(self.items())
+        return self.materialized
+
+    def same_as(self, instance):
+        """
+        Returns whether the record represents the given instance data, so it
+        can be reused.
+
+        The definitions of an instance are resolved when it is created and
+        never change, so they are not compared.
+        """
+        for field in self.FIELDS:
+            if instance.get(field, _MISSING) != getattr(self, field):
+                return False
+        extra, count = self.extra or dict(), 0
+        for key, value in instance.items():
+            if key in self.FIELDS or key in self.definitions:
+                continue
+            if extra.get(key, _MISSING) != value:
+                return False
+            count += 1
+        return count == len(extra)
+
+    def __repr__(self):
+        return 'InstanceRecord({0!r})'.format(self.as_dict())
+
+def compact_instance(nodename, instance, shared, previous=None):
+    """
+    Returns the record of an instance; ``previous`` (the record of the
+    instance in the previous pass) if it is unchanged.
+    """
+    if isinstance(instance, InstanceRecord):
+        return instance
+    if previous is not None and previous.same_as(instance):
+        return previous
+    return InstanceRecord(instance, shared.intern(nodename, instance))
+
+def compact_state(dynamic_state, shared, previous=None):
+    """
+    Converts the instances of the dynamic state into records, in place, so
+    the instance dictionaries are released as soon as possible.
+
+    :param shared: The interned definitions.
+    :type shared: :class:`SharedDefinitions`
+    :param previous: The compacted dynamic state of the previous pass; its
+        unchanged records are reused.
+    :returns: The compacted dynamic state.
+    """
+    shared.forget(dynamic_state)
+    previous = previous or dict()
+    for nodename, instances in dynamic_state.items():
+        known = previous.get(nodename, dict())
+        for node_id, instance in instances.items():
+            instances[node_id] = compact_instance(
+                nodename, instance, shared, known.get(node_id))
+    return dynamic_state
+
+def as_instance_data(instance):
+    """Returns the instance data as a dictionary, for the infraprocessor."""
+    if isinstance(instance, InstanceRecord):
+        return instance.as_dict()
+    return instance
@@ -0,0 +1,129 @@
+### Copyright 2014, MTA SZTAKI, www.sztaki.hu
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###    http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+
+"""
+Dependency-driven (dataflow) enactment of node creations.
+
+By default, the :class:`~occo.enactor.Enactor` creates nodes level by level
+along the topological ordering of the infrastructure, so a slow node type holds
+back the whole next level. In dataflow mode, the creation of each node type is
+started as soon as the creation of the node types *it* depends on has
+finished.
+"""
+
+__all__ = ['node_dependencies', 'enact_dataflow']
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import logging
+
+log = logging.getLogger('occo.enactor.dataflow')
+
+def _node_name(node):
+    return node['name'] if isinstance(node, dict) else node
+
+def node_dependencies(static_description):
+    """
+    Determines the direct dependencies of each node type.
+
+    Dependencies are specified as ``[dependent, dependency]`` pairs, either
+    directly or under the ``connection`` key; the nodes may be given by their
+    definition or by name.
+
+    :returns: The set of the names of the node types each node type depends
+        on.
+    :rtype: ``{str: set(str)}``
+    """
+    deps = dict((node['name'], set()) for node in static_description.nodes)
+    for dependency in getattr(static_description, 'dependencies', None) or []:
+        if isinstance(dependency, dict):
+            dependency = dependency['connection']
+        dependent, dependee = (_node_name(n) for n in dependency)
+        deps.setdefault(dependent, set()).add(dependee)
+    return deps
+
+def enact_dataflow(push_instructions, create_graph, max_workers=8):
+    """
+    Pushes the instruction batches of the node types as soon as their
+    dependencies have been enacted.
+
+    :param push_instructions: Pushes the batch of instructions of a single
+        node type, and returns when they have been performed.
+    :type push_instructions: ``(str, [instruction]) -> None``
+
+    :param create_graph: The instructions of each node type along with the
+        names of the node types it depends on. Dependencies not appearing in
+        the graph are considered satisfied.
+    :type create_graph: ``[(str, set(str), [instruction])]``
+
+    :param int max_workers: The maximum number of batches pushed concurrently.
+
+    If pushing the batch of a node type fails, the node types depending on it
+    (directly or indirectly) are not started, but independent node types are
+    still enacted. The first exception is re-raised when nothing else can be
+    done.
+    """
+    names = set(name for name, _, _ in create_graph)
+    pending = dict((name, (deps & names, instructions))
+                   for name, deps, instructions in create_graph)
+    done, failed, running, errors = set(), set(), dict(), []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            ready = [name for name, (deps, _) in list(pending.items())
+                     if deps <= done]
+            for name in ready:
+                _, instructions = pending.pop(name)
+                instruction_list = list(instructions)
+                if instruction_list:
+                    log.debug('Performing operation batch of %r: %r',
+                              name, instruction_list)
+                    running[executor.submit(
+                        push_instructions, name, instruction_list)] = name
+                else:
+                    done.add(name)
+            if ready and not running:
+                # Nothing to wait for; newly satisfied node types may be ready
+                continue
+            if not running:
+                raise ValueError(
+                    'Circular dependency among node types: {0!r}'.format(
+                        sorted(pending)))
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    future.result()
+                except Exception as ex:
+                    log.error('Enacting node type %r failed: %s', name, ex)
+                    failed.add(name)
+                    errors.append(ex)
+                else:
+                    done.add(name)
+            _block_dependents(pending, failed)
+    if errors:
+        raise errors[0]
+
+def _block_dependents(pending, failed):
+    """
+    Removes the node types depending on failed node types from ``pending``,
+    adding them to ``failed``.
+    """
+    blocked = True
+    while blocked:
+        blocked = [name for name, (deps, _) in list(pending.items())
+                   if deps & failed]
+        for name in blocked:
+            log.warning('Not enacting node type %r: a node type it depends '
+                        'on has failed', name)
+            del pending[name]
+            failed.add(name)
@@ -0,0 +1,137 @@
+### Copyright 2014, MTA SZTAKI, www.sztaki.hu
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###    http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+
+"""
+Data derived from the static description of an infrastructure.
+
+The static description rarely changes, but the
+:class:`~occo.enactor.Enactor` needs node lookups, the set of node names and
+the dependencies in every pass. A :class:`DescriptionIndex` holds these, and
+is rebuilt only when the version of the description changes.
+
+Components storing or modifying static descriptions in the UDS (including
+suspending infrastructures) record this with :func:`touch_description`; the
+enactor then fetches the description only when its stored version changes.
+"""
+
+__all__ = ['description_version', 'DescriptionIndex',
+           'stored_version_key', 'touch_description']
+
+from . import dataflow as dataflow
+from . import scaling as scaling
+from . import standby as standby
+import occo.infobroker as ib
+import hashlib
+import uuid
+import weakref
+import logging
+
+log = logging.getLogger('occo.enactor.description')
+
+# Digests of the description objects seen, see description_version
+_digests = weakref.WeakKeyDictionary()
+
+def description_version(static_description):
+    """
+    Returns the version of a static description.
+
+    The ``version`` attribute of the description is used if it has any;
+    otherwise, a digest of the node types, the dependencies and the
+    topological order. The digest is calculated once per description object,
+    so descriptions must not be modified in place: a changed description is
+    expected to be a new object.
+    """
+    version = getattr(static_description, 'version', None)
+    if version is not None:
+        return version
+    try:
+        return _digests[static_description]
+    except (KeyError, TypeError):
+        pass
+    content = repr((static_description.infra_id,
+                    static_description.nodes,
+                    getattr(static_description, 'dependencies', None),
+                    static_description.topological_order))
+    digest = hashlib.sha1(content.encode('utf-8')).hexdigest()
+    try:
+        _digests[static_description] = digest
+    except TypeError:
+        # Neither hashable nor weakly referable
+        pass
+    return digest
+
+def stored_version_key(infra_id):
+    return 'infra:{0}:description_version'.format(infra_id)
+
+def touch_description(infra_id, uds=None):
+    """
+    Records in the key-value store of the UDS that the static description
+    of an infrastructure has changed; to be called after the description has
+    been stored.
+
+    :param uds: The UDS to use; :data:`occo.infobroker.main_uds` by default.
+    :returns: The new stored version.
+    """
+    uds = ib.main_uds if uds is None else uds
+    version = uuid.uuid4().hex
+    uds.kvstore.set_item(stored_version_key(infra_id), version)
+    return version
+
+class DescriptionIndex(object):
+    """
+    Indexes of a static description.
+
+    :ivar version: The version of the indexed description.
+    :ivar nodes: The node types by name.
+    :ivar node_names: The set of the node names.
+    :ivar levels: The node names of each topological level.
+    :ivar level_of: The index of the topological level by node name.
+    :ivar dependencies: The names of the node types each node type depends
+        on; see :func:`occo.enactor.dataflow.node_dependencies`.
+    :ivar fingerprint: The digest of the node types, their scaling limits,
+        standby pool sizes and their topological order; see
+        :meth:`occo.enactor.Enactor.pass_fingerprint`.
+    :ivar standby_sizes: The number of standby instances of the node types
+        having any; see :mod:`occo.enactor.standby`.
+    :ivar bool started: Whether the infrastructure is known to be started.
+    """
+    def __init__(self, static_description, version=None):
+        self.version = description_version(static_description) \
+            if version is None else version
+        self.infra_id = static_description.infra_id
+        self.nodes = dict((node['name'], node)
+                          for node in static_description.nodes)
+        self.node_names = frozenset(self.nodes)
+        self.levels = [[node['name'] for node in nodelist]
+                       for nodelist in static_description.topological_order]
+        self.level_of = dict((nodename, i)
+                             for i, level in enumerate(self.levels)
+                             for nodename in level)
+        self.dependencies = dataflow.node_dependencies(static_description)
+        self.standby_sizes = dict(
+            (name, standby.pool_size(node))
+            for name, node in self.nodes.items()
+            if standby.pool_size(node) > 0)
+        self.fingerprint = (
+            self.infra_id,
+            tuple(tuple(sorted(
+                      (node['name'],) + scaling.get_scaling_limits(node)
+                      for node in nodelist))
+                  for nodelist in static_description.topological_order),
+            tuple(sorted(self.standby_sizes.items())),
+        )
+        self.started = False
+
+    def __contains__(self, nodename):
+        return nodename in self.node_names
@@ -13,6 +13,8 @@
 ### limitations under the License.
 
 import occo.util.factory as factory
+from .policy import MetricsProvider
+import heapq
 import random
 import logging
 
@@ -33,7 +35,8 @@ class DownscaleStrategy(factory.MultiBackend):
 class SimpleDownscaleStrategy(DownscaleStrategy):
     """Implements :class:`DownscaleStrategy`, dropping the latest nodes."""
     def drop_nodes(self, existing, dropcount):
-        nodes = sorted(list(existing.values()), key=lambda k: k['instance_start_time'])[-dropcount:]
+        nodes = heapq.nlargest(dropcount, existing.values(),
+                               key=lambda k: k['instance_start_time'])
         log.debug('Selected nodes (last N) for downscaling: %r', nodes)
         return nodes
 
@@ -45,3 +48,85 @@ class RandomDownscaleStrategy(DownscaleStrategy):
         log.debug('Selected nodes (randomly) for downscaling: %r', nodes)
         return nodes
 
+class DownscaleScorer(factory.MultiBackend):
+    """
+    Abstract scoring function for :class:`ScoringDownscaleStrategy`.
+
+    Instances with higher scores are dropped first.
+    """
+
+    def __init__(self):
+        pass
+
+    def score(self, instance):
+        raise NotImplementedError()
+
+@factory.register(DownscaleScorer, 'newest')
+class NewestFirstScorer(DownscaleScorer):
+    """Implements :class:`DownscaleScorer`, preferring the latest nodes."""
+    def score(self, instance):
+        return instance['instance_start_time']
+
+@factory.register(DownscaleScorer, 'oldest')
+class OldestFirstScorer(DownscaleScorer):
+    """Implements :class:`DownscaleScorer`, preferring the earliest nodes."""
+    def score(self, instance):
+        return -instance['instance_start_time']
+
+@factory.register(DownscaleScorer, 'least_loaded')
+class LeastLoadedScorer(DownscaleScorer):
+    """
+    Implements :class:`DownscaleScorer`, preferring the least loaded nodes.
+
+    The load of the instances is acquired from a
+    :class:`~occo.enactor.policy.MetricsProvider`, keyed by node id instead
+    of node name (i.e. ``{infra_id: {node_id: {metric: value}}}``), as
+    OCCO itself does not collect per-instance metrics. Without a provider,
+    the ``metrics`` dictionary of the instance data is used, if some
+    component stores one there. Instances not reporting the metric are
+    dropped last.
+
+    :param str metric: The name of the load metric.
+    :param metrics_provider: The
+        :class:`~occo.enactor.policy.MetricsProvider` of per-instance
+        metrics, or its configuration.
+    """
+    def __init__(self, metric='load', metrics_provider=None):
+        self.metric = metric
+        if metrics_provider is not None \
+                and not isinstance(metrics_provider, MetricsProvider):
+            metrics_provider = MetricsProvider.from_config(metrics_provider)
+        self.metrics_provider = metrics_provider
+
+    def get_load(self, instance):
+        if self.metrics_provider is None:
+            metrics = instance.get('metrics') or dict()
+        else:
+            metrics = self.metrics_provider.get_metrics(
+                instance.get('infra_id'), instance['node_id'])
+        return metrics.get(self.metric)
+
+    def score(self, instance):
+        load = self.get_load(instance)
+        return float('-inf') if load is None else -load
+
+@factory.register(DownscaleStrategy, 'scoring')
+class ScoringDownscaleStrategy(DownscaleStrategy):
+    """
+    Implements :class:`DownscaleStrategy`, dropping the nodes with the highest
+    scores.
+
+    Only the ``dropcount`` best scoring nodes are selected (using a heap), so
+    the existing nodes need not be sorted.
+
+    :param scorer: The configuration of the :class:`DownscaleScorer` to use.
+    """
+    def __init__(self, scorer='newest'):
+        self.scorer = DownscaleScorer.from_config(scorer)
+
+    def drop_nodes(self, existing, dropcount):
+        nodes = heapq.nlargest(dropcount, existing.values(),
+                               key=self.scorer.score)
+        log.debug('Selected nodes (top %d by score) for downscaling: %r',
+                  dropcount, nodes)
+        return nodes
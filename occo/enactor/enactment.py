@@ -0,0 +1,274 @@
+### Copyright 2014, MTA SZTAKI, www.sztaki.hu
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###    http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+
+"""
+Utilities for pushing the delta to the :ref:`Infrastructure Processor
+<infraprocessor>`.
+
+Elements of the delta are :class:`InstructionBatch` objects, which are plain
+iterables of instructions that also tell what kind of operations they contain,
+and what each instruction pertains to. Large batches can be split into *waves*
+by an :class:`EnactmentLimiter`, so that cloud APIs are not flooded with
+hundreds of requests at once. Failed operations are retried as allowed by a
+:class:`RetryPolicy`.
+"""
+
+__all__ = ['InstructionBatch', 'TokenBucket', 'EnactmentLimiter',
+           'RetryPolicy', 'DeadlineReached']
+
+import contextlib
+import threading
+import time
+import logging
+
+log = logging.getLogger('occo.enactor.enactment')
+
+BOOTSTRAP, DROP, CREATE = 'bootstrap', 'drop', 'create'
+
+class InstructionBatch(object):
+    """
+    An element of the delta: instructions that can be executed
+    asynchronously and independently of each other.
+
+    :param str kind: The kind of the instructions: ``bootstrap``, ``drop`` or
+        ``create``.
+    :param items: The instructions (possibly a generator), each paired with
+        its *subject*: the node description it creates, or the instance
+        data it drops.
+    :type items: ``[(subject, instruction)]``
+
+    Iterating over the batch yields the instructions only.
+    """
+    def __init__(self, kind, items):
+        self.kind = kind
+        self.items = items
+
+    def __iter__(self):
+        return (instruction for _, instruction in self.items)
+
+class DeadlineReached(Exception):
+    """
+    Raised at a wave boundary when the time budget of the pass has run out,
+    or when waiting for the limits or a retry would exceed it.
+    """
+    pass
+
+class TokenBucket(object):
+    """
+    Token bucket rate limiter.
+
+    :param float rate: Tokens added per second.
+    :param int burst: The capacity of the bucket.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = max(int(burst if burst is not None else rate), 1)
+        self.tokens = float(self.burst)
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def refill(self, now):
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, count, deadline=None):
+        """
+        Takes ``count`` tokens (at most ``burst``), waiting until they are
+        available.
+
+        :param float deadline: The time (as returned by :func:`time.time`)
+            the wait must not exceed.
+        :raises DeadlineReached: if the tokens would only be available after
+            ``deadline``; no tokens are taken then.
+        """
+        count = min(count, self.burst)
+        while True:
+            with self.lock:
+                now = time.time()
+                self.refill(now)
+                if self.tokens >= count:
+                    self.tokens -= count
+                    return
+                wait = (count - self.tokens) / self.rate
+            if deadline is not None and now + wait > deadline:
+                raise DeadlineReached()
+            time.sleep(wait)
+
+class EnactmentLimiter(object):
+    """
+    Limits the pace of node creations and drops.
+
+    Batches are split into waves performing no more operations than the
+    in-flight limit and the burst of the rate limit; each wave waits until it
+    fits into the in-flight limit and its tokens are available. Operations
+    are counted by instance, so an instruction creating multiple instances
+    counts as that many operations. A limiter may be shared among the
+    enactors of infrastructures using the same cloud backend, so that the
+    limits apply to the backend as a whole.
+
+    :param int max_inflight_creates: The maximum number of node creations in
+        progress at the same time.
+    :param int max_inflight_drops: The maximum number of node drops in
+        progress at the same time.
+    :param float create_rate: The maximum sustained rate of node creations
+        (per second).
+    :param float drop_rate: The maximum sustained rate of node drops (per
+        second).
+    :param int burst: The capacity of the token buckets; defaults to the
+        rate.
+
+    Limits that are not specified are not enforced.
+    """
+    def __init__(self, max_inflight_creates=None, max_inflight_drops=None,
+                 create_rate=None, drop_rate=None, burst=None):
+        self.max_inflight = {CREATE: max_inflight_creates,
+                             DROP: max_inflight_drops}
+        self.buckets = dict(
+            (kind, TokenBucket(rate, burst))
+            for kind, rate in ((CREATE, create_rate), (DROP, drop_rate))
+            if rate)
+        self.inflight = {CREATE: 0, DROP: 0}
+        self.condition = threading.Condition()
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Returns ``config`` if it is a limiter, otherwise creates one from
+        the configuration dictionary.
+        """
+        if isinstance(config, cls):
+            return config
+        return cls(**(config or dict()))
+
+    def wave_size(self, kind):
+        """
+        Returns the maximum size of a wave of the given kind, or ``None`` if
+        unlimited.
+        """
+        limits = [self.max_inflight.get(kind)]
+        if kind in self.buckets:
+            limits.append(self.buckets[kind].burst)
+        limits = [limit for limit in limits if limit]
+        return min(limits) if limits else None
+
+    def waves(self, kind, instruction_list, weight=None):
+        """
+        Splits a list of instructions into waves.
+
+        :param weight: Returns the number of operations an instruction
+            performs; 1 for each instruction by default. An instruction
+            performing more operations than the wave size forms a wave on
+            its own.
+        :type weight: ``(instruction) -> int``
+        """
+        size = self.wave_size(kind)
+        if not size:
+            if instruction_list:
+                yield instruction_list
+            return
+        wave, operations = [], 0
+        for instruction in instruction_list:
+            count = weight(instruction) if weight else 1
+            if wave and operations + count > size:
+                yield wave
+                wave, operations = [], 0
+            wave.append(instruction)
+            operations += count
+        if wave:
+            yield wave
+
+    @contextlib.contextmanager
+    def acquire(self, kind, count, deadline=None):
+        """
+        Waits until ``count`` operations of the given kind may be started,
+        and accounts them as in flight within the ``with`` block.
+
+        :param float deadline: The time (as returned by :func:`time.time`)
+            the wait must not exceed.
+        :raises DeadlineReached: if the operations cannot be started by
+            ``deadline``.
+        """
+        limit = self.max_inflight.get(kind)
+        if limit:
+            with self.condition:
+                while self.inflight[kind] \
+                        and self.inflight[kind] + count > limit:
+                    timeout = None if deadline is None \
+                        else deadline - time.time()
+                    if timeout is not None and timeout <= 0:
+                        raise DeadlineReached()
+                    self.condition.wait(timeout)
+                self.inflight[kind] += count
+        try:
+            if kind in self.buckets:
+                self.buckets[kind].take(count, deadline)
+            yield
+        finally:
+            if limit:
+                with self.condition:
+                    self.inflight[kind] -= count
+                    self.condition.notify_all()
+
+class RetryPolicy(object):
+    """
+    Exponential backoff of the retries of failed operations within a pass.
+
+    The delay before the ``n``-th retry (counted from zero) of a batch is
+    ``backoff * 2**n`` seconds, at most ``max_backoff``. A batch is retried
+    at most ``max_retries`` times, and the total time spent waiting for
+    retries in a pass is limited by ``budget``.
+
+    :param int max_retries: The maximum number of retries of a batch.
+    :param float backoff: The delay before the first retry, in seconds.
+    :param float max_backoff: The maximum delay before a retry.
+    :param float budget: The maximum total delay in a pass.
+    """
+    def __init__(self, max_retries=2, backoff=1.0, max_backoff=30.0,
+                 budget=30.0):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.budget = budget
+        self.spent = 0.0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Returns ``config`` if it is a retry policy, otherwise creates one from
+        the configuration dictionary.
+        """
+        if isinstance(config, cls):
+            return config
+        return cls(**(config or dict()))
+
+    def reset(self):
+        """Starts a new pass, renewing the budget."""
+        with self.lock:
+            self.spent = 0.0
+
+    def delay(self, attempt):
+        """
+        Returns the delay before the given retry, accounting it in the
+        budget; or ``None`` if no more retries are allowed.
+        """
+        if attempt >= self.max_retries:
+            return None
+        delay = min(self.backoff * 2 ** attempt, self.max_backoff)
+        with self.lock:
+            if self.spent + delay > self.budget:
+                return None
+            self.spent += delay
+        return delay
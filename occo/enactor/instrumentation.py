@@ -0,0 +1,170 @@
+### Copyright 2014, MTA SZTAKI, www.sztaki.hu
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###    http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+
+"""
+Instrumentation of enactor passes.
+
+The :class:`~occo.enactor.Enactor` reports the following to its
+:class:`MetricsSink`, labelled with the ``infra_id``:
+
+``enactor_passes_total`` (counter, ``outcome``)
+    Passes by outcome: ``full``, ``skipped`` (unchanged inputs),
+    ``interrupted`` (the time budget has run out), ``suspended``,
+    ``unleased`` (the lease is held by another enactor, see
+    :mod:`occo.enactor.lease`) or ``aborted`` (exception).
+``enactor_phase_seconds`` (summary, ``phase``)
+    Duration of the phases of a pass: ``static_description``, ``upkeep``,
+    ``scaling_snapshot``, ``scaling`` (target count calculation) and
+    ``enactment`` (including ``scaling``).
+``enactor_pass_calls`` (summary, ``service``, ``method``)
+    Calls made to the UDS and the infobroker in a pass.
+``enactor_batch_instructions`` (summary)
+    Number of instructions in each batch pushed to the infraprocessor.
+``enactor_push_seconds`` (summary)
+    Duration of each ``push_instructions`` call.
+``enactor_retries_total`` (counter, ``kind``)
+    Retries of failed ``create``, ``drop`` or ``bootstrap`` operations.
+"""
+
+__all__ = ['MetricsSink', 'CallCounter']
+
+import occo.util.factory as factory
+import collections
+import contextlib
+import threading
+import time
+import logging
+
+log = logging.getLogger('occo.enactor.instrumentation')
+
+class MetricsSink(factory.MultiBackend):
+    """
+    Abstract receiver of instrumentation data.
+    """
+
+    def __init__(self):
+        pass
+
+    def increment(self, name, value=1, **labels):
+        """Increments a counter."""
+        raise NotImplementedError()
+
+    def observe(self, name, value, **labels):
+        """Records an observation of a summary (e.g. a duration)."""
+        raise NotImplementedError()
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """Observes the duration of the ``with`` block, in seconds."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+@factory.register(MetricsSink, 'null')
+class NullMetricsSink(MetricsSink):
+    """Implements :class:`MetricsSink`, discarding everything."""
+    def increment(self, name, value=1, **labels):
+        pass
+
+    def observe(self, name, value, **labels):
+        pass
+
+@factory.register(MetricsSink, 'prometheus')
+class PrometheusMetricsSink(MetricsSink):
+    """
+    Implements :class:`MetricsSink`, keeping the metrics in memory and
+    rendering them in the Prometheus text exposition format by
+    :meth:`exposition`. Summaries are exposed by their ``_sum`` and
+    ``_count``.
+    """
+    def __init__(self):
+        self.counters = collections.defaultdict(float)
+        self.summaries = collections.defaultdict(lambda: [0.0, 0])
+        self.lock = threading.Lock()
+
+    def increment(self, name, value=1, **labels):
+        with self.lock:
+            self.counters[name, tuple(sorted(labels.items()))] += value
+
+    def observe(self, name, value, **labels):
+        with self.lock:
+            summary = self.summaries[name, tuple(sorted(labels.items()))]
+            summary[0] += value
+            summary[1] += 1
+
+    @staticmethod
+    def format_labels(labels):
+        if not labels:
+            return ''
+        return '{{{0}}}'.format(','.join(
+            '{0}="{1}"'.format(key, str(value).replace('\\', '\\\\')
+                                              .replace('"', '\\"')
+                                              .replace('\n', '\\n'))
+            for key, value in labels))
+
+    def exposition(self):
+        """Returns the metrics in the Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            summaries = sorted((key, list(value))
+                               for key, value in self.summaries.items())
+        for kind, items in (('counter', counters), ('summary', summaries)):
+            declared = set()
+            for (name, labels), value in items:
+                if name not in declared:
+                    lines.append('# TYPE {0} {1}'.format(name, kind))
+                    declared.add(name)
+                if kind == 'counter':
+                    lines.append('{0}{1} {2!r}'.format(
+                        name, self.format_labels(labels), value))
+                else:
+                    lines.append('{0}_sum{1} {2!r}'.format(
+                        name, self.format_labels(labels), float(value[0])))
+                    lines.append('{0}_count{1} {2}'.format(
+                        name, self.format_labels(labels), value[1]))
+        return '\n'.join(lines) + '\n'
+
+class CallCounter(object):
+    """
+    Proxy counting the method calls made to an object.
+
+    :param target: The object to be proxied.
+    :param counts: The counter to increment, by ``(service, method)``.
+    :type counts: :class:`collections.Counter`
+    :param str service: The name of the proxied service.
+    :param nested: Attributes of the object whose method calls are counted
+        too, as ``attribute.method`` (e.g. the ``kvstore`` of the UDS).
+    """
+    def __init__(self, target, counts, service, nested=(), prefix=''):
+        self._target = target
+        self._counts = counts
+        self._service = service
+        self._nested = nested
+        self._prefix = prefix
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if name in self._nested:
+            return CallCounter(attr, self._counts, self._service,
+                               prefix='{0}{1}.'.format(self._prefix, name))
+        if not callable(attr):
+            return attr
+        method = self._prefix + name
+        def counted(*args, **kwargs):
+            self._counts[self._service, method] += 1
+            return attr(*args, **kwargs)
+        return counted
@@ -0,0 +1,282 @@
+### Copyright 2014, MTA SZTAKI, www.sztaki.hu
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###    http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+
+"""
+Sharding infrastructures among enactor processes.
+
+Multiple enactor processes (possibly on different hosts) may maintain the
+same set of infrastructures. To prevent two of them from enacting the same
+infrastructure at once, an enactor must hold the *lease* of the
+infrastructure to make a pass. Leases expire unless renewed, so the
+infrastructures of a crashed enactor are taken over by the others.
+
+Enactors announce themselves as *members* (also renewed with each pass), and
+each infrastructure is assigned to one of the live members by rendezvous
+hashing. When a member joins or leaves, only the infrastructures assigned
+differently move: the previous holder releases the lease in its next pass,
+and the new one acquires it in its pass following that (or when the lease
+expires).
+
+The leases are stored by a :class:`LeaseManager`; an :class:`EnactorLease`
+is shared by the enactors of a process::
+
+    lease = EnactorLease(LeaseManager.from_config(
+                             dict(protocol='redis', host='redis-host')),
+                         owner='enactor-1', ttl=60)
+    pool = EnactorPool(lambda infra_id: Enactor(infra_id, ip, lease=lease))
+"""
+
+__all__ = ['LeaseManager', 'EnactorLease', 'assigned_member']
+
+import occo.util.factory as factory
+import hashlib
+import socket
+import os
+import threading
+import time
+import logging
+
+log = logging.getLogger('occo.enactor.lease')
+
+def assigned_member(infra_id, members):
+    """
+    Returns the member an infrastructure is assigned to, by rendezvous
+    hashing; or ``None`` if there are no members.
+    """
+    def weight(member):
+        key = '{0}\0{1}'.format(member, infra_id).encode('utf-8')
+        return hashlib.sha1(key).hexdigest()
+    return max(members, key=weight) if members else None
+
+class LeaseManager(factory.MultiBackend):
+    """
+    Abstract store of the leases of infrastructures and the membership of
+    enactors. Durations are in seconds.
+    """
+
+    def __init__(self):
+        pass
+
+    def acquire(self, infra_id, owner, ttl):
+        """
+        Acquires the lease of an infrastructure for ``ttl``, or renews it if
+        it is already held by ``owner``.
+
+        :returns: Whether ``owner`` holds the lease.
+        """
+        raise NotImplementedError()
+
+    def release(self, infra_id, owner):
+        """Releases the lease of an infrastructure if held by ``owner``."""
+        raise NotImplementedError()
+
+    def holder(self, infra_id):
+        """Returns the holder of the lease, or ``None``."""
+        raise NotImplementedError()
+
+    def join(self, member, ttl):
+        """Announces (or renews) a member for ``ttl``."""
+        raise NotImplementedError()
+
+    def leave(self, member):
+        """Removes a member."""
+        raise NotImplementedError()
+
+    def members(self):
+        """Returns the sorted list of the live members."""
+        raise NotImplementedError()
+
+@factory.register(LeaseManager, 'dict')
+class DictLeaseManager(LeaseManager):
+    """
+    Implements :class:`LeaseManager` in memory; a stand-in for a single
+    process. Must be shared as an instance by the enactors.
+    """
+    def __init__(self):
+        self.leases = dict()
+        self.member_expiry = dict()
+        self.lock = threading.Lock()
+
+    def acquire(self, infra_id, owner, ttl):
+        now = time.time()
+        with self.lock:
+            holder, expiry = self.leases.get(infra_id, (None, 0))
+            if holder not in (None, owner) and expiry > now:
+                return False
+            self.leases[infra_id] = (owner, now + ttl)
+            return True
+
+    def release(self, infra_id, owner):
+        with self.lock:
+            if self.leases.get(infra_id, (None, 0))[0] == owner:
+                del self.leases[infra_id]
+
+    def holder(self, infra_id):
+        with self.lock:
+            holder, expiry = self.leases.get(infra_id, (None, 0))
+            return holder if expiry > time.time() else None
+
+    def join(self, member, ttl):
+        with self.lock:
+            self.member_expiry[member] = time.time() + ttl
+
+    def leave(self, member):
+        with self.lock:
+            self.member_expiry.pop(member, None)
+
+    def members(self):
+        now = time.time()
+        with self.lock:
+            return sorted(member
+                          for member, expiry in self.member_expiry.items()
+                          if expiry > now)
+
+@factory.register(LeaseManager, 'redis')
+class RedisLeaseManager(LeaseManager):
+    """
+    Implements :class:`LeaseManager` in Redis.
+
+    The lease of an infrastructure is stored under ``enactor:lease:<infra_id>``
+    with ``SET NX PX``; it is renewed and released atomically, only by its
+    holder. Members are stored in the sorted set ``enactor:members``, scored
+    by their expiry time. Leases are renewed in every pass, so they are kept
+    out of the ``infra:`` keys, whose changes trigger passes (see
+    :class:`~occo.enactor.trigger.RedisEventSource`).
+
+    Parameters are passed to :class:`redis.StrictRedis`.
+    """
+    MEMBERS = 'enactor:members'
+
+    RENEW = """
+        if redis.call('get', KEYS[1]) == ARGV[1] then
+            return redis.call('pexpire', KEYS[1], ARGV[2])
+        end
+        return 0
+    """
+    RELEASE = """
+        if redis.call('get', KEYS[1]) == ARGV[1] then
+            return redis.call('del', KEYS[1])
+        end
+        return 0
+    """
+
+    def __init__(self, host='localhost', port=6379, db=0, **kwargs):
+        import redis
+        self.backend = redis.StrictRedis(host=host, port=port, db=db,
+                                         decode_responses=True, **kwargs)
+        self.renew = self.backend.register_script(self.RENEW)
+        self.release_script = self.backend.register_script(self.RELEASE)
+
+    @staticmethod
+    def key(infra_id):
+        return 'enactor:lease:{0}'.format(infra_id)
+
+    def acquire(self, infra_id, owner, ttl):
+        key, ttl_ms = self.key(infra_id), int(ttl * 1000)
+        if self.backend.set(key, owner, nx=True, px=ttl_ms):
+            return True
+        return bool(self.renew(keys=[key], args=[owner, ttl_ms]))
+
+    def release(self, infra_id, owner):
+        self.release_script(keys=[self.key(infra_id)], args=[owner])
+
+    def holder(self, infra_id):
+        return self.backend.get(self.key(infra_id))
+
+    def join(self, member, ttl):
+        self.backend.zadd(self.MEMBERS, {member: time.time() + ttl})
+
+    def leave(self, member):
+        self.backend.zrem(self.MEMBERS, member)
+
+    def members(self):
+        pipe = self.backend.pipeline(transaction=True)
+        pipe.zremrangebyscore(self.MEMBERS, '-inf', time.time())
+        pipe.zrange(self.MEMBERS, 0, -1)
+        return sorted(pipe.execute()[1])
+
+class EnactorLease(object):
+    """
+    The leases of an enactor process.
+
+    :param manager: The :class:`LeaseManager`, or its configuration.
+    :param str owner: The identifier of the enactor process; defaults to
+        ``<hostname>:<pid>``.
+    :param float ttl: The duration of the leases and the membership, in
+        seconds. Must be longer than the passes, and than the interval
+        between them; otherwise leases expire and infrastructures move among
+        the enactors.
+    """
+    def __init__(self, manager='dict', owner=None, ttl=60):
+        if not isinstance(manager, LeaseManager):
+            manager = LeaseManager.from_config(manager)
+        self.manager = manager
+        self.owner = owner or '{0}:{1}'.format(socket.gethostname(),
+                                               os.getpid())
+        self.ttl = ttl
+        self.held = set()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Returns ``config`` if it is an :class:`EnactorLease`, otherwise creates
+        one from the configuration dictionary.
+        """
+        if isinstance(config, cls):
+            return config
+        return cls(**(config or dict()))
+
+    def hold(self, infra_id):
+        """
+        Renews the membership of the enactor, and acquires or renews the
+        lease of the infrastructure if it is assigned to this enactor;
+        otherwise, releases the lease.
+
+        :returns: Whether the enactor holds a valid lease of the
+            infrastructure.
+        """
+        self.manager.join(self.owner, self.ttl)
+        assigned = assigned_member(infra_id, self.manager.members())
+        if assigned != self.owner:
+            self.release(infra_id)
+            return False
+        held = self.manager.acquire(infra_id, self.owner, self.ttl)
+        with self.lock:
+            if held:
+                self.held.add(infra_id)
+            else:
+                self.held.discard(infra_id)
+        return held
+
+    def release(self, infra_id):
+        """Releases the lease of an infrastructure."""
+        with self.lock:
+            if infra_id not in self.held:
+                return
+            self.held.discard(infra_id)
+        log.info('Releasing lease of infrastructure %r', infra_id)
+        self.manager.release(infra_id, self.owner)
+
+    def leave(self):
+        """
+        Releases all leases and leaves the membership, so the infrastructures
+        are taken over by the other enactors without waiting for the leases
+        to expire.
+        """
+        with self.lock:
+            held = list(self.held)
+        for infra_id in held:
+            self.release(infra_id)
+        self.manager.leave(self.owner)
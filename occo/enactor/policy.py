@@ -0,0 +1,435 @@
+### Copyright 2014, MTA SZTAKI, www.sztaki.hu
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###    http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+
+"""
+Scaling policies calculating the target instance count of node types.
+
+The :class:`~occo.enactor.Enactor` asks its :class:`ScalingPolicy` for the
+target count of each node type in every pass. The default ``requests`` policy
+uses the stored target count, adjusted by explicit create/destroy requests.
+Metric-based policies compute the target count from per-node-type metrics
+(e.g. CPU utilization or queue length) acquired through a
+:class:`MetricsProvider`. Explicit scaling requests take precedence over
+metric-based decisions in the pass they arrive in.
+"""
+
+import occo.util.factory as factory
+from . import scaling as scaling
+import collections
+import math
+import os
+import threading
+import time
+import yaml
+import logging
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+log = logging.getLogger('occo.enactor.policy')
+
+class MetricsProvider(factory.MultiBackend):
+    """
+    Abstract provider of per-node-type metrics.
+    """
+
+    def __init__(self):
+        pass
+
+    def get_metrics(self, infra_id, nodename):
+        """
+        Returns the current metrics of a node type.
+
+        :rtype: ``{str: float}``
+        """
+        raise NotImplementedError()
+
+@factory.register(MetricsProvider, 'memory')
+class InMemoryMetricsProvider(MetricsProvider):
+    """
+    Implements :class:`MetricsProvider`, storing metrics in memory. Metrics
+    are fed by :meth:`set_metric`.
+    """
+    def __init__(self, metrics=None):
+        self.metrics = metrics or dict()
+        self.lock = threading.Lock()
+
+    def set_metric(self, infra_id, nodename, metric, value):
+        with self.lock:
+            self.metrics.setdefault(infra_id, dict()) \
+                .setdefault(nodename, dict())[metric] = value
+
+    def get_metrics(self, infra_id, nodename):
+        with self.lock:
+            return dict(self.metrics.get(infra_id, dict()).get(nodename, dict()))
+
+@factory.register(MetricsProvider, 'file')
+class FileMetricsProvider(MetricsProvider):
+    """
+    Implements :class:`MetricsProvider`, reading metrics from a YAML (or JSON)
+    file of the form ``{infra_id: {nodename: {metric: value}}}``. The file is
+    re-read when it is modified.
+
+    :param str path: The path of the metrics file.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self.metrics = dict()
+
+    def reload(self):
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            log.warning('Metrics file %r is not available', self.path)
+            return
+        if mtime != self.mtime:
+            with open(self.path) as f:
+                self.metrics = yaml.safe_load(f) or dict()
+            self.mtime = mtime
+
+    def get_metrics(self, infra_id, nodename):
+        self.reload()
+        return dict(self.metrics.get(infra_id, dict()).get(nodename, dict()))
+
+class ScalingPolicy(factory.MultiBackend):
+    """
+    Abstract strategy calculating the target instance count of a node type.
+    """
+
+    def __init__(self):
+        pass
+
+    def target_count(self, node, existing, scaling_snapshot,
+                     address_index=None):
+        """
+        Calculates the target instance count of a node type.
+
+        :param node: The node type.
+        :param existing: The existing instances of the node type.
+        :param scaling_snapshot: The scaling requests loaded for this pass.
+        :type scaling_snapshot: :class:`occo.enactor.scaling.ScalingSnapshot`
+        :param address_index: The address index of the infrastructure.
+        :type address_index: :class:`occo.enactor.upkeep.AddressIndex`
+        """
+        raise NotImplementedError()
+
+    def fingerprint(self, infra_id, nodenames):
+        """
+        Returns a hashable digest of the inputs of the policy other than the
+        dynamic state and the scaling requests; see
+        :meth:`occo.enactor.Enactor.pass_fingerprint`.
+        """
+        return None
+
+@factory.register(ScalingPolicy, 'requests')
+class RequestScalingPolicy(ScalingPolicy):
+    """
+    Implements :class:`ScalingPolicy`, using the stored target count adjusted
+    by explicit createnode and destroynode requests.
+    """
+    def target_count(self, node, existing, scaling_snapshot,
+                     address_index=None):
+        targetcount = scaling.get_act_target_count(node, scaling_snapshot)
+        newtc = scaling.process_create_node_requests(
+            node, targetcount, scaling_snapshot)
+        if newtc != targetcount: return newtc
+        newtc = scaling.process_drop_node_requests_with_ids(
+            node, targetcount, existing, scaling_snapshot, address_index)
+        if newtc != targetcount: return newtc
+        newtc = scaling.process_drop_node_requests_with_no_ids(
+            node, targetcount, scaling_snapshot)
+        if newtc != targetcount: return newtc
+        return targetcount
+
+class MetricScalingPolicy(RequestScalingPolicy):
+    """
+    Abstract :class:`ScalingPolicy` calculating the target count from a
+    metric of the node type.
+
+    If explicit scaling requests have been processed, or the metric is not
+    available, the target count of :class:`RequestScalingPolicy` is used.
+    Otherwise, the target count calculated by :meth:`metric_target` is
+    clamped by the scaling limits of the node type, and stored.
+
+    :param str metric: The name of the metric.
+    :param metrics_provider: The configuration of the
+        :class:`MetricsProvider`.
+    """
+    def __init__(self, metric, metrics_provider='memory'):
+        self.metric = metric
+        self.metrics = MetricsProvider.from_config(metrics_provider)
+
+    def metric_target(self, node, current, value):
+        """
+        Calculates the target count from the current instance count and
+        the current value of the metric.
+        """
+        raise NotImplementedError()
+
+    def target_count(self, node, existing, scaling_snapshot,
+                     address_index=None):
+        storedtc = scaling.get_act_target_count(node, scaling_snapshot)
+        targetcount = super(MetricScalingPolicy, self).target_count(
+            node, existing, scaling_snapshot, address_index)
+        if targetcount != storedtc:
+            return targetcount
+        value = self.metrics.get_metrics(
+            node['infra_id'], node['name']).get(self.metric)
+        if value is None:
+            return targetcount
+        newtc = scaling.keep_limits_for_scaling(
+            self.metric_target(node, len(existing), value), node)
+        if newtc != targetcount:
+            log.info('Scaling: %s of node %r is %r; target count: %d -> %d',
+                     self.metric, node['name'], value, targetcount, newtc)
+            scaling_snapshot.set_target_count(node['name'], newtc)
+        return newtc
+
+    def fingerprint(self, infra_id, nodenames):
+        return tuple(
+            (nodename,
+             self.metrics.get_metrics(infra_id, nodename).get(self.metric))
+            for nodename in sorted(nodenames))
+
+@factory.register(ScalingPolicy, 'target_tracking')
+class TargetTrackingScalingPolicy(MetricScalingPolicy):
+    """
+    Implements :class:`ScalingPolicy`, keeping a per-instance metric (e.g.
+    average CPU utilization) around a target value: the target count is
+    ``ceil(current * value / target_value)``.
+
+    :param float target_value: The desired value of the metric.
+    """
+    def __init__(self, metric, target_value, metrics_provider='memory'):
+        super(TargetTrackingScalingPolicy, self).__init__(
+            metric, metrics_provider)
+        self.target_value = float(target_value)
+
+    def metric_target(self, node, current, value):
+        if current == 0:
+            return scaling.get_scaling_limits(node)[0]
+        return int(math.ceil(current * value / self.target_value))
+
+@factory.register(ScalingPolicy, 'step')
+class StepScalingPolicy(MetricScalingPolicy):
+    """
+    Implements :class:`ScalingPolicy`, adjusting the current instance count
+    by the step whose bounds contain the value of the metric.
+
+    :param list steps: Items of the form ``dict(lower=L, upper=U,
+        adjustment=N)``; the step applies if ``L <= value < U``. Missing
+        bounds are unlimited. The first matching step is used.
+    """
+    def __init__(self, metric, steps, metrics_provider='memory'):
+        super(StepScalingPolicy, self).__init__(metric, metrics_provider)
+        self.steps = steps
+
+    def metric_target(self, node, current, value):
+        for step in self.steps:
+            lower, upper = step.get('lower'), step.get('upper')
+            if (lower is None or lower <= value) \
+                    and (upper is None or value < upper):
+                return current + step['adjustment']
+        return current
+
+@factory.register(ScalingPolicy, 'predictive')
+class PredictiveScalingPolicy(MetricScalingPolicy):
+    """
+    Implements :class:`ScalingPolicy`, scaling for the demand forecast a
+    boot-time horizon ahead.
+
+    The policy keeps a rolling window of the samples of a demand metric
+    (e.g. queue length or request rate) for each node type, and fits a
+    linear trend over the window. The target count is enough instances to
+    serve both the current and the forecast demand, so capacity is started
+    before a spike arrives, and is not released before the demand actually
+    decreases. Requires NumPy.
+
+    :param float capacity: The demand a single instance can serve.
+    :param float horizon: How far ahead (in seconds) to forecast; typically
+        the time it takes for a new instance to become ready.
+    :param int window: The maximum number of samples kept per node type.
+    :param float sample_interval: The minimum time (in seconds) between two
+        samples of a node type.
+    """
+    def __init__(self, metric, capacity, horizon=300, window=60,
+                 sample_interval=1.0, metrics_provider='memory'):
+        if np is None:
+            raise ImportError(
+                'The predictive scaling policy requires NumPy')
+        super(PredictiveScalingPolicy, self).__init__(
+            metric, metrics_provider)
+        self.capacity = float(capacity)
+        self.horizon = float(horizon)
+        self.window = window
+        self.sample_interval = sample_interval
+        self.history = dict()
+
+    def add_sample(self, key, value, now=None):
+        now = time.time() if now is None else now
+        samples = self.history.setdefault(
+            key, collections.deque(maxlen=self.window))
+        if not samples or now - samples[-1][0] >= self.sample_interval:
+            samples.append((now, float(value)))
+        return samples
+
+    def forecast(self, samples):
+        """
+        Forecasts the demand ``horizon`` seconds after the last sample, by
+        fitting a linear trend over the samples.
+        """
+        data = np.array(samples, dtype=float)
+        if len(data) < 2 or np.ptp(data[:, 0]) == 0:
+            return data[-1, 1]
+        t = data[:, 0] - data[-1, 0]
+        slope, intercept = np.polyfit(t, data[:, 1], 1)
+        return max(intercept + slope * self.horizon, 0.0)
+
+    def metric_target(self, node, current, value, now=None):
+        samples = self.add_sample((node['infra_id'], node['name']), value,
+                                  now)
+        predicted = self.forecast(samples)
+        demand = max(float(value), predicted)
+        log.debug('Scaling: forecast %s of node %r in %ds: %r',
+                  self.metric, node['name'], self.horizon, predicted)
+        return int(math.ceil(demand / self.capacity))
+
+    def fingerprint(self, infra_id, nodenames):
+        # The forecast changes with time even if the metric does not, so
+        # the inputs of the policy are never considered unchanged.
+        return object()
+
+class ScalingStabilizer(object):
+    """
+    Damps the target counts calculated by the scaling policy, so that
+    instances are not created in one pass and dropped in the next one.
+
+    :param float min_instance_age: The minimum age (in seconds, by
+        ``instance_start_time``) of an instance before it may be dropped by
+        downscaling.
+    :param float cooldown: The minimum time (in seconds) between opposite
+        scaling actions of a node type.
+    :param float downscale_window: Downscaling uses the maximum of the
+        targets calculated in this time window (in seconds), so it only
+        happens if the demand has been low during the whole window.
+    :param float upscale_window: Upscaling uses the minimum of the targets
+        calculated in this time window.
+
+    Targets are held back within the scaling limits of the node type. Node
+    types with pending drop requests targeting specific instances are not
+    held back. The default parameters disable stabilization.
+    """
+    def __init__(self, min_instance_age=0, cooldown=0,
+                 downscale_window=0, upscale_window=0):
+        self.min_instance_age = min_instance_age
+        self.cooldown = cooldown
+        self.downscale_window = downscale_window
+        self.upscale_window = upscale_window
+        self.history = dict()
+        self.last_action = dict()
+        self.held = set()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Returns ``config`` if it is a stabilizer, otherwise creates one from
+        the configuration dictionary.
+        """
+        if isinstance(config, cls):
+            return config
+        return cls(**(config or dict()))
+
+    def begin_pass(self):
+        """Starts a new pass."""
+        with self.lock:
+            self.held.clear()
+
+    def old_enough(self, instance, now):
+        start = instance.get('instance_start_time')
+        return start is None or now - float(start) >= self.min_instance_age
+
+    def downscale_candidates(self, existing, now=None):
+        """
+        Returns the instances old enough to be dropped by downscaling.
+        """
+        if not self.min_instance_age:
+            return existing
+        now = time.time() if now is None else now
+        return dict((node_id, instance)
+                    for node_id, instance in existing.items()
+                    if self.old_enough(instance, now))
+
+    def record_target(self, key, target, now):
+        window = max(self.downscale_window, self.upscale_window)
+        samples = self.history.setdefault(key, collections.deque())
+        samples.append((now, target))
+        while samples and now - samples[0][0] > window:
+            samples.popleft()
+        return samples
+
+    def stabilize(self, node, existing, target, scaling_snapshot=None,
+                  now=None):
+        """
+        Stabilizes the target count of a node type.
+
+        :param existing: The existing instances of the node type.
+        :param int target: The target count calculated by the scaling policy.
+        :param scaling_snapshot: The scaling requests of the pass.
+        :returns: The stabilized target count.
+        """
+        now = time.time() if now is None else now
+        key = node.get('infra_id'), node['name']
+        current = len(existing)
+        stabilized = target
+        targeted = scaling_snapshot is not None and any(
+            scaling_snapshot.get_destroynode(node['name']).values())
+        with self.lock:
+            samples = self.record_target(key, target, now)
+            if targeted:
+                # Explicitly selected instances are dropped as requested
+                pass
+            elif target < current and self.downscale_window:
+                stabilized = max(t for ts, t in samples
+                                 if now - ts <= self.downscale_window)
+                stabilized = min(stabilized, current)
+            elif target > current and self.upscale_window:
+                stabilized = min(t for ts, t in samples
+                                 if now - ts <= self.upscale_window)
+                stabilized = max(stabilized, current)
+
+            if stabilized < current and self.min_instance_age \
+                    and not targeted:
+                droppable = len(self.downscale_candidates(existing, now))
+                stabilized = max(stabilized, current - droppable)
+
+            direction = (stabilized > current) - (stabilized < current)
+            last = self.last_action.get(key)
+            if direction and last and last[0] == -direction \
+                    and now - last[1] < self.cooldown and not targeted:
+                stabilized = current
+
+            stabilized = scaling.keep_limits_for_scaling(stabilized, node) \
+                if stabilized != target else target
+            direction = (stabilized > current) - (stabilized < current)
+            if direction:
+                self.last_action[key] = (direction, now)
+            if stabilized != target:
+                self.held.add(key)
+                log.info('Scaling: target count of node %r held at %d '
+                         'instead of %d', node['name'], stabilized, target)
+        return stabilized
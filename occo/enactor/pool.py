@@ -0,0 +1,216 @@
+### Copyright 2014, MTA SZTAKI, www.sztaki.hu
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###    http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+
+"""
+Scheduler maintaining multiple infrastructures in a single process.
+
+An :class:`~occo.enactor.Enactor` maintains exactly one infrastructure. The
+:class:`EnactorPool` keeps one enactor per infrastructure and runs their
+passes on a bounded thread pool:
+
+  - at most one pass is running for an infrastructure at any time;
+  - infrastructures are served in round-robin order, so a busy pool does not
+    starve the ones at the end of the list;
+  - each infrastructure is maintained at most once per *pass interval*,
+    measured from the end of its previous pass, unless a pass is requested
+    explicitly with :meth:`EnactorPool.trigger` (see
+    :mod:`occo.enactor.trigger`);
+  - a pass interrupted by the time budget is continued as soon as possible,
+    after the other infrastructures due.
+"""
+
+__all__ = ['EnactorPool']
+
+from concurrent.futures import ThreadPoolExecutor
+import collections
+import threading
+import time
+import logging
+
+log = logging.getLogger('occo.enactor.pool')
+
+class EnactorPool(object):
+    """
+    Runs enactor passes of many infrastructures on a bounded thread pool.
+
+    :param enactor_factory: Creates the enactor of an infrastructure.
+    :type enactor_factory: ``(infra_id) -> Enactor``
+
+    :param int max_workers: The maximum number of concurrent passes.
+
+    :param float pass_interval: The default time (in seconds) to wait between
+        two passes of the same infrastructure.
+
+    :param float time_budget: The time (in seconds) a pass may take, so a
+        huge infrastructure does not hold a worker for long; see
+        :meth:`occo.enactor.Enactor.make_a_pass`.
+    """
+    def __init__(self, enactor_factory, max_workers=4, pass_interval=10,
+                 time_budget=None):
+        self.enactor_factory = enactor_factory
+        self.time_budget = time_budget
+        self.max_workers = max_workers
+        self.pass_interval = pass_interval
+        self.enactors = dict()
+        self.intervals = dict()
+        self.next_due = dict()
+        self.running = set()
+        self.triggered = set()
+        self.order = collections.deque()
+        self.lock = threading.RLock()
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def add_infrastructure(self, infra_id, pass_interval=None):
+        """
+        Starts maintaining an infrastructure.
+
+        :param float pass_interval: Overrides the default pass interval for
+            this infrastructure.
+        """
+        with self.lock:
+            if infra_id in self.enactors:
+                return
+            log.debug('Adding infrastructure %r to the enactor pool', infra_id)
+            self.enactors[infra_id] = self.enactor_factory(infra_id)
+            self.intervals[infra_id] = pass_interval
+            self.next_due[infra_id] = time.time()
+            self.order.append(infra_id)
+        self.wakeup.set()
+
+    def remove_infrastructure(self, infra_id):
+        """
+        Stops maintaining an infrastructure. A pass already running is not
+        interrupted.
+        """
+        with self.lock:
+            if infra_id not in self.enactors:
+                return
+            log.debug('Removing infrastructure %r from the enactor pool',
+                      infra_id)
+            del self.enactors[infra_id]
+            del self.intervals[infra_id]
+            del self.next_due[infra_id]
+            self.triggered.discard(infra_id)
+            self.order.remove(infra_id)
+
+    def trigger(self, infra_id):
+        """
+        Requests a pass of an infrastructure as soon as possible, regardless
+        of its pass interval. If a pass is running, another one follows it.
+        """
+        with self.lock:
+            if infra_id not in self.enactors:
+                return
+            if infra_id in self.running:
+                self.triggered.add(infra_id)
+            else:
+                self.next_due[infra_id] = time.time()
+        self.wakeup.set()
+
+    def interval_of(self, infra_id):
+        interval = self.intervals.get(infra_id)
+        return self.pass_interval if interval is None else interval
+
+    def schedule(self, now=None):
+        """
+        Submits a pass for each idle infrastructure that is due, as long as
+        there are free workers.
+
+        Infrastructures are visited in round-robin order: the next call starts
+        with the infrastructure following the last one submitted.
+
+        :returns: The list of infrastructure identifiers submitted.
+        """
+        now = time.time() if now is None else now
+        submitted = []
+        with self.lock:
+            for _ in range(len(self.order)):
+                if len(self.running) >= self.max_workers:
+                    break
+                infra_id = self.order[0]
+                self.order.rotate(-1)
+                if infra_id in self.running or self.next_due[infra_id] > now:
+                    continue
+                self.running.add(infra_id)
+                submitted.append(infra_id)
+                self.executor.submit(self._make_a_pass,
+                                     infra_id, self.enactors[infra_id])
+        return submitted
+
+    def _make_a_pass(self, infra_id, enactor):
+        outcome = None
+        try:
+            if self.time_budget is None:
+                outcome = enactor.make_a_pass()
+            else:
+                outcome = enactor.make_a_pass(time_budget=self.time_budget)
+        except Exception:
+            log.exception('Enactor pass of infrastructure %r failed:', infra_id)
+        finally:
+            with self.lock:
+                self.running.discard(infra_id)
+                if infra_id in self.next_due:
+                    if outcome == 'interrupted':
+                        # Continued right away, at the back of the round-robin
+                        self.order.remove(infra_id)
+                        self.order.append(infra_id)
+                    if outcome == 'interrupted' or infra_id in self.triggered:
+                        self.triggered.discard(infra_id)
+                        self.next_due[infra_id] = time.time()
+                    else:
+                        self.next_due[infra_id] = \
+                            time.time() + self.interval_of(infra_id)
+            self.wakeup.set()
+
+    def time_to_next_pass(self, now=None):
+        """
+        Returns the time until the earliest idle infrastructure becomes due,
+        or ``None`` if there is nothing to wait for.
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            if len(self.running) >= self.max_workers:
+                # A finishing pass will wake the scheduler up
+                return None
+            due = [self.next_due[i] for i in self.order if i not in self.running]
+        return max(min(due) - now, 0) if due else None
+
+    def run(self):
+        """
+        Schedules passes until :meth:`stop` is called.
+        """
+        log.info('Starting enactor pool with %d workers', self.max_workers)
+        while not self.stopped.is_set():
+            self.wakeup.clear()
+            self.schedule()
+            self.wakeup.wait(self.time_to_next_pass())
+        log.info('Enactor pool stopped')
+
+    def stop(self, wait=True):
+        """
+        Stops scheduling new passes, and optionally waits for the running
+        ones to finish. After the passes have finished, the leases of the
+        enactors (see :mod:`occo.enactor.lease`) are released.
+        """
+        self.stopped.set()
+        self.wakeup.set()
+        self.executor.shutdown(wait=wait)
+        if wait:
+            with self.lock:
+                leases = set(getattr(enactor, 'lease', None)
+                             for enactor in self.enactors.values())
+            for lease in leases - set([None]):
+                lease.leave()
@@ -0,0 +1,278 @@
+### Copyright 2014, MTA SZTAKI, www.sztaki.hu
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###    http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+
+"""
+Compact, atomic queues of scaling requests.
+
+By default, each createnode and destroynode request is stored in the UDS as
+an entry of its own, and deleted one by one when processed. A
+:class:`ScalingRequestQueue` stores the requests of a node type as a counter
+of creations, a counter of anonymous drops and a set of targeted drops (node
+ids or addresses). The :class:`~occo.enactor.scaling.ScalingSnapshot` drains
+them atomically at the start of the pass, and acknowledges them at its end,
+putting back the requests not consumed by the pass.
+
+Drained requests are kept as being processed until they are acknowledged,
+and are delivered again by the next drain if they have not been; so the
+requests of a pass interrupted by the death of the process are not lost.
+Requests consumed by such a pass may be applied again, though.
+"""
+
+__all__ = ['ScalingRequests', 'ScalingRequestQueue', 'merge']
+
+import occo.util.factory as factory
+import collections
+import threading
+import logging
+
+log = logging.getLogger('occo.enactor.requestqueue')
+
+ScalingRequests = collections.namedtuple(
+    'ScalingRequests', ['creates', 'drops', 'targeted'])
+ScalingRequests.__doc__ = """
+Pending scaling requests of a node type: the number of creations, the number
+of anonymous drops, and the set of node ids (or addresses) to be dropped.
+"""
+
+NO_REQUESTS = ScalingRequests(0, 0, frozenset())
+
+class ScalingRequestQueue(factory.MultiBackend):
+    """
+    Abstract store of the scaling requests of node types.
+    """
+
+    def __init__(self):
+        pass
+
+    def add_create(self, infra_id, nodename, count=1):
+        """Requests the creation of ``count`` instances."""
+        raise NotImplementedError()
+
+    def add_drop(self, infra_id, nodename, nodeid=''):
+        """
+        Requests the drop of an instance: the one identified by ``nodeid``
+        (node id or address), or any instance if it is empty.
+        """
+        raise NotImplementedError()
+
+    def drain(self, infra_id, nodenames):
+        """
+        Atomically moves the requests of each node type to the requests
+        being processed, and returns the requests being processed; i.e.
+        including the ones drained earlier but not acknowledged.
+
+        :rtype: ``{str: ScalingRequests}``
+        """
+        raise NotImplementedError()
+
+    def pending(self, infra_id, nodename):
+        """
+        Returns the requests of a node type, including the ones being
+        processed, without draining them.
+
+        :rtype: :class:`ScalingRequests`
+        """
+        raise NotImplementedError()
+
+    def add_requests(self, infra_id, nodename, requests):
+        """
+        Adds requests of a node type.
+
+        :type requests: :class:`ScalingRequests`
+        """
+        if requests.creates:
+            self.add_create(infra_id, nodename, requests.creates)
+        for i in range(requests.drops):
+            self.add_drop(infra_id, nodename)
+        for nodeid in requests.targeted:
+            self.add_drop(infra_id, nodename, nodeid)
+
+    def acknowledge(self, infra_id, unconsumed):
+        """
+        Completes the processing of the drained requests: atomically clears
+        the requests being processed, and puts back the ones that have not
+        been consumed.
+
+        :param unconsumed: The requests not consumed, by the name of each
+            node type drained.
+        :type unconsumed: ``{str: ScalingRequests}``
+        """
+        raise NotImplementedError()
+
+def merge(*requests):
+    """Returns the sum of :class:`ScalingRequests`."""
+    return ScalingRequests(sum(r.creates for r in requests),
+                           sum(r.drops for r in requests),
+                           frozenset().union(*(r.targeted for r in requests)))
+
+@factory.register(ScalingRequestQueue, 'dict')
+class DictScalingRequestQueue(ScalingRequestQueue):
+    """
+    Implements :class:`ScalingRequestQueue` in memory. Must be shared as an
+    instance by the components making requests and the enactor.
+    """
+    def __init__(self):
+        self.requests = dict()
+        self.processing = dict()
+        self.lock = threading.Lock()
+
+    def _entry(self, infra_id, nodename):
+        return self.requests.setdefault((infra_id, nodename), [0, 0, set()])
+
+    def add_create(self, infra_id, nodename, count=1):
+        with self.lock:
+            self._entry(infra_id, nodename)[0] += count
+
+    def add_drop(self, infra_id, nodename, nodeid=''):
+        with self.lock:
+            entry = self._entry(infra_id, nodename)
+            if nodeid:
+                entry[2].add(nodeid)
+            else:
+                entry[1] += 1
+
+    def _get(self, infra_id, nodename):
+        creates, drops, targeted = self.requests.get(
+            (infra_id, nodename), NO_REQUESTS)
+        return merge(ScalingRequests(creates, drops, frozenset(targeted)),
+                     self.processing.get((infra_id, nodename), NO_REQUESTS))
+
+    def drain(self, infra_id, nodenames):
+        with self.lock:
+            drained = dict()
+            for nodename in nodenames:
+                requests = self._get(infra_id, nodename)
+                self.requests.pop((infra_id, nodename), None)
+                if any(requests):
+                    self.processing[infra_id, nodename] = requests
+                drained[nodename] = requests
+            return drained
+
+    def pending(self, infra_id, nodename):
+        with self.lock:
+            return self._get(infra_id, nodename)
+
+    def acknowledge(self, infra_id, unconsumed):
+        with self.lock:
+            for nodename, requests in unconsumed.items():
+                self.processing.pop((infra_id, nodename), None)
+                if any(requests):
+                    entry = self._entry(infra_id, nodename)
+                    entry[0] += requests.creates
+                    entry[1] += requests.drops
+                    entry[2].update(requests.targeted)
+
+@factory.register(ScalingRequestQueue, 'redis')
+class RedisScalingRequestQueue(ScalingRequestQueue):
+    """
+    Implements :class:`ScalingRequestQueue` in Redis.
+
+    The requests of a node type are stored under
+    ``infra:<infra_id>:scaling:<nodename>:`` as the counters ``create`` and
+    ``drop``, and the set ``drop_ids``; the requests being processed as the
+    hash ``processing`` (with the fields ``create`` and ``drop``) and the set
+    ``processing_ids``. All node types are drained by a single script, and
+    acknowledged in a single ``MULTI``/``EXEC`` transaction.
+
+    Parameters are passed to :class:`redis.StrictRedis`.
+    """
+    KEYS = ('create', 'drop', 'drop_ids', 'processing', 'processing_ids')
+
+    DRAIN = """
+        local result = {}
+        for i = 1, #KEYS, 5 do
+            local creates = tonumber(redis.call('get', KEYS[i]) or 0)
+            local drops = tonumber(redis.call('get', KEYS[i + 1]) or 0)
+            if creates > 0 then
+                redis.call('hincrby', KEYS[i + 3], 'create', creates)
+            end
+            if drops > 0 then
+                redis.call('hincrby', KEYS[i + 3], 'drop', drops)
+            end
+            if redis.call('exists', KEYS[i + 2]) == 1 then
+                redis.call('sunionstore', KEYS[i + 4], KEYS[i + 4], KEYS[i + 2])
+            end
+            redis.call('del', KEYS[i], KEYS[i + 1], KEYS[i + 2])
+            table.insert(result, redis.call('hget', KEYS[i + 3], 'create'))
+            table.insert(result, redis.call('hget', KEYS[i + 3], 'drop'))
+            table.insert(result, redis.call('smembers', KEYS[i + 4]))
+        end
+        return result
+    """
+
+    def __init__(self, host='localhost', port=6379, db=0, **kwargs):
+        import redis
+        self.backend = redis.StrictRedis(host=host, port=port, db=db, **kwargs)
+        self.drain_script = self.backend.register_script(self.DRAIN)
+
+    @staticmethod
+    def key(infra_id, nodename, name):
+        return 'infra:{0}:scaling:{1}:{2}'.format(infra_id, nodename, name)
+
+    def add_create(self, infra_id, nodename, count=1):
+        self.backend.incrby(self.key(infra_id, nodename, 'create'), count)
+
+    def add_drop(self, infra_id, nodename, nodeid=''):
+        if nodeid:
+            self.backend.sadd(self.key(infra_id, nodename, 'drop_ids'), nodeid)
+        else:
+            self.backend.incr(self.key(infra_id, nodename, 'drop'))
+
+    def drain(self, infra_id, nodenames):
+        nodenames = list(nodenames)
+        if not nodenames:
+            return dict()
+        results = self.drain_script(keys=[
+            self.key(infra_id, nodename, name)
+            for nodename in nodenames for name in self.KEYS])
+        return dict((nodename, self.requests(*results[3 * i:3 * i + 3]))
+                    for i, nodename in enumerate(nodenames))
+
+    def pending(self, infra_id, nodename):
+        pipe = self.backend.pipeline(transaction=True)
+        for name in ('create', 'drop'):
+            pipe.get(self.key(infra_id, nodename, name))
+        pipe.smembers(self.key(infra_id, nodename, 'drop_ids'))
+        processing = self.key(infra_id, nodename, 'processing')
+        pipe.hget(processing, 'create')
+        pipe.hget(processing, 'drop')
+        pipe.smembers(self.key(infra_id, nodename, 'processing_ids'))
+        results = pipe.execute()
+        return merge(self.requests(*results[:3]), self.requests(*results[3:]))
+
+    @staticmethod
+    def requests(creates, drops, targeted):
+        return ScalingRequests(
+            int(creates or 0), int(drops or 0),
+            frozenset(nodeid.decode('utf-8')
+                      if isinstance(nodeid, bytes) else nodeid
+                      for nodeid in targeted))
+
+    def acknowledge(self, infra_id, unconsumed):
+        if not unconsumed:
+            return
+        pipe = self.backend.pipeline(transaction=True)
+        for nodename, requests in unconsumed.items():
+            pipe.delete(self.key(infra_id, nodename, 'processing'),
+                        self.key(infra_id, nodename, 'processing_ids'))
+            if requests.creates:
+                pipe.incrby(self.key(infra_id, nodename, 'create'),
+                            requests.creates)
+            if requests.drops:
+                pipe.incrby(self.key(infra_id, nodename, 'drop'),
+                            requests.drops)
+            if requests.targeted:
+                pipe.sadd(self.key(infra_id, nodename, 'drop_ids'),
+                          *requests.targeted)
+        pipe.execute()
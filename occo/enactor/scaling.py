@@ -19,10 +19,13 @@ Scaling related algorithms to be used by manager_service and enactor.
 """
 
 import occo.infobroker as ib
+import itertools
 import logging
 import occo.util as util
 
 from occo.infobroker import main_uds
+from occo.enactor.requestqueue import ScalingRequests
+from occo.enactor import trigger as trigger
 
 log = logging.getLogger('occo.scaling')
 datalog = logging.getLogger('occo.data.scaling')
@@ -39,7 +42,7 @@ def keep_limits_for_scaling(target_count, node):
     target_count = min(target_count,target_max)
     return target_count
 
-def report(instances):
+def report(instances, request_queue=None, uds=None):
     if not instances:
         raise Exception("Internal error: instances not found!")
 
@@ -47,11 +50,16 @@ def report(instances):
     infraid = oneinstance['infra_id']
     nodename = oneinstance['resolved_node_definition']['name']
     count = len(instances)
+    uds = main_uds if uds is None else uds
 
-    target_count = int(util.coalesce(main_uds.get_scaling_target_count(infraid,nodename),
+    target_count = int(util.coalesce(uds.get_scaling_target_count(infraid,nodename),
                     count))
-    target_count += len(list(main_uds.get_scaling_createnode(infraid,nodename).keys()))
-    target_count -= len(list(main_uds.get_scaling_destroynode(infraid,nodename).keys()))
+    target_count += len(list(uds.get_scaling_createnode(infraid,nodename).keys()))
+    target_count -= len(list(uds.get_scaling_destroynode(infraid,nodename).keys()))
+    if request_queue is not None:
+        requests = request_queue.pending(infraid, nodename)
+        target_count += requests.creates
+        target_count -= requests.drops + len(requests.targeted)
 
     target_min, target_max = get_scaling_limits(oneinstance['node_description'])
     target_count = keep_limits_for_scaling(target_count,oneinstance['node_description'])
@@ -59,18 +67,268 @@ def report(instances):
     return dict(actual=count, target=target_count, min=target_min,
             max=target_max)
 
-def get_act_target_count(node):
-    nodename = node['name']
-    infraid = node['infra_id']
-    target_count = main_uds.get_scaling_target_count(infraid,nodename)
+class ScalingSnapshot(object):
+    """
+    Scaling requests of an infrastructure, loaded once per enactor pass.
+
+    Target counts, createnode and destroynode requests of every node type are
+    read from the UDS once by :meth:`load`, in a single bulk read if the UDS
+    supports it; the scaling algorithms then work on this snapshot only.
+    Modifications (consumed requests, new target counts) are written through
+    to the UDS and mirrored in the snapshot so later steps of the same pass
+    see a consistent view. Requests added after :meth:`load` are only seen
+    in the next pass.
+
+    If a request queue is used, the requests are drained from the queue
+    instead, and represented in the snapshot by entries with generated keys;
+    consuming them does not touch the store. Requests stored in the UDS entry
+    by entry (e.g. by components not using the queue) are moved to the queue
+    first. The drained requests must be acknowledged by :meth:`acknowledge`
+    at the end of the pass, which puts back the ones left unconsumed.
+
+    :param str infraid: The identifier of the infrastructure.
+    :param uds: The UDS to use; :data:`occo.infobroker.main_uds` by default.
+    :param request_queue: The queue of the scaling requests; if omitted,
+        the requests are stored in the UDS entry by entry.
+    :type request_queue: :class:`occo.enactor.requestqueue.ScalingRequestQueue`
+    """
+    def __init__(self, infraid, uds=None, request_queue=None):
+        self.infraid = infraid
+        self.uds = main_uds if uds is None else uds
+        self.request_queue = request_queue
+        self.keyids = ('queued:{0}'.format(i) for i in itertools.count())
+        self.target_counts = dict()
+        self.createnodes = dict()
+        self.destroynodes = dict()
+        self.drained = []
+
+    @classmethod
+    def load(cls, infraid, nodenames, uds=None, request_queue=None):
+        """
+        Loads the scaling requests of the given node types.
+
+        If the UDS provides ``get_scaling_requests(infraid, nodenames)``,
+        returning the target count, createnode and destroynode requests of
+        each node type, the snapshot is loaded in a single bulk read.
+        Otherwise the requests are read node type by node type.
+
+        :param str infraid: The identifier of the infrastructure.
+        :param nodenames: Names of the node types to be loaded.
+        :param uds: The UDS to use; :data:`occo.infobroker.main_uds` by
+            default.
+        :param request_queue: The queue to drain the requests from.
+        """
+        snapshot = cls(infraid, uds, request_queue)
+        nodenames = list(nodenames)
+        stored = snapshot.read_requests(nodenames)
+        for nodename in nodenames:
+            target_count, createnodes, destroynodes = stored[nodename]
+            snapshot.target_counts[nodename] = target_count
+            if request_queue is None:
+                snapshot.createnodes[nodename] = dict(createnodes)
+                snapshot.destroynodes[nodename] = dict(destroynodes)
+        if request_queue is not None:
+            snapshot.queue_entries(nodenames, stored)
+            drained = request_queue.drain(infraid, nodenames)
+            for nodename in nodenames:
+                snapshot.add_requests(nodename, drained[nodename])
+            snapshot.drained = [nodename for nodename in nodenames
+                                if any(drained[nodename])]
+        datalog.debug('Scaling snapshot of %r: %r', infraid, snapshot.__dict__)
+        return snapshot
+
+    def read_requests(self, nodenames):
+        """
+        Reads the scaling requests stored in the UDS.
+
+        The requests stored entry by entry are only read node type by node
+        type if no request queue is used; otherwise they are left to
+        :meth:`queue_entries`.
+
+        :returns: The target count, createnode and destroynode requests of
+            each node type; the latter two may be :data:`None` if they have
+            not been read.
+        :rtype: ``{nodename: (target_count, createnodes, destroynodes)}``
+        """
+        bulk_read = getattr(self.uds, 'get_scaling_requests', None)
+        if bulk_read is not None:
+            return bulk_read(self.infraid, nodenames)
+        requests = dict()
+        for nodename in nodenames:
+            target_count = self.uds.get_scaling_target_count(
+                self.infraid, nodename)
+            if self.request_queue is None:
+                requests[nodename] = (
+                    target_count,
+                    self.uds.get_scaling_createnode(self.infraid, nodename),
+                    self.uds.get_scaling_destroynode(self.infraid, nodename))
+            else:
+                requests[nodename] = (target_count, None, None)
+        return requests
+
+    def add_requests(self, nodename, requests):
+        """
+        Adds drained requests to the snapshot.
+
+        :type requests: :class:`occo.enactor.requestqueue.ScalingRequests`
+        """
+        createnodes = self.get_createnode(nodename)
+        for i in range(requests.creates):
+            createnodes[next(self.keyids)] = '1'
+        destroynodes = self.get_destroynode(nodename)
+        for nodeid in itertools.chain([''] * requests.drops,
+                                      sorted(requests.targeted)):
+            destroynodes[next(self.keyids)] = nodeid
+
+    def queue_entries(self, nodenames, stored):
+        """
+        Moves the requests stored in the UDS entry by entry to the request
+        queue.
+
+        Unless they have been read in bulk, the entries are only read if
+        their existence has been flagged under :func:`entries_key` (see
+        :func:`add_createnode_request`); the flag is cleared first, so
+        entries stored meanwhile are flagged again.
+
+        :param stored: The requests read by :meth:`read_requests`.
+        """
+        if all(stored[nodename][1] is None for nodename in nodenames):
+            kvstore = self.uds.kvstore
+            if not kvstore.query_item(entries_key(self.infraid), None):
+                return
+            kvstore.set_item(entries_key(self.infraid), None)
+        for nodename in nodenames:
+            requests = self.drain_entries(nodename, *stored[nodename][1:])
+            if any(requests):
+                log.debug('Scaling: queueing requests of node %r stored in '
+                          'the UDS: %r', nodename, requests)
+                self.request_queue.add_requests(
+                    self.infraid, nodename, requests)
+
+    def drain_entries(self, nodename, createnodes=None, destroynodes=None):
+        """
+        Reads and deletes the requests of a node type stored in the UDS entry
+        by entry.
+
+        :param createnodes: The createnode requests, if already read.
+        :param destroynodes: The destroynode requests, if already read.
+        :rtype: :class:`occo.enactor.requestqueue.ScalingRequests`
+        """
+        if createnodes is None:
+            createnodes = self.uds.get_scaling_createnode(
+                self.infraid, nodename)
+        if destroynodes is None:
+            destroynodes = self.uds.get_scaling_destroynode(
+                self.infraid, nodename)
+        for keyid in createnodes:
+            self.uds.del_scaling_createnode(self.infraid, nodename, keyid)
+        for keyid in destroynodes:
+            self.uds.del_scaling_destroynode(self.infraid, nodename, keyid)
+        destroynodes = list(destroynodes.values())
+        return ScalingRequests(
+            len(createnodes), destroynodes.count(''),
+            frozenset(nodeid for nodeid in destroynodes if nodeid))
+
+    def unconsumed(self, nodename):
+        """
+        Returns the requests of a node type left in the snapshot.
+
+        :rtype: :class:`occo.enactor.requestqueue.ScalingRequests`
+        """
+        destroynodes = list(self.get_destroynode(nodename).values())
+        return ScalingRequests(
+            len(self.get_createnode(nodename)),
+            destroynodes.count(''),
+            frozenset(nodeid for nodeid in destroynodes if nodeid))
+
+    def acknowledge(self):
+        """
+        Acknowledges the requests drained from the request queue, putting
+        back the ones not consumed in this pass.
+        """
+        if self.request_queue is None or not self.drained:
+            return
+        unconsumed = dict((nodename, self.unconsumed(nodename))
+                          for nodename in self.drained)
+        for nodename, requests in unconsumed.items():
+            if any(requests):
+                log.debug('Scaling: restoring unprocessed requests of node '
+                          '%r: %r', nodename, requests)
+        self.request_queue.acknowledge(self.infraid, unconsumed)
+        self.drained = []
+        self.createnodes.clear()
+        self.destroynodes.clear()
+
+    def fingerprint(self):
+        """
+        Returns a hashable digest of the pending scaling requests.
+
+        Two snapshots with equal fingerprints lead to the same target counts.
+        """
+        return (
+            tuple(sorted((nodename, util.coalesce(count, ''))
+                         for nodename, count in self.target_counts.items())),
+            tuple(sorted((nodename, tuple(sorted(requests)))
+                         for nodename, requests in self.createnodes.items())),
+            tuple(sorted((nodename, tuple(sorted(requests.items())))
+                         for nodename, requests in self.destroynodes.items())),
+        )
+
+    def get_target_count(self, nodename):
+        return self.target_counts.get(nodename)
+
+    def set_target_count(self, nodename, count):
+        self.uds.set_scaling_target_count(self.infraid, nodename, count)
+        self.target_counts[nodename] = count
+
+    def get_createnode(self, nodename):
+        return self.createnodes.setdefault(nodename, dict())
+
+    def del_createnode(self, nodename, keyid):
+        if self.request_queue is None:
+            self.uds.del_scaling_createnode(self.infraid, nodename, keyid)
+        self.get_createnode(nodename).pop(keyid, None)
+
+    def get_destroynode(self, nodename):
+        return self.destroynodes.setdefault(nodename, dict())
+
+    def set_destroynode(self, nodename, nodeid):
+        if self.request_queue is None:
+            keyid = self.uds.set_scaling_destroynode(
+                self.infraid, nodename, nodeid)
+        else:
+            keyid = next(self.keyids)
+        self.get_destroynode(nodename)[keyid] = nodeid
+        return keyid
+
+    def del_destroynode(self, nodename, keyid):
+        if self.request_queue is None:
+            self.uds.del_scaling_destroynode(self.infraid, nodename, keyid)
+        self.get_destroynode(nodename).pop(keyid, None)
+
+def entries_key(infraid):
+    """
+    The key flagging that scaling requests have been stored in the UDS entry
+    by entry, to be moved to the request queue.
+    """
+    return 'infra:{0}:scaling_entries'.format(infraid)
+
+def _snapshot_for(node, snapshot):
+    if snapshot is None:
+        snapshot = ScalingSnapshot.load(node['infra_id'], [node['name']])
+    return snapshot
+
+def get_act_target_count(node, snapshot=None):
+    snapshot = _snapshot_for(node, snapshot)
+    target_count = snapshot.get_target_count(node['name'])
     target_count = 0 if target_count is None else target_count
     target_count = keep_limits_for_scaling(target_count,node)
     return target_count
 
-def process_create_node_requests(node, targetcount):
+def process_create_node_requests(node, targetcount, snapshot=None):
+    snapshot = _snapshot_for(node, snapshot)
     nodename = node['name']
-    infraid = node['infra_id']
-    createnodes = main_uds.get_scaling_createnode(infraid, nodename)
+    createnodes = snapshot.get_createnode(nodename)
     if len(list(createnodes.keys())) > 0:
         targetmin, targetmax = get_scaling_limits(node)
         targetcount += len(list(createnodes.keys()))
@@ -79,55 +337,49 @@ def process_create_node_requests(node, targetcount):
                          targetmax, nodename )
             targetcount = targetmax
         for keyid in list(createnodes.keys()):
-            main_uds.del_scaling_createnode(infraid,nodename,keyid)
-        main_uds.set_scaling_target_count(infraid,nodename,targetcount)
+            snapshot.del_createnode(nodename,keyid)
+        snapshot.set_target_count(nodename,targetcount)
     return targetcount
 
 def remove_create_node_requests(infraid, nodename, requests):
     return
 
-def process_drop_node_requests_with_ids(node, targetcount, dynamic_state):
+def process_drop_node_requests_with_ids(node, targetcount, dynamic_state,
+                                        snapshot=None, address_index=None):
+    """
+    Processes the destroynode requests targeting specific instances.
+
+    A request may refer to an instance by its node id, or by any of its
+    addresses (IPv4 or IPv6). Requests referring to unknown instances are
+    discarded.
+
+    :param dynamic_state: The existing instances of the node type.
+    :param address_index: The address index of the infrastructure, maintained
+        by the upkeep. If omitted, it is built from ``dynamic_state``.
+    :type address_index: :class:`occo.enactor.upkeep.AddressIndex`
+    """
+    snapshot = _snapshot_for(node, snapshot)
     nodename = node['name']
-    infraid = node['infra_id']
-    #log.info('Calling process_drop_node_requests_with_ids({0}{1})...'.format(infraid,nodename))
-    #log.info('        targetcount: {0}'.format(targetcount))
-
-    existing_nodes_with_ips = {}
-    existing_ips_with_nodes = {}
-    for _,instance, in list(dynamic_state.items()):
-      existing_nodes_with_ips[instance['node_id']]=instance['resource_address']
-      if isinstance(instance['resource_address'], list):
-        for nra in instance['resource_address']:
-          existing_ips_with_nodes[nra]=instance['node_id']
-      else:
-        existing_ips_with_nodes[instance['resource_address']]=instance['node_id']
-    #log.info('EXISTING NODES WITH IPS: {0}'.format(existing_nodes_with_ips))
-    #log.info('EXISTING IPS WITH NODES: {0}'.format(existing_ips_with_nodes))
+    if address_index is None:
+        from occo.enactor.upkeep import AddressIndex
+        address_index = AddressIndex()
+        address_index.update({nodename: dynamic_state})
 
     #Collecting nodeids and requestids
-    dnlist = main_uds.get_scaling_destroynode(infraid,nodename)
-    #log.info('DNLIST: {0}'.format(dnlist))
+    dnlist = snapshot.get_destroynode(nodename)
     request_ids_with_destroy_node_id = dict()
-    destroy_node_ids_with_request_id = dict()
     for keyid, nodeid in list(dnlist.items()):
       if nodeid != "":
-        #Convert ipaddress to nodeid
-        if nodeid.count('.')>2:
-          main_uds.del_scaling_destroynode(infraid,nodename,keyid)
-          if nodeid in list(existing_ips_with_nodes):
-            ipaddress = nodeid
-            nodeid = existing_ips_with_nodes[ipaddress]
-            keyid = main_uds.set_scaling_destroynode(infraid, nodename, nodeid)
-            request_ids_with_destroy_node_id[keyid]=nodeid
-            destroy_node_ids_with_request_id[nodeid]=keyid
         #Check if nodid is valid
-        elif nodeid in list(existing_nodes_with_ips):
+        if nodeid in dynamic_state:
           request_ids_with_destroy_node_id[keyid]=nodeid
-          destroy_node_ids_with_request_id[nodeid]=keyid
-        else:
-          main_uds.del_scaling_destroynode(infraid,nodename,keyid)
-    #log.info('REQUEST_IDS_WITH_DESTROY_NODE_ID: {0}'.format(request_ids_with_destroy_node_id))
-    #log.info('DESTROY_NODE_IDS_WITH_REQUEST_ID: {0}'.format(destroy_node_ids_with_request_id))
+          continue
+        #Convert ipaddress to nodeid
+        snapshot.del_destroynode(nodename,keyid)
+        addressed_nodeid = address_index.lookup(nodeid)
+        if addressed_nodeid in dynamic_state:
+          keyid = snapshot.set_destroynode(nodename, addressed_nodeid)
+          request_ids_with_destroy_node_id[keyid]=addressed_nodeid
     if len(list(request_ids_with_destroy_node_id.keys())) > 0:
         targetmin, targetmax = get_scaling_limits(node)
         targetcount -= len(list(request_ids_with_destroy_node_id.keys()))
@@ -136,15 +388,15 @@ def process_drop_node_requests_with_ids(node, targetcount, dynamic_state):
             log.warning('Scaling: request(s) ignored, minimum count (%i) reached for node \'%s\'',
                          targetmin, nodename )
             for keyid in list(request_ids_with_destroy_node_id.keys())[:targetmin-targetcount]:
-                main_uds.del_scaling_destroynode(infraid,nodename,keyid)
+                snapshot.del_destroynode(nodename,keyid)
         targetcount = max(targetcount,targetmin)
-        main_uds.set_scaling_target_count(infraid,nodename,targetcount)
+        snapshot.set_target_count(nodename,targetcount)
     return targetcount
 
-def process_drop_node_requests_with_no_ids(node, targetcount):
+def process_drop_node_requests_with_no_ids(node, targetcount, snapshot=None):
+    snapshot = _snapshot_for(node, snapshot)
     nodename = node['name']
-    infraid = node['infra_id']
-    dnlist = main_uds.get_scaling_destroynode(infraid,nodename)
+    dnlist = snapshot.get_destroynode(nodename)
     destroynodes = dict()
     for keyid, nodeid in list(dnlist.items()):
         if nodeid == "":
@@ -152,24 +404,47 @@ def process_drop_node_requests_with_no_ids(node, targetcount):
     if len(list(destroynodes.keys())) > 0:
         targetmin, targetmax = get_scaling_limits(node)
         targetcount -= len(list(destroynodes.keys()))
-        #remove all destroy requests below minimum
         if targetcount < targetmin:
             log.warning('Scaling: request(s) ignored, minimum count (%i) reached for node \'%s\'',
                          targetmin, nodename )
-            for keyid in list(destroynodes.keys())[:targetmin-targetcount]:
-                main_uds.del_scaling_destroynode(infraid,nodename,keyid)
+        #anonymous requests are consumed by the new target count, so they
+        #are not applied again if the drop is postponed
+        for keyid in list(destroynodes.keys()):
+            snapshot.del_destroynode(nodename,keyid)
         targetcount = max(targetcount,targetmin)
-        main_uds.set_scaling_target_count(infraid,nodename,targetcount)
+        snapshot.set_target_count(nodename,targetcount)
     return targetcount
 
-def add_createnode_request(infraid, nodename, count = 1):
-    main_uds.set_scaling_createnode(infraid, nodename, count)
+# The request helpers publish the change to the local event sources of
+# occo.enactor.trigger, so that the dict UDS backend triggers passes too.
+# Requests stored entry by entry are flagged under entries_key, so that
+# enactors using a request queue only look for them if there are any.
+# Like report, they use main_uds unless a UDS is passed.
+
+def add_createnode_request(infraid, nodename, count = 1, request_queue=None,
+                           uds=None):
+    if request_queue is not None:
+        request_queue.add_create(infraid, nodename, count)
+    else:
+        uds = main_uds if uds is None else uds
+        uds.set_scaling_createnode(infraid, nodename, count)
+        uds.kvstore.set_item(entries_key(infraid), True)
+    trigger.publish(infraid)
     return
 
-def add_dropnode_request(infraid, nodename, nodeid):
-    main_uds.set_scaling_destroynode(infraid, nodename, nodeid)
+def add_dropnode_request(infraid, nodename, nodeid, request_queue=None,
+                         uds=None):
+    if request_queue is not None:
+        request_queue.add_drop(infraid, nodename, nodeid)
+    else:
+        uds = main_uds if uds is None else uds
+        uds.set_scaling_destroynode(infraid, nodename, nodeid)
+        uds.kvstore.set_item(entries_key(infraid), True)
+    trigger.publish(infraid)
     return
 
-def set_scalenode_request(infraid, nodename, count ):
-    main_uds.set_scaling_target_count(infraid, nodename, count)
+def set_scalenode_request(infraid, nodename, count, uds=None):
+    uds = main_uds if uds is None else uds
+    uds.set_scaling_target_count(infraid, nodename, count)
+    trigger.publish(infraid)
     return
@@ -0,0 +1,126 @@
+### Copyright 2014, MTA SZTAKI, www.sztaki.hu
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###    http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+
+"""
+Warm standby instances of node types.
+
+A node type may keep a number of pre-provisioned, idle instances besides its
+active ones, by specifying ``standby`` among its scaling parameters::
+
+    scaling:
+        min: 2
+        max: 20
+        standby: 3
+
+Standby instances are created from the node description extended with
+``standby: true``, so they can be recognized in the dynamic state. Their role
+is recorded in the key-value store of the UDS under
+``infra:<infra_id>:standby:<nodename>``. When the target count of the node
+type rises, standby instances are promoted to active ones instead of creating
+new instances; the pool is replenished at the end of the pass. Standby
+instances do not count towards the scaling limits of the node type.
+"""
+
+__all__ = ['pool_size', 'standby_node', 'StandbyPool']
+
+import occo.infobroker as ib
+import occo.constants.status as nodestate
+import logging
+
+log = logging.getLogger('occo.enactor.standby')
+
+STANDBY, ACTIVE = 'standby', 'active'
+
+def pool_size(node):
+    """Returns the number of standby instances of a node type."""
+    return int(node.get('scaling', dict()).get('standby', 0))
+
+def standby_node(node):
+    """Returns the node description standby instances are created from."""
+    return dict(node, standby=True)
+
+def is_standby_instance(instance):
+    return bool((instance.get('node_description') or dict()).get('standby'))
+
+class StandbyPool(object):
+    """
+    Keeps track of the standby instances of an infrastructure.
+
+    :param uds: The UDS storing the roles of the instances;
+        :data:`occo.infobroker.main_uds` by default.
+    """
+    def __init__(self, uds=None):
+        self.uds = ib.main_uds if uds is None else uds
+
+    @staticmethod
+    def key(infra_id, nodename):
+        return 'infra:{0}:standby:{1}'.format(infra_id, nodename)
+
+    def partition(self, infra_id, nodenames, dynamic_state):
+        """
+        Separates the standby instances of the given node types from the
+        active ones.
+
+        Instances created as standby instances are recorded as such when
+        first seen; records of instances no longer existing are removed.
+
+        :returns: The dynamic state of the active instances, and the standby
+            instances by node name.
+        :rtype: ``(dynamic_state, {str: {node_id: instance}})``
+        """
+        if not nodenames:
+            return dynamic_state, dict()
+        active_state, standby = dict(dynamic_state), dict()
+        for nodename in nodenames:
+            instances = dynamic_state.get(nodename, dict())
+            key = self.key(infra_id, nodename)
+            records = self.uds.kvstore.query_item(key, dict())
+            roles = dict((node_id, records.get(node_id, STANDBY))
+                         for node_id, instance in instances.items()
+                         if is_standby_instance(instance))
+            if roles != records:
+                self.uds.kvstore.set_item(key, roles)
+            standby[nodename] = dict(
+                (node_id, instance) for node_id, instance in instances.items()
+                if roles.get(node_id) == STANDBY)
+            active_state[nodename] = dict(
+                (node_id, instance) for node_id, instance in instances.items()
+                if node_id not in standby[nodename])
+        return active_state, standby
+
+    def promote(self, infra_id, nodename, standby, count):
+        """
+        Promotes up to ``count`` standby instances to active ones; ready
+        instances are promoted first, the longest-running first.
+
+        :param standby: The standby instances of the node type; promoted
+            instances are removed from it.
+        :returns: The promoted instances.
+        """
+        if count <= 0 or not standby:
+            return []
+        candidates = sorted(
+            standby.values(),
+            key=lambda instance: (instance.get('state') != nodestate.READY,
+                                  instance.get('instance_start_time') or 0))
+        promoted = candidates[:count]
+        key = self.key(infra_id, nodename)
+        records = self.uds.kvstore.query_item(key, dict())
+        for instance in promoted:
+            records[instance['node_id']] = ACTIVE
+            del standby[instance['node_id']]
+        self.uds.kvstore.set_item(key, records)
+        log.info('Promoted %d standby instance(s) of node %r',
+                 len(promoted), nodename)
+        return promoted
@@ -0,0 +1,216 @@
+### Copyright 2014, MTA SZTAKI, www.sztaki.hu
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###    http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+
+"""
+Event-driven triggering of enactor passes.
+
+Instead of waiting for the next periodic pass, an :class:`EventTrigger`
+subscribes to change notifications of the UDS (scaling requests, node states)
+through an :class:`EventSource`, and requests a pass of the affected
+infrastructure immediately. Bursts of events are coalesced: after a triggered
+pass, further events of the same infrastructure within the debounce window
+result in a single additional pass at the end of the window.
+
+Typical use with an :class:`~occo.enactor.pool.EnactorPool`::
+
+    trigger = EventTrigger(EventSource.from_config('local'), pool.trigger)
+    trigger.start()
+"""
+
+__all__ = ['EventSource', 'EventTrigger', 'publish']
+
+import occo.util.factory as factory
+import threading
+import logging
+
+log = logging.getLogger('occo.enactor.trigger')
+
+class EventSource(factory.MultiBackend):
+    """
+    Abstract source of infrastructure change notifications.
+    """
+
+    def __init__(self):
+        self.callback = None
+
+    def subscribe(self, callback):
+        """
+        Sets the function to be called with the infrastructure identifier
+        upon each change notification.
+        """
+        self.callback = callback
+
+    def notify(self, infra_id):
+        if self.callback:
+            self.callback(infra_id)
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+_local_sources = set()
+_local_lock = threading.Lock()
+
+def publish(infra_id):
+    """
+    Publishes a change of an infrastructure to the ``local`` event sources.
+
+    This is the in-process stand-in of keyspace notifications, to be called
+    by components changing the scaling requests or node states in a UDS
+    without change notifications (e.g. the ``dict`` backend).
+    """
+    with _local_lock:
+        sources = list(_local_sources)
+    for source in sources:
+        source.notify(infra_id)
+
+@factory.register(EventSource, 'local')
+class LocalEventSource(EventSource):
+    """
+    Implements :class:`EventSource`, receiving the events published in-process
+    with :func:`publish`.
+    """
+    def start(self):
+        with _local_lock:
+            _local_sources.add(self)
+
+    def stop(self):
+        with _local_lock:
+            _local_sources.discard(self)
+
+@factory.register(EventSource, 'redis')
+class RedisEventSource(EventSource):
+    """
+    Implements :class:`EventSource`, using Redis keyspace notifications.
+
+    The infrastructure identifier is the second ``:``-separated part of the
+    changed key (``infra:<infra_id>:...``), like in the keys of the UDS.
+
+    By default, only the keys of the scaling requests, the node states and
+    the description versions are subscribed to (:data:`PATTERNS`), so the keys the enactor maintains
+    in every pass (e.g. the resume record, the standby roles and the
+    teardown progress) do not trigger further passes. Consuming scaling
+    requests and removing failed nodes still result in one more pass.
+
+    :param list patterns: Key patterns to subscribe to; :data:`PATTERNS` by
+        default.
+    :param bool configure: If set, keyspace notifications are enabled on
+        the server (``notify-keyspace-events``); otherwise they must be
+        enabled by the administrator.
+
+    Other parameters are passed to :class:`redis.StrictRedis`.
+    """
+    PATTERNS = ('infra:*:scaling:*',
+                'infra:*:state',
+                'infra:*:state_changes:version',
+                'infra:*:description_version')
+
+    def __init__(self, patterns=None, configure=False,
+                 host='localhost', port=6379, db=0, **kwargs):
+        super(RedisEventSource, self).__init__()
+        import redis
+        self.db = db
+        self.patterns = self.PATTERNS if patterns is None else patterns
+        self.backend = redis.StrictRedis(host=host, port=port, db=db, **kwargs)
+        if configure:
+            self.backend.config_set('notify-keyspace-events', 'KA')
+        self.pubsub = None
+        self.thread = None
+
+    def handle(self, message):
+        channel = message['channel']
+        if isinstance(channel, bytes):
+            channel = channel.decode('utf-8')
+        key = channel.split(':', 1)[1]
+        parts = key.split(':')
+        if len(parts) > 1:
+            self.notify(parts[1])
+
+    def start(self):
+        self.pubsub = self.backend.pubsub(ignore_subscribe_messages=True)
+        self.pubsub.psubscribe(**dict(
+            ('__keyspace@{0}__:{1}'.format(self.db, pattern), self.handle)
+            for pattern in self.patterns))
+        self.thread = self.pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+    def stop(self):
+        if self.thread:
+            self.thread.stop()
+            self.thread = None
+        if self.pubsub:
+            self.pubsub.close()
+            self.pubsub = None
+
+class EventTrigger(object):
+    """
+    Triggers passes of infrastructures upon change notifications, coalescing
+    bursts of events.
+
+    The first event of an infrastructure triggers a pass immediately, and
+    opens a debounce window. Further events within the window trigger a
+    single pass when the window closes (which opens a new window).
+
+    :param event_source: The source of change notifications.
+    :type event_source: :class:`EventSource`
+    :param callback: Requests a pass of an infrastructure, e.g.
+        :meth:`occo.enactor.pool.EnactorPool.trigger`.
+    :type callback: ``(infra_id) -> None``
+    :param float debounce: The length of the debounce window, in seconds.
+    """
+    def __init__(self, event_source, callback, debounce=1.0):
+        self.event_source = event_source
+        self.callback = callback
+        self.debounce = debounce
+        self.windows = dict()
+        self.lock = threading.Lock()
+        self.event_source.subscribe(self.event)
+
+    def event(self, infra_id):
+        with self.lock:
+            if infra_id in self.windows:
+                # Coalesced into the pass at the end of the window
+                self.windows[infra_id] = True
+                return
+            self.open_window(infra_id)
+        self.fire(infra_id)
+
+    def open_window(self, infra_id):
+        self.windows[infra_id] = False
+        timer = threading.Timer(self.debounce, self.close_window, [infra_id])
+        timer.daemon = True
+        timer.start()
+
+    def close_window(self, infra_id):
+        with self.lock:
+            pending = self.windows.pop(infra_id, False)
+            if pending:
+                self.open_window(infra_id)
+        if pending:
+            self.fire(infra_id)
+
+    def fire(self, infra_id):
+        log.debug('Triggering pass of infrastructure %r', infra_id)
+        try:
+            self.callback(infra_id)
+        except Exception:
+            log.exception('Triggering pass of infrastructure %r failed:',
+                          infra_id)
+
+    def start(self):
+        self.event_source.start()
+
+    def stop(self):
+        self.event_source.stop()
@@ -21,14 +21,138 @@ Upkeep algorithms to be used before making an Enactor pass.
 import occo.infobroker as ib
 import occo.util.factory as factory
 import occo.constants.status as nodestate
+from . import compact as compact
+import asyncio
+import ipaddress
+import json
+import threading
+import time
 import logging
 
 log = logging.getLogger('occo.upkeep')
 datalog = logging.getLogger('occo.data.upkeep')
 
+def normalize_address(address):
+    """
+    Returns the canonical form of an IPv4 or IPv6 address, so differently
+    written forms of the same address match. Other strings (e.g. host names)
+    are returned unchanged.
+    """
+    try:
+        return str(ipaddress.ip_address(str(address).strip()))
+    except ValueError:
+        return address
+
+def host_header(host, port):
+    """
+    Returns the value of the HTTP ``Host`` header for an address; IPv6
+    addresses are enclosed in brackets.
+    """
+    if ':' in host:
+        host = '[{0}]'.format(host)
+    return host if port == 80 else '{0}:{1}'.format(host, port)
+
+class AddressIndex(object):
+    """
+    Index of the resource addresses of the instances of an infrastructure.
+
+    The index is updated incrementally by :meth:`update`: only instances
+    that appeared, disappeared, or whose address changed since the previous
+    update are touched. Compact records (see :mod:`occo.enactor.compact`) are
+    immutable, so the addresses of records already indexed are not even
+    compared. Lookups are O(1).
+    """
+    def __init__(self):
+        self.addresses = dict()
+        self.nodes = dict()
+        self.records = dict()
+
+    @staticmethod
+    def instance_addresses(instance):
+        address = instance.get('resource_address')
+        if address is None:
+            return ()
+        if not isinstance(address, list):
+            address = [address]
+        return tuple(normalize_address(a) for a in address)
+
+    def add(self, node_id, addresses):
+        self.remove(node_id)
+        self.addresses[node_id] = addresses
+        for address in addresses:
+            self.nodes[address] = node_id
+
+    def remove(self, node_id):
+        self.records.pop(node_id, None)
+        for address in self.addresses.pop(node_id, ()):
+            if self.nodes.get(address) == node_id:
+                del self.nodes[address]
+
+    def update(self, dynamic_state):
+        """
+        Synchronizes the index with the dynamic state of the infrastructure.
+
+        :param dynamic_state: The instances of the infrastructure by node
+            type.
+        """
+        current = dict((node_id, instance)
+                       for instances in dynamic_state.values()
+                       for node_id, instance in instances.items())
+        for node_id in set(self.addresses) - set(current):
+            self.remove(node_id)
+        for node_id, instance in current.items():
+            if self.records.get(node_id) is instance:
+                continue
+            addresses = self.instance_addresses(instance)
+            if self.addresses.get(node_id) != addresses:
+                self.add(node_id, addresses)
+            if isinstance(instance, compact.InstanceRecord):
+                self.records[node_id] = instance
+            else:
+                self.records.pop(node_id, None)
+
+    def update_nodes(self, dynamic_state, changes):
+        """
+        Synchronizes the given instances of the index with the dynamic state
+        of the infrastructure.
+
+        :param changes: The instances that may have changed, as
+            ``(nodename, node_id)`` pairs.
+        """
+        for nodename, node_id in changes:
+            instance = dynamic_state.get(nodename, dict()).get(node_id)
+            if instance is None:
+                self.remove(node_id)
+            else:
+                addresses = self.instance_addresses(instance)
+                if self.addresses.get(node_id) != addresses:
+                    self.add(node_id, addresses)
+
+    def lookup(self, address):
+        """
+        Returns the identifier of the node having the given address, or
+        ``None``.
+        """
+        return self.nodes.get(normalize_address(address))
+
+    def __contains__(self, node_id):
+        return node_id in self.addresses
+
+class DeferredAddressIndex(AddressIndex):
+    """
+    An :class:`AddressIndex` ignoring updates, for upkeep strategies whose
+    dynamic state is indexed by the strategy wrapping them.
+    """
+    def update(self, dynamic_state):
+        pass
+
+    def update_nodes(self, dynamic_state, changes):
+        pass
+
 class Upkeep(factory.MultiBackend):
     def __init__(self):
         self.infobroker = ib.main_info_broker
+        self.address_index = AddressIndex()
 
     def acquire_dynamic_state(self, infra_id):
         raise NotImplementedError()
@@ -36,7 +160,9 @@ class Upkeep(factory.MultiBackend):
 @factory.register(Upkeep, 'noop')
 class DefaultUpkeep(Upkeep):
     def acquire_dynamic_state(self, infra_id):
-        return self.infobroker.get('infrastructure.state', infra_id, True)
+        dynamic_state = self.infobroker.get('infrastructure.state', infra_id, True)
+        self.address_index.update(dynamic_state)
+        return dynamic_state, []
 
 @factory.register(Upkeep, 'basic')
 class BasicUpkeep(Upkeep):
@@ -61,6 +187,19 @@ class BasicUpkeep(Upkeep):
         nodes = [node
                  for instances in list(dynamic_state.values())
                  for node in list(instances.values())]
+        failed_nodes = self.process_nodes(infra_id, dynamic_state, nodes)
+
+        self.address_index.update(dynamic_state)
+        return dynamic_state, failed_nodes
+
+    def process_nodes(self, infra_id, dynamic_state, nodes):
+        """
+        Archives the failed nodes and removes the failed and shut down nodes,
+        both from the infrastructure and ``dynamic_state``.
+
+        :param nodes: The nodes to be checked.
+        :returns: The list of failed nodes.
+        """
         failed_nodes, remove_nodes = [], []
 
         for node in nodes:
@@ -83,4 +222,455 @@ class BasicUpkeep(Upkeep):
                  infra_id, remove_ids)
             self.uds.remove_nodes(infra_id, *remove_ids)
 
+        return failed_nodes
+
+class StateChangeLog(factory.MultiBackend):
+    """
+    Abstract log of the node state changes of infrastructures.
+
+    Each recorded change increments the version of the infrastructure's log.
+    Components changing the state of nodes (registering, updating or
+    removing them) record the change together with the new instance data
+    (see :class:`StateChangeRecorder`), so :class:`IncrementalUpkeep` can
+    refresh only the changed nodes. As long as nothing has been recorded for
+    an infrastructure (version 0), no producer is assumed to exist, and the
+    upkeep keeps performing full scans.
+    """
+
+    def __init__(self):
+        pass
+
+    def record(self, infra_id, nodename, node_id, instance_data=None):
+        """
+        Records that the state of a node has changed.
+
+        :param nodename: The node type of the node; may be ``None`` if the
+            node has been removed.
+        :param instance_data: The new instance data of the node; ``None`` if
+            the node has been removed.
+        """
+        raise NotImplementedError()
+
+    def version(self, infra_id):
+        """
+        Returns the current version of the log of the infrastructure, or
+        ``None`` if it is not available.
+        """
+        raise NotImplementedError()
+
+    def changes(self, infra_id, since):
+        """
+        Returns the changes recorded after version ``since``.
+
+        :returns: The current version and the latest recorded
+            ``(nodename, instance_data)`` of each changed node by node id;
+            or ``None`` if the changes since that version are not (or no
+            longer) available.
+        """
+        raise NotImplementedError()
+
+@factory.register(StateChangeLog, 'none')
+class NoStateChangeLog(StateChangeLog):
+    """
+    Implements :class:`StateChangeLog` without recording anything; changes
+    are never available, so the upkeep always performs a full scan.
+    """
+    def record(self, infra_id, nodename, node_id, instance_data=None):
+        pass
+
+    def version(self, infra_id):
+        return None
+
+    def changes(self, infra_id, since):
+        return None
+
+@factory.register(StateChangeLog, 'kvstore')
+class KVStoreStateChangeLog(StateChangeLog):
+    """
+    Implements :class:`StateChangeLog`, storing a bounded log in the key-value
+    store of the UDS.
+
+    The log is updated with a read-modify-write of the whole log, which is
+    only serialized within a process: changes recorded concurrently by other
+    processes may be lost (and are then only noticed by the periodic full
+    scan of :class:`IncrementalUpkeep`). Use the ``redis`` change log if
+    multiple processes record changes.
+
+    :param int max_entries: The number of changes kept. If more changes
+        happen between two passes, the log has a gap, and the upkeep falls
+        back to a full scan.
+    """
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self.uds = ib.main_uds
+        self.lock = threading.Lock()
+
+    def key(self, infra_id):
+        return 'infra:{0}:state_changes'.format(infra_id)
+
+    def load(self, infra_id):
+        return self.uds.kvstore.query_item(
+            self.key(infra_id), dict(version=0, entries=[]))
+
+    def record(self, infra_id, nodename, node_id, instance_data=None):
+        with self.lock:
+            changelog = self.load(infra_id)
+            changelog['version'] += 1
+            changelog['entries'].append(
+                (changelog['version'], nodename, node_id, instance_data))
+            del changelog['entries'][:-self.max_entries]
+            self.uds.kvstore.set_item(self.key(infra_id), changelog)
+
+    def version(self, infra_id):
+        return self.load(infra_id)['version']
+
+    def changes(self, infra_id, since):
+        changelog = self.load(infra_id)
+        version, entries = changelog['version'], changelog['entries']
+        if since is None or since > version:
+            return None
+        oldest = entries[0][0] if entries else version + 1
+        if since < oldest - 1:
+            return None
+        return version, dict((node_id, (nodename, instance_data))
+                             for v, nodename, node_id, instance_data in entries
+                             if v > since)
+
+@factory.register(StateChangeLog, 'redis')
+class RedisStateChangeLog(StateChangeLog):
+    """
+    Implements :class:`StateChangeLog` in Redis, recording changes atomically,
+    so any number of processes may record them.
+
+    The version of the log of an infrastructure is the counter
+    ``infra:<infra_id>:state_changes:version``; the entries are stored in the
+    sorted set ``infra:<infra_id>:state_changes``, scored by their version.
+
+    :param int max_entries: The number of changes kept.
+
+    Other parameters are passed to :class:`redis.StrictRedis`.
+    """
+    RECORD = """
+        local version = redis.call('incr', KEYS[1])
+        redis.call('zadd', KEYS[2], version, version .. ':' .. ARGV[1])
+        redis.call('zremrangebyrank', KEYS[2], 0, -tonumber(ARGV[2]) - 1)
+        return version
+    """
+
+    def __init__(self, max_entries=10000, host='localhost', port=6379, db=0,
+                 **kwargs):
+        import redis
+        self.max_entries = max_entries
+        self.backend = redis.StrictRedis(host=host, port=port, db=db,
+                                         decode_responses=True, **kwargs)
+        self.record_script = self.backend.register_script(self.RECORD)
+
+    @staticmethod
+    def key(infra_id):
+        return 'infra:{0}:state_changes'.format(infra_id)
+
+    def record(self, infra_id, nodename, node_id, instance_data=None):
+        key = self.key(infra_id)
+        self.record_script(keys=[key + ':version', key],
+                           args=[json.dumps([node_id, nodename,
+                                             instance_data]),
+                                 self.max_entries])
+
+    def version(self, infra_id):
+        return int(self.backend.get(self.key(infra_id) + ':version') or 0)
+
+    def changes(self, infra_id, since):
+        if since is None:
+            return None
+        key = self.key(infra_id)
+        pipe = self.backend.pipeline(transaction=True)
+        pipe.get(key + ':version')
+        pipe.zrange(key, 0, 0, withscores=True)
+        pipe.zrangebyscore(key, '({0}'.format(since), '+inf')
+        version, oldest, entries = pipe.execute()
+        version = int(version or 0)
+        if since > version:
+            return None
+        oldest = int(oldest[0][1]) if oldest else version + 1
+        if since < oldest - 1:
+            return None
+        changed = dict()
+        for entry in entries:
+            node_id, nodename, instance_data = \
+                json.loads(entry.split(':', 1)[1])
+            changed[node_id] = nodename, instance_data
+        return version, changed
+
+class StateChangeRecorder(object):
+    """
+    Wraps a UDS, recording the changes of the nodes registered and removed
+    through it in a :class:`StateChangeLog`.
+
+    Components maintaining the nodes of infrastructures (e.g. the
+    infraprocessor) use the recorder in place of the UDS to produce the
+    change log for :class:`IncrementalUpkeep`. Other methods are delegated
+    to the UDS.
+
+    :param uds: The UDS to wrap.
+    :param change_log: The :class:`StateChangeLog`, or its configuration.
+    """
+    def __init__(self, uds, change_log='kvstore'):
+        self.uds = uds
+        if not isinstance(change_log, StateChangeLog):
+            change_log = StateChangeLog.from_config(change_log)
+        self.change_log = change_log
+
+    def __getattr__(self, name):
+        return getattr(self.uds, name)
+
+    def register_started_node(self, infra_id, node_name, instance_data):
+        result = self.uds.register_started_node(
+            infra_id, node_name, instance_data)
+        self.change_log.record(infra_id, node_name,
+                               instance_data['node_id'], instance_data)
+        return result
+
+    def remove_nodes(self, infra_id, *node_ids):
+        result = self.uds.remove_nodes(infra_id, *node_ids)
+        for node_id in node_ids:
+            self.change_log.record(infra_id, None, node_id)
+        return result
+
+@factory.register(Upkeep, 'incremental')
+class IncrementalUpkeep(BasicUpkeep):
+    """
+    Implements :class:`Upkeep`, processing only the nodes whose state has
+    changed since the previous pass, according to a :class:`StateChangeLog`.
+
+    The dynamic state of the previous pass is kept, and only the nodes named
+    in the change log are refreshed from the instance data recorded with
+    the changes; the state of the infrastructure is not queried from the
+    infobroker.
+
+    A full scan is performed in the first pass; whenever the changes since
+    the previous pass are not available (the log has a gap); as long as no
+    change has ever been recorded for the infrastructure (there is no
+    producer); and every ``full_scan_interval`` seconds, so changes that
+    have not been recorded are noticed eventually.
+
+    :param change_log: The configuration of the :class:`StateChangeLog`.
+    :param float full_scan_interval: The maximum time between two full
+        scans, in seconds; ``None`` disables periodic full scans.
+    """
+    def __init__(self, change_log='kvstore', full_scan_interval=300):
+        super(IncrementalUpkeep, self).__init__()
+        self.change_log = StateChangeLog.from_config(change_log)
+        self.full_scan_interval = full_scan_interval
+        self.version = None
+        self.last_full_scan = None
+        self.dynamic_state = None
+
+    def full_scan_reason(self, changes, now):
+        """
+        Returns why a full scan is needed, or ``None`` if the changes can be
+        processed incrementally.
+        """
+        if changes is None:
+            return 'no continuous change log'
+        if changes[0] == 0:
+            return 'no changes have ever been recorded'
+        if self.full_scan_interval is not None \
+                and now - self.last_full_scan >= self.full_scan_interval:
+            return 'periodic full scan'
+        return None
+
+    def acquire_dynamic_state(self, infra_id):
+        log.debug('Acquiring state of %r', infra_id)
+        now = time.time()
+        changes = self.change_log.changes(infra_id, self.version)
+        reason = self.full_scan_reason(changes, now)
+        if reason is not None:
+            log.debug('Performing full scan of %r: %s', infra_id, reason)
+            # The version is read first, so changes made during the scan are
+            # processed again in the next pass.
+            version = self.change_log.version(infra_id)
+            dynamic_state, failed_nodes = \
+                super(IncrementalUpkeep, self).acquire_dynamic_state(infra_id)
+            self.version, self.last_full_scan = version, now
+            self.dynamic_state = dynamic_state
+            return self.copy_state(), failed_nodes
+
+        self.version, changed = changes
+        dynamic_state = self.dynamic_state
+        log.debug('Refreshing %d changed nodes in %r', len(changed), infra_id)
+        nodes = []
+        for node_id, (nodename, instance_data) in changed.items():
+            for instances in dynamic_state.values():
+                instances.pop(node_id, None)
+            if instance_data is not None:
+                dynamic_state.setdefault(nodename, dict())[node_id] = \
+                    instance_data
+                nodes.append(instance_data)
+        datalog.debug('%r', dynamic_state)
+        failed_nodes = self.process_nodes(infra_id, dynamic_state, nodes)
+
+        self.address_index.update_nodes(
+            dynamic_state, [(nodename, node_id)
+                            for node_id, (nodename, _) in changed.items()])
+        return self.copy_state(), failed_nodes
+
+    def copy_state(self):
+        """
+        Returns a copy of the kept dynamic state, which may be modified by
+        the enactor without affecting the next pass.
+        """
+        return dict((nodename, dict(instances))
+                    for nodename, instances in self.dynamic_state.items())
+
+@factory.register(Upkeep, 'probing')
+class ProbingUpkeep(BasicUpkeep):
+    """
+    Implements :class:`Upkeep`, actively probing the ready instances of the
+    infrastructure in addition to the checks of :class:`BasicUpkeep`.
+
+    Instances are probed concurrently (using :mod:`asyncio`) at their
+    ``resource_address``. The probe is specified by the ``health_check``
+    section of the node description, or by the default ``health_check``
+    given here; instances without one are not probed::
+
+        health_check:
+            protocol: tcp   # or http
+            port: 22
+            path: /health   # http only
+            timeout: 5      # optional, overrides the default
+
+    A TCP probe succeeds if the connection is accepted; an HTTP probe if the
+    response status is below 400. Instances failing ``failure_threshold``
+    consecutive probes are considered failed: they are archived and removed
+    like the nodes reported as failed, so they are replaced in the same
+    pass.
+
+    :param int concurrency: The maximum number of probes in progress.
+    :param float timeout: The default timeout of a probe, in seconds.
+    :param int failure_threshold: The number of consecutive failed probes
+        after which an instance is considered failed.
+    :param dict health_check: The default probe specification.
+    """
+    def __init__(self, concurrency=50, timeout=5, failure_threshold=3,
+                 health_check=None):
+        super(ProbingUpkeep, self).__init__()
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.failure_threshold = failure_threshold
+        self.health_check = health_check
+        self.failures = dict()
+
+    def get_health_check(self, node):
+        return node.get('node_description', dict()).get(
+            'health_check', self.health_check)
+
+    def is_failed(self, node):
+        return super(ProbingUpkeep, self).is_failed(node) \
+            or self.failures.get(node['node_id'], 0) >= self.failure_threshold
+
+    async def probe(self, host, health_check):
+        """
+        Probes a single address.
+
+        :returns: Whether the probe succeeded.
+        """
+        protocol = health_check.get('protocol', 'tcp')
+        port = health_check['port']
+        timeout = health_check.get('timeout', self.timeout)
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(host, port), timeout)
+        except (OSError, asyncio.TimeoutError):
+            return False
+        try:
+            if protocol == 'tcp':
+                return True
+            request = 'GET {0} HTTP/1.0\r\nHost: {1}\r\n\r\n'.format(
+                health_check.get('path', '/'), host_header(host, port))
+            writer.write(request.encode('ascii'))
+            status_line = await asyncio.wait_for(
+                reader.readline(), timeout)
+            status = status_line.split()
+            return len(status) > 1 and status[1].isdigit() \
+                and int(status[1]) < 400
+        except (OSError, asyncio.TimeoutError):
+            return False
+        finally:
+            writer.close()
+
+    async def probe_nodes(self, nodes):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        async def probe_node(node, host, health_check):
+            async with semaphore:
+                return node, await self.probe(host, health_check)
+        probes = []
+        for node in nodes:
+            health_check = self.get_health_check(node)
+            addresses = self.address_index.instance_addresses(node)
+            if health_check and addresses \
+                    and node['state'] == nodestate.READY:
+                probes.append(probe_node(node, addresses[0], health_check))
+        return await asyncio.gather(*probes)
+
+    def acquire_dynamic_state(self, infra_id):
+        log.debug('Acquiring state of %r', infra_id)
+        dynamic_state = self.infobroker.get(
+            'infrastructure.state', infra_id, True)
+        datalog.debug('%r', dynamic_state)
+
+        nodes = [node
+                 for instances in list(dynamic_state.values())
+                 for node in list(instances.values())]
+
+        log.debug('Probing %d nodes in %r', len(nodes), infra_id)
+        failures = dict()
+        for node, alive in asyncio.run(self.probe_nodes(nodes)):
+            node_id = node['node_id']
+            if not alive:
+                failures[node_id] = self.failures.get(node_id, 0) + 1
+                log.debug('Probing node %r failed (%d in a row)',
+                          node_id, failures[node_id])
+        # Instances which disappeared, or passed the probe, are forgotten
+        self.failures = failures
+
+        log.debug('Processing failed nodes in %r', infra_id)
+        failed_nodes = self.process_nodes(infra_id, dynamic_state, nodes)
+
+        self.address_index.update(dynamic_state)
+        return dynamic_state, failed_nodes
+
+@factory.register(Upkeep, 'compact')
+class CompactUpkeep(Upkeep):
+    """
+    Implements :class:`Upkeep`, converting the dynamic state acquired by
+    another upkeep strategy into compact records (see
+    :mod:`occo.enactor.compact`), which share the definitions of node types
+    among their instances. Records of unchanged instances are kept from pass
+    to pass, and the address index is updated after the conversion, so their
+    addresses are not parsed again.
+
+    :param upkeep: The configuration of the upkeep strategy acquiring the
+        dynamic state.
+    """
+    def __init__(self, upkeep='basic'):
+        self.upkeep = Upkeep.from_config(upkeep)
+        self.upkeep.address_index = DeferredAddressIndex()
+        self.address_index = AddressIndex()
+        self.shared = compact.SharedDefinitions()
+        self.previous = dict()
+
+    def _delegate(name):
+        return property(lambda self: getattr(self.upkeep, name),
+                        lambda self, value: setattr(self.upkeep, name, value))
+    infobroker = _delegate('infobroker')
+    uds = _delegate('uds')
+    del _delegate
+
+    def acquire_dynamic_state(self, infra_id):
+        dynamic_state, failed_nodes = \
+            self.upkeep.acquire_dynamic_state(infra_id)
+        dynamic_state = compact.compact_state(
+            dynamic_state, self.shared, self.previous.get(infra_id))
+        self.previous[infra_id] = dynamic_state
+        self.address_index.update(dynamic_state)
         return dynamic_state, failed_nodes
@@ -0,0 +1,338 @@
+### Copyright 2014, MTA SZTAKI, www.sztaki.hu
+###
+### Licensed under the Apache License, Version 2.0 (the "License");
+### you may not use this file except in compliance with the License.
+### You may obtain a copy of the License at
+###
+###    http://www.apache.org/licenses/LICENSE-2.0
+###
+### Unless required by applicable law or agreed to in writing, software
+### distributed under the License is distributed on an "AS IS" BASIS,
+### WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+### See the License for the specific language governing permissions and
+### limitations under the License.
+
+"""
+Scale benchmarks of the Enactor.
+
+Synthetic infrastructures with many node types, deep topological orders and
+thousands of instances are maintained against the ``dict`` UDS and a local
+infraprocessor. For each scenario, the pass latency, the UDS and infobroker
+calls per pass, the number of instructions generated, the peak memory
+allocated and the memory held by the dynamic state once acquired are measured
+(the latter two in a separate run, as tracing allocations slows down the
+passes), and compared to a stored baseline::
+
+    python -m occo_test.benchmark --size large
+    python -m occo_test.benchmark --size large --update-baseline
+    python -m occo_test.benchmark --size large --upkeep-strategy compact
+    python -m occo_test.benchmark --size large --upkeep-strategy incremental
+    python -m occo_test.benchmark --counts-only --update-baseline
+
+The exit status is non-zero if any measurement regressed beyond its tolerance,
+or if there is no baseline of the size (unless it is being updated).
+Call and instruction counts are deterministic, so any increase is a
+regression; time and memory are compared with relative tolerances.
+With ``--counts-only``, only these are measured (and stored); the baseline
+of the repository holds only the counts, so that it does not depend on the
+machine. The ``small`` size of it is checked by the test suite.
+"""
+
+import occo.enactor as enactor
+import occo.compiler as compiler
+import occo.infobroker as ib
+import occo.util.communication as comm
+import occo.util.factory as factory
+import occo.util as util
+import occo.constants.status as nodestate
+from occo.infobroker.uds import UDS
+from occo.enactor.upkeep import StateChangeRecorder
+from occo.enactor.description import touch_description
+import argparse
+import random
+import sys
+import time
+import tracemalloc
+import uuid
+import yaml
+import logging
+
+log = logging.getLogger('occo.benchmark')
+
+BASELINE_FILE = util.rel_to_file('benchmark_baseline.yaml')
+
+SIZES = dict(
+    small=dict(node_types=20, levels=5, instances=10),
+    large=dict(node_types=200, levels=20, instances=25),
+)
+
+# Deterministic metrics; the stored baseline holds only these
+COUNTS = ('uds_calls', 'instructions')
+
+TOLERANCES = dict(
+    latency=0.5,
+    peak_memory=0.25,
+    state_memory=0.25,
+    uds_calls=0,
+    instructions=0,
+)
+
+def generate_infrastructure(node_types, levels, instances, seed=0):
+    """
+    Generates the description of a synthetic infrastructure.
+
+    Node types are distributed evenly among ``levels`` topological levels;
+    each node type depends on a random node type of the previous level. Each
+    node type has exactly ``instances`` instances.
+    """
+    rnd = random.Random(seed)
+    nodes = [dict(name='node{0:04d}'.format(i),
+                  scaling=dict(min=instances, max=instances * 2))
+             for i in range(node_types)]
+    per_level = max(node_types // levels, 1)
+    dependencies = [
+        [node, rnd.choice(nodes[i - i % per_level - per_level:
+                                i - i % per_level])]
+        for i, node in enumerate(nodes) if i >= per_level]
+    return dict(user_id='benchmark', name='benchmark',
+                nodes=nodes, dependencies=dependencies)
+
+class BenchmarkInstruction(object):
+    def __init__(self, parent_ip, perform):
+        self.parent_ip = parent_ip
+        self._perform = perform
+    def perform(self):
+        self._perform()
+
+@factory.register(comm.RPCProducer, 'local_benchmark')
+@ib.provider
+class BenchmarkInfraProcessor(ib.InfoProvider, comm.RPCProducer):
+    """
+    Local infraprocessor registering complete instance data in the UDS, and
+    counting the instructions performed.
+    """
+    def __init__(self, static_description, uds, **kwargs):
+        ib.InfoProvider.__init__(self, main_info_broker=True)
+        self.static_description = static_description
+        self.started = False
+        self.instructions = 0
+        self.addresses = iter(range(1, 2**24))
+        self.uds = uds
+        self.uds.add_infrastructure(static_description)
+        touch_description(static_description.infra_id, uds)
+
+    @ib.provides('infrastructure.started')
+    def infrastructure_created(self, infra_id, **kwargs):
+        return self.started
+
+    @ib.provides('infrastructure.static_description')
+    def infra_descr(self, infra_id, **kwargs):
+        return self.static_description
+
+    @ib.provides('infrastructure.state')
+    def infra_state(self, infra_id, allow_default=False):
+        return self.uds.get_infrastructure_state(infra_id, allow_default)
+
+    def create_node(self, node):
+        address = next(self.addresses)
+        self.uds.register_started_node(
+            self.static_description.infra_id, node['name'],
+            dict(node_id=str(uuid.uuid4()),
+                 infra_id=self.static_description.infra_id,
+                 name=node['name'],
+                 state=nodestate.READY,
+                 resource_address='10.{0}.{1}.{2}'.format(
+                     address >> 16, (address >> 8) & 255, address & 255),
+                 instance_start_time=time.time(),
+                 resolved_node_definition=dict(name=node['name']),
+                 node_description=node))
+
+    def cri_create_infrastructure(self, infra_id):
+        return BenchmarkInstruction(
+            self, lambda: setattr(self, 'started', True))
+    def cri_create_node(self, node):
+        return BenchmarkInstruction(self, lambda: self.create_node(node))
+    def cri_drop_node(self, instance_data):
+        return BenchmarkInstruction(
+            self, lambda: self.uds.remove_nodes(
+                self.static_description.infra_id, instance_data['node_id']))
+    def push_instructions(self, infra_id, instructions, **kwargs):
+        for i in instructions:
+            i.perform()
+        self.instructions += len(instructions)
+
+def measure(e, processor, prepare=None, trace_memory=False):
+    """
+    Measures a single enactor pass.
+
+    Tracing allocations slows down the pass considerably, so either the
+    memory is measured (``trace_memory``), or the latency and the counts.
+    """
+    if prepare:
+        prepare()
+    if trace_memory:
+        held = []
+        acquire = e.upkeep.acquire_dynamic_state
+        def acquire_dynamic_state(infra_id):
+            result = acquire(infra_id)
+            held.append(tracemalloc.get_traced_memory()[0])
+            return result
+        e.upkeep.acquire_dynamic_state = acquire_dynamic_state
+        tracemalloc.start()
+        try:
+            e.make_a_pass()
+            _, peak_memory = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+            del e.upkeep.acquire_dynamic_state
+        return dict(peak_memory=peak_memory, state_memory=sum(held))
+    instructions = processor.instructions
+    start = time.perf_counter()
+    e.make_a_pass()
+    latency = time.perf_counter() - start
+    return dict(latency=latency,
+                uds_calls=sum(e.call_counts.values()),
+                instructions=processor.instructions - instructions)
+
+def run_scenarios(node_types, levels, instances, upkeep_strategy='basic',
+                  trace_memory=False):
+    """
+    Runs the benchmark scenarios on a new synthetic infrastructure.
+
+    :returns: The measurements by scenario.
+    """
+    infra = generate_infrastructure(node_types, levels, instances)
+    uds = UDS.instantiate(protocol='dict')
+    statd = compiler.StaticDescription(infra)
+    if upkeep_strategy == 'incremental':
+        # The infraprocessor produces the change log of the upkeep
+        processor = comm.RPCProducer.instantiate(
+            'local_benchmark', statd, StateChangeRecorder(uds))
+    else:
+        processor = comm.RPCProducer.instantiate('local_benchmark', statd, uds)
+    e = enactor.Enactor(infrastructure_id=statd.infra_id,
+                        infraprocessor=processor,
+                        upkeep_strategy=upkeep_strategy)
+    full = enactor.Enactor(infrastructure_id=statd.infra_id,
+                           infraprocessor=processor,
+                           upkeep_strategy=upkeep_strategy,
+                           skip_unchanged=False)
+    scaled = [node['name'] for node in statd.nodes[::10]]
+
+    def scale_out():
+        for nodename in scaled:
+            uds.set_scaling_createnode(statd.infra_id, nodename, 1)
+    def scale_in():
+        for nodename in scaled:
+            uds.set_scaling_destroynode(statd.infra_id, nodename, '')
+    def fail_nodes():
+        # Through the infraprocessor's UDS, so that the change log of the
+        # incremental upkeep records the failures too
+        state = uds.get_infrastructure_state(statd.infra_id)
+        for nodename in scaled:
+            instance_data = list(state[nodename].values())[0]
+            processor.uds.register_started_node(
+                statd.infra_id, nodename,
+                dict(instance_data, state=nodestate.FAIL))
+
+    def run(e, prepare=None):
+        return measure(e, processor, prepare, trace_memory)
+
+    results = dict()
+    results['bootstrap'] = run(e)
+    results['converged'] = run(e)
+    results['steady_skipped'] = run(e)
+    results['steady_full'] = run(full)
+    results['scale_out'] = run(e, scale_out)
+    results['scale_in'] = run(e, scale_in)
+    results['replace_failed'] = run(e, fail_nodes)
+    return results
+
+def run_benchmarks(node_types, levels, instances, upkeep_strategy='basic'):
+    """
+    Runs the benchmark scenarios twice: measuring the latency and the counts
+    first, then the memory.
+
+    :returns: The measurements by scenario.
+    """
+    results = run_scenarios(node_types, levels, instances, upkeep_strategy)
+    memory = run_scenarios(node_types, levels, instances, upkeep_strategy,
+                           trace_memory=True)
+    for scenario, measurements in results.items():
+        measurements.update(memory[scenario])
+    return results
+
+def compare(results, baseline, tolerances=TOLERANCES):
+    """
+    Compares the results to the baseline.
+
+    :returns: The list of regressions, as human-readable strings.
+    """
+    regressions = []
+    for scenario, measurements in sorted(results.items()):
+        for metric, value in sorted(measurements.items()):
+            expected = baseline.get(scenario, dict()).get(metric)
+            if expected is None:
+                continue
+            limit = expected * (1 + tolerances[metric])
+            if value > limit:
+                regressions.append(
+                    '{0}.{1}: {2!r} > {3!r} (baseline {4!r})'.format(
+                        scenario, metric, value, limit, expected))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--size', choices=sorted(SIZES), default='small')
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--upkeep-strategy',
+                        choices=['basic', 'compact', 'incremental'],
+                        default='basic')
+    parser.add_argument('--update-baseline', action='store_true')
+    parser.add_argument('--counts-only', action='store_true',
+                        help='measure the call and instruction counts only')
+    args = parser.parse_args(argv)
+    # Baselines of other upkeep strategies are stored as <size>:<strategy>
+    size = args.size if args.upkeep_strategy == 'basic' \
+        else '{0}:{1}'.format(args.size, args.upkeep_strategy)
+
+    try:
+        with open(args.baseline) as f:
+            baselines = yaml.safe_load(f) or dict()
+    except IOError:
+        baselines = dict()
+
+    if not args.update_baseline and size not in baselines:
+        print('No baseline of size {0!r} in {1}; '
+              'store one with --update-baseline'.format(size, args.baseline))
+        return 2
+
+    if args.counts_only:
+        results = run_scenarios(upkeep_strategy=args.upkeep_strategy,
+                                **SIZES[args.size])
+        results = dict((scenario, dict((metric, measurements[metric])
+                                       for metric in COUNTS))
+                       for scenario, measurements in results.items())
+    else:
+        results = run_benchmarks(upkeep_strategy=args.upkeep_strategy,
+                                 **SIZES[args.size])
+    for scenario, measurements in sorted(results.items()):
+        print('{0:16} {1}'.format(scenario, ' '.join(
+            '{0}={1!r}'.format(metric, value)
+            for metric, value in sorted(measurements.items()))))
+
+    if args.update_baseline:
+        baselines[size] = results
+        with open(args.baseline, 'w') as f:
+            yaml.safe_dump(baselines, f, default_flow_style=False)
+        print('Baseline of size {0!r} stored in {1}'.format(
+            size, args.baseline))
+        return 0
+
+    regressions = compare(results, baselines[size])
+    for regression in regressions:
+        print('REGRESSION: {0}'.format(regression))
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
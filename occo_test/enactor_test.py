@@ -23,6 +23,7 @@ import occo.constants.status as nodestate
 import occo.util.config as config
 from occo.infobroker.uds import UDS
 import occo.infobroker.rediskvstore
+from occo.enactor.description import touch_description
 from functools import wraps
 import uuid, sys
 import io as sio
@@ -70,6 +71,16 @@ class CreateNodeSLI(SingletonLocalInstruction):
         self.parent_ip.add_process(self.node_def['name'], pid)
     def __str__(self):
         return '{{create_node -> {0}}}'.format(self.node_def['name'])
+class CreateNodesSLI(CreateNodeSLI):
+    def __init__(self, parent_ip, node_def, count, **kwargs):
+        self.count = count
+        super(CreateNodesSLI, self).__init__(parent_ip, node_def, **kwargs)
+    def perform(self):
+        for i in range(self.count):
+            super(CreateNodesSLI, self).perform()
+    def __str__(self):
+        return '{{create_nodes -> {0} x{1}}}'.format(self.node_def['name'],
+                                                     self.count)
 class DropNodeSLI(SingletonLocalInstruction):
     def __init__(self, parent_ip, instance_data, **kwargs):
         self.node_id = instance_data['node_id']
@@ -102,6 +113,7 @@ class SingletonLocalInfraProcessor(ib.InfoProvider,
         self.started = False
         self.uds = uds
         self.uds.add_infrastructure(static_description)
+        touch_description(static_description.infra_id, uds)
 
     def add_process(self, node_name, pid):
         self.process_list[node_name].append(pid)
@@ -144,7 +156,7 @@ class SingletonLocalInfraProcessor(ib.InfoProvider,
     def cri_drop_infrastructure(self, infra_id):
         return DropInfrastructureSLI(
             self, instruction='drop_infrastructure', infra_id=infra_id)
-    def push_instructions(self, instructions, **kwargs):
+    def push_instructions(self, infra_id, instructions, **kwargs):
         for i in instructions:
             i.perform()
 
@@ -153,6 +165,7 @@ class SLITester(SingletonLocalInfraProcessor):
     def __init__(self, statd, uds, output_buffer, **kwargs):
         super(SLITester, self).__init__(statd, uds, **kwargs)
         self.buf = output_buffer
+        self.created = []
         self.print_state()
     def print_state(self):
         self.buf.write('R' if self.started else 'S')
@@ -160,16 +173,30 @@ class SLITester(SingletonLocalInfraProcessor):
         for k in sorted(state.keys()):
             self.buf.write(' {0}:{1}'.format(k, len(state[k])))
         self.buf.write('\n')
-    def push_instructions(self, instructions, **kwargs):
-        super(SLITester, self).push_instructions(instructions, **kwargs)
+    def push_instructions(self, infra_id, instructions, **kwargs):
+        super(SLITester, self).push_instructions(infra_id, instructions, **kwargs)
+        self.created.extend(i.node_def['name'] for i in instructions
+                            if isinstance(i, CreateNodeSLI))
         self.print_state()
 
+@factory.register(comm.RPCProducer, 'local_test_bulk')
+class BulkSLITester(SLITester):
+    def __init__(self, statd, uds, output_buffer, **kwargs):
+        super(BulkSLITester, self).__init__(statd, uds, output_buffer, **kwargs)
+        self.bulk_instructions = 0
+    def cri_create_nodes(self, node, count):
+        self.bulk_instructions += 1
+        return CreateNodesSLI(self, instruction='create_nodes',
+                              node_def=node, count=count)
+
 def make_enactor_pass(infra, uds,
                       upkeep_strategy='noop',
-                      downscale_strategy='simple'):
+                      downscale_strategy='simple',
+                      processor_protocol='local_test'):
     buf = sio.StringIO()
     statd = compiler.StaticDescription(infra)
-    processor = comm.RPCProducer.instantiate('local_test', statd, uds, buf)
+    processor = comm.RPCProducer.instantiate(
+        processor_protocol, statd, uds, buf)
     e = enactor.Enactor(infrastructure_id=statd.infra_id,
                         infraprocessor=processor,
                         upkeep_strategy=upkeep_strategy,
@@ -184,6 +211,30 @@ def test_enactor_pass():
     for infra in infracfg.infrastructures:
         yield make_enactor_pass, infra, uds
 
+def make_dataflow_pass(infra, uds):
+    buf = sio.StringIO()
+    statd = compiler.StaticDescription(infra)
+    processor = comm.RPCProducer.instantiate('local_test', statd, uds, buf)
+    e = enactor.Enactor(infrastructure_id=statd.infra_id,
+                        infraprocessor=processor,
+                        upkeep_strategy='noop',
+                        enactment_mode='dataflow')
+    e.make_a_pass()
+    # Batches are pushed per node type, so only the final state is fixed
+    nose.tools.assert_equal(buf.getvalue().splitlines()[-1],
+                            infra['expected_output'].splitlines()[-1])
+    # Each node type is created after all of its dependencies
+    created = processor.created
+    for node, dependency in infra['dependencies']:
+        nose.tools.assert_greater(
+            created.index(node['name']),
+            len(created) - created[::-1].index(dependency['name']) - 1)
+
+def test_dataflow_enactment():
+    uds = UDS.instantiate(protocol='dict')
+    for infra in infracfg.infrastructures:
+        yield make_dataflow_pass, infra, uds
+
 def make_upkeep(uds_config):
     import copy
     infra = copy.deepcopy(infracfg.infrastructures[0])
@@ -228,6 +279,871 @@ def test_drop_nodes():
     sc['min'] = sc['max'] = 1
     e.make_a_pass()
 
+def test_bulk_create():
+    import copy
+    infra = copy.deepcopy(infracfg.infrastructures[0])
+    uds = UDS.instantiate(protocol='dict')
+    e, buf, statd = make_enactor_pass(infra, uds,
+                                      processor_protocol='local_test_bulk')
+    # Only the two instances of C are created in bulk
+    nose.tools.assert_equal(e.ip.bulk_instructions, 1)
+
+def test_bulk_create_limits():
+    import copy
+    infra = copy.deepcopy(infracfg.infrastructures[0])
+    infra['nodes'][1]['scaling']['min'] = 5
+    uds = UDS.instantiate(protocol='dict')
+    statd = compiler.StaticDescription(infra)
+    processor = comm.RPCProducer.instantiate(
+        'local_test_bulk', statd, uds, sio.StringIO())
+    e = enactor.Enactor(infrastructure_id=statd.infra_id,
+                        infraprocessor=processor,
+                        upkeep_strategy='noop',
+                        enactment_limits=dict(max_inflight_creates=2,
+                                              create_rate=100))
+    acquired = []
+    acquire = e.limiter.acquire
+    def record_acquire(kind, count, deadline=None):
+        acquired.append((kind, count))
+        return acquire(kind, count, deadline)
+    e.limiter.acquire = record_acquire
+    e.make_a_pass()
+    nose.tools.assert_equal(
+        dict((name, len(pids)) for name, pids in processor.process_list.items()),
+        dict(A=1, B=5, C=2, D=1))
+    # Bulk creations are split, and limited by instance
+    creates = [count for kind, count in acquired if kind == 'create']
+    nose.tools.assert_equal(sum(creates), 9)
+    nose.tools.assert_true(all(count <= 2 for count in creates))
+    # B: 2 + 2 + 1, C: 2
+    nose.tools.assert_equal(processor.bulk_instructions, 3)
+
+def test_teardown():
+    import copy
+    infra = copy.deepcopy(infracfg.infrastructures[0])
+    uds = UDS.instantiate(protocol='dict')
+    e, buf, statd = make_enactor_pass(infra, uds)
+    record = e.teardown()
+    nose.tools.assert_true(record['done'])
+    nose.tools.assert_false(e.ip.started)
+    nose.tools.assert_equal(
+        sum(len(pids) for pids in e.ip.process_list.values()), 0)
+    # Idempotent
+    nose.tools.assert_equal(e.teardown(), record)
+    # Passes are refused on the torn down infrastructure
+    nose.tools.assert_false(e.description.started)
+    e.make_a_pass()
+    nose.tools.assert_false(e.ip.started)
+    nose.tools.assert_equal(
+        sum(len(pids) for pids in e.ip.process_list.values()), 0)
+
+def test_address_index():
+    from occo.enactor.upkeep import AddressIndex
+    index = AddressIndex()
+    index.update(dict(A=dict(a1=dict(resource_address=['10.0.0.1',
+                                                        '2001:DB8::0:1'])),
+                      B=dict(b1=dict(resource_address='10.0.0.2'))))
+    nose.tools.assert_equal(index.lookup('2001:db8::1'), 'a1')
+    nose.tools.assert_equal(index.lookup('10.0.0.2'), 'b1')
+    # Records are immutable: a new record of an instance is indexed again
+    from occo.enactor.compact import InstanceRecord
+    record = InstanceRecord(dict(node_id='b1', resource_address='10.0.0.2'),
+                            dict())
+    index.update(dict(B=dict(b1=record)))
+    nose.tools.assert_is(index.records['b1'], record)
+    index.update(dict(B=dict(b1=InstanceRecord(
+        dict(node_id='b1', resource_address='10.0.0.3'), dict()))))
+    nose.tools.assert_equal(index.lookup('10.0.0.3'), 'b1')
+    nose.tools.assert_equal(index.lookup('10.0.0.2'), None)
+    index.update(dict(A=dict(), B=dict(b1=dict(resource_address='10.0.0.1'))))
+    nose.tools.assert_equal(index.lookup('10.0.0.1'), 'b1')
+    nose.tools.assert_is_none(index.lookup('2001:db8::1'))
+    nose.tools.assert_not_in('a1', index)
+
+class StateStub(object):
+    """Stands in for the infobroker and the UDS of an upkeep."""
+    def __init__(self, **nodes):
+        self.state = dict(
+            (nodename, dict((node_id, dict(node_id=node_id, state='ready',
+                                           resolved_node_definition=dict(
+                                               name=nodename)))
+                            for node_id in node_ids))
+            for nodename, node_ids in nodes.items())
+        self.failed = []
+        self.queries = 0
+    def get(self, key, infra_id, *args):
+        import copy
+        self.queries += 1
+        return copy.deepcopy(self.state)
+    def register_started_node(self, infra_id, node_name, instance_data):
+        self.state.setdefault(node_name, dict())[instance_data['node_id']] = \
+            instance_data
+    def store_failed_nodes(self, infra_id, *nodes):
+        self.failed.extend(node['node_id'] for node in nodes)
+    def remove_nodes(self, infra_id, *node_ids):
+        for instances in self.state.values():
+            for node_id in node_ids:
+                instances.pop(node_id, None)
+
+def make_incremental_upkeep(stub, change_log):
+    from occo.enactor.upkeep import Upkeep
+    upkeep = Upkeep.from_config(
+        dict(protocol='incremental', change_log=change_log,
+             full_scan_interval=None))
+    upkeep.infobroker = upkeep.uds = stub
+    upkeep.change_log.uds = UDS.instantiate(protocol='dict')
+    return upkeep
+
+def failed_ids(upkeep):
+    _, failed_nodes = upkeep.acquire_dynamic_state('infra')
+    return sorted(node['node_id'] for node in failed_nodes)
+
+def test_incremental_upkeep():
+    stub = StateStub(A=['a1', 'a2', 'a3'])
+    upkeep = make_incremental_upkeep(stub, 'kvstore')
+    nose.tools.assert_equal(failed_ids(upkeep), [])
+    # Nothing has been recorded: no producer, full scans are performed
+    stub.state['A']['a1']['state'] = 'fail'
+    nose.tools.assert_equal(failed_ids(upkeep), ['a1'])
+    # Only the recorded changes are processed
+    stub.state['A']['a2']['state'] = 'fail'
+    stub.state['A']['a3']['state'] = 'fail'
+    upkeep.change_log.record('infra', 'A', 'a2', stub.state['A']['a2'])
+    nose.tools.assert_equal(failed_ids(upkeep), ['a2'])
+    nose.tools.assert_equal(failed_ids(upkeep), [])
+    nose.tools.assert_in('a3', stub.state['A'])
+
+def test_incremental_upkeep_gap():
+    stub = StateStub(A=['a1', 'a2'], B=['b1'])
+    upkeep = make_incremental_upkeep(
+        stub, dict(protocol='kvstore', max_entries=2))
+    upkeep.change_log.record('infra', 'B', 'b1', stub.state['B']['b1'])
+    nose.tools.assert_equal(failed_ids(upkeep), [])
+    stub.state['A']['a1']['state'] = 'fail'
+    for i in range(3):
+        upkeep.change_log.record('infra', 'B', 'b1', stub.state['B']['b1'])
+    # The change of a1 has not been recorded, but the log has a gap
+    nose.tools.assert_equal(failed_ids(upkeep), ['a1'])
+    nose.tools.assert_equal(stub.failed, ['a1'])
+    nose.tools.assert_not_in('a1', stub.state['A'])
+
+def test_incremental_upkeep_cached_state():
+    from occo.enactor.upkeep import StateChangeRecorder
+    stub = StateStub(A=['a1'])
+    upkeep = make_incremental_upkeep(stub, 'kvstore')
+    recorder = StateChangeRecorder(stub, upkeep.change_log)
+    nose.tools.assert_equal(failed_ids(upkeep), [])
+    nose.tools.assert_equal(stub.queries, 1)
+    # Registered nodes are refreshed from the change log
+    a2 = dict(node_id='a2', state='ready',
+              resolved_node_definition=dict(name='A'))
+    recorder.register_started_node('infra', 'A', a2)
+    dynamic_state, _ = upkeep.acquire_dynamic_state('infra')
+    nose.tools.assert_equal(sorted(dynamic_state['A']), ['a1', 'a2'])
+    # The state is not queried if nothing has changed
+    dynamic_state, _ = upkeep.acquire_dynamic_state('infra')
+    nose.tools.assert_equal(sorted(dynamic_state['A']), ['a1', 'a2'])
+    recorder.register_started_node('infra', 'A', dict(a2, state='fail'))
+    nose.tools.assert_equal(failed_ids(upkeep), ['a2'])
+    recorder.remove_nodes('infra', 'a1')
+    dynamic_state, _ = upkeep.acquire_dynamic_state('infra')
+    nose.tools.assert_equal(dynamic_state, dict(A=dict()))
+    nose.tools.assert_equal(stub.queries, 1)
+
+def test_probing_upkeep():
+    from occo.enactor.upkeep import Upkeep
+    import socket, threading, http.server
+    listening = socket.socket()
+    listening.bind(('127.0.0.1', 0))
+    listening.listen(8)
+    closed = socket.socket()
+    closed.bind(('127.0.0.1', 0))
+    closed_port = closed.getsockname()[1]
+    closed.close()
+    class HealthHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200 if self.path == '/health' else 500)
+            self.end_headers()
+        def log_message(self, *args):
+            pass
+    httpd = http.server.HTTPServer(('127.0.0.1', 0), HealthHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    http_port = httpd.server_address[1]
+    checks = dict(
+        tcp_up=dict(protocol='tcp', port=listening.getsockname()[1]),
+        tcp_down=dict(protocol='tcp', port=closed_port),
+        http_up=dict(protocol='http', port=http_port, path='/health'),
+        http_down=dict(protocol='http', port=http_port, path='/broken'))
+    stub = StateStub(A=list(checks))
+    for node_id, health_check in checks.items():
+        stub.state['A'][node_id].update(
+            resource_address='127.0.0.1',
+            node_description=dict(health_check=health_check))
+    upkeep = Upkeep.from_config(
+        dict(protocol='probing', timeout=2, failure_threshold=2))
+    upkeep.infobroker = upkeep.uds = stub
+    try:
+        # Failures are counted, but the threshold is not reached yet
+        nose.tools.assert_equal(failed_ids(upkeep), [])
+        nose.tools.assert_equal(upkeep.failures,
+                                dict(tcp_down=1, http_down=1))
+        nose.tools.assert_equal(failed_ids(upkeep), ['http_down', 'tcp_down'])
+        # Failed instances are archived and removed
+        nose.tools.assert_equal(sorted(stub.failed),
+                                ['http_down', 'tcp_down'])
+        nose.tools.assert_equal(sorted(stub.state['A']),
+                                ['http_up', 'tcp_up'])
+        nose.tools.assert_equal(failed_ids(upkeep), [])
+        nose.tools.assert_equal(upkeep.failures, dict())
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+        listening.close()
+
+def test_http_host_header():
+    from occo.enactor.upkeep import host_header
+    nose.tools.assert_equal(host_header('10.0.0.1', 80), '10.0.0.1')
+    nose.tools.assert_equal(host_header('2001:db8::1', 8080),
+                            '[2001:db8::1]:8080')
+
+def make_scoring_downscale(scorer, expected):
+    from occo.enactor.downscale import DownscaleStrategy
+    existing = dict((str(i), dict(node_id=str(i),
+                                  instance_start_time=i,
+                                  metrics=dict(load=(i * 7) % 10)))
+                    for i in range(10))
+    strategy = DownscaleStrategy.from_config(
+        dict(protocol='scoring', scorer=scorer))
+    nose.tools.assert_equal(
+        sorted(n['node_id'] for n in strategy.drop_nodes(existing, 3)),
+        expected)
+
+def test_scoring_downscale():
+    yield make_scoring_downscale, 'newest', ['7', '8', '9']
+    yield make_scoring_downscale, 'oldest', ['0', '1', '2']
+    yield make_scoring_downscale, 'least_loaded', ['0', '3', '6']
+
+def test_least_loaded_scorer_metrics_provider():
+    from occo.enactor.downscale import DownscaleStrategy
+    from occo.enactor.policy import InMemoryMetricsProvider
+    provider = InMemoryMetricsProvider()
+    existing = dict((str(i), dict(node_id=str(i), infra_id='infra',
+                                  instance_start_time=i))
+                    for i in range(10))
+    for i in range(9):
+        provider.set_metric('infra', str(i), 'load', (i * 7) % 10)
+    strategy = DownscaleStrategy.from_config(
+        dict(protocol='scoring',
+             scorer=dict(protocol='least_loaded', metrics_provider=provider)))
+    # Node 9 reports no load, so it is dropped last
+    nose.tools.assert_equal(
+        sorted(n['node_id'] for n in strategy.drop_nodes(existing, 3)),
+        ['0', '3', '6'])
+
+def test_metric_scaling_policies():
+    from occo.enactor.policy import ScalingPolicy
+    node = dict(name='W', scaling=dict(min=1, max=10))
+    tracking = ScalingPolicy.from_config(
+        dict(protocol='target_tracking', metric='cpu', target_value=0.5))
+    nose.tools.assert_equal(tracking.metric_target(node, 3, 0.9), 6)
+    nose.tools.assert_equal(tracking.metric_target(node, 4, 0.2), 2)
+    step = ScalingPolicy.from_config(
+        dict(protocol='step', metric='queue',
+             steps=[dict(lower=100, adjustment=2),
+                    dict(upper=10, adjustment=-1)]))
+    nose.tools.assert_equal(step.metric_target(node, 3, 150), 5)
+    nose.tools.assert_equal(step.metric_target(node, 3, 50), 3)
+    nose.tools.assert_equal(step.metric_target(node, 3, 5), 2)
+
+def test_predictive_scaling_policy():
+    from occo.enactor import policy
+    from occo.enactor.scaling import keep_limits_for_scaling
+    if policy.np is None:
+        raise nose.SkipTest('NumPy is not available')
+    node = dict(name='W', infra_id='i', scaling=dict(min=1, max=20))
+    def make_policy(horizon, series):
+        predictive = policy.ScalingPolicy.from_config(
+            dict(protocol='predictive', metric='queue', capacity=12,
+                 horizon=horizon))
+        for now, value in enumerate(series):
+            predictive.add_sample(('i', 'W'), value, now)
+        return predictive
+    # Rising by 10/s: 10s ahead, the demand is 150 (13 instances), not the
+    # current 50 (5 instances)
+    rising = make_policy(10, [10, 20, 30, 40])
+    nose.tools.assert_equal(rising.metric_target(node, 5, 50, now=4), 13)
+    # Far ahead, the forecast is clamped by the scaling limits
+    far = make_policy(100, [10, 20, 30, 40])
+    nose.tools.assert_equal(keep_limits_for_scaling(
+        far.metric_target(node, 5, 50, now=4), node), 20)
+    # Falling demand is not released ahead of time; the forecast is never
+    # negative
+    falling = make_policy(100, [50, 40, 30, 20])
+    nose.tools.assert_equal(falling.metric_target(node, 5, 10, now=4), 1)
+    nose.tools.assert_equal(falling.forecast(falling.history[('i', 'W')]), 0)
+
+def test_scaling_stabilizer():
+    from occo.enactor.policy import ScalingStabilizer
+    node = dict(name='X', scaling=dict(min=1, max=10))
+    existing = dict((str(i), dict(instance_start_time=i)) for i in range(5))
+    windowed = ScalingStabilizer(downscale_window=10)
+    nose.tools.assert_equal(
+        [windowed.stabilize(node, existing, target, now=now)
+         for now, target in [(0, 5), (1, 3), (2, 2)]], [5, 5, 5])
+    nose.tools.assert_equal(windowed.stabilize(node, existing, 2, now=20), 2)
+    aged = ScalingStabilizer(min_instance_age=10)
+    nose.tools.assert_equal(aged.stabilize(node, existing, 1, now=12), 2)
+    cooled = ScalingStabilizer(cooldown=10)
+    nose.tools.assert_equal(cooled.stabilize(node, existing, 7, now=0), 7)
+    nose.tools.assert_equal(cooled.stabilize(node, existing, 3, now=5), 5)
+    nose.tools.assert_equal(cooled.stabilize(node, existing, 3, now=11), 3)
+
+def test_prometheus_exposition():
+    from occo.enactor.instrumentation import MetricsSink
+    sink = MetricsSink.from_config('prometheus')
+    sink.increment('enactor_passes_total', infra_id='i', outcome='full')
+    sink.increment('enactor_passes_total', infra_id='i', outcome='full')
+    sink.observe('enactor_batch_instructions', 3, infra_id='i')
+    nose.tools.assert_equal(
+        sink.exposition(),
+        '# TYPE enactor_passes_total counter\n'
+        'enactor_passes_total{infra_id="i",outcome="full"} 2.0\n'
+        '# TYPE enactor_batch_instructions summary\n'
+        'enactor_batch_instructions_sum{infra_id="i"} 3.0\n'
+        'enactor_batch_instructions_count{infra_id="i"} 1\n')
+
+def test_target_once_per_pass():
+    import copy
+    infra = copy.deepcopy(infracfg.infrastructures[0])
+    uds = UDS.instantiate(protocol='dict')
+    e, buf, statd = make_enactor_pass(infra, uds)
+    e.skip_unchanged = False
+    stabilized = []
+    stabilize = e.stabilizer.stabilize
+    def recording_stabilize(node, *args, **kwargs):
+        stabilized.append(node['name'])
+        return stabilize(node, *args, **kwargs)
+    e.stabilizer.stabilize = recording_stabilize
+    e.make_a_pass()
+    # The drop and the create phases share the target of a node type
+    nose.tools.assert_equal(sorted(stabilized),
+                            sorted(node['name'] for node in statd.nodes))
+
+def test_pass_uds_calls():
+    import copy
+    infra = copy.deepcopy(infracfg.infrastructures[0])
+    uds = UDS.instantiate(protocol='dict')
+    e, buf, statd = make_enactor_pass(infra, uds)
+    e.skip_unchanged = False
+    e.make_a_pass()
+    # The key-value store calls (description version, teardown and resume
+    # records) are counted as well
+    nose.tools.assert_equal(
+        dict((method, count) for (service, method), count
+             in e.call_counts.items() if service == 'uds'),
+        {'get_scaling_target_count': 4,
+         'get_scaling_createnode': 4,
+         'get_scaling_destroynode': 4,
+         'kvstore.query_item': 3,
+         'finished_first_maintenance': 1})
+
+def test_skip_unchanged_pass():
+    import copy
+    infra = copy.deepcopy(infracfg.infrastructures[0])
+    uds = UDS.instantiate(protocol='dict')
+    e, buf, statd = make_enactor_pass(infra, uds)
+    e.make_a_pass()
+    e.make_a_pass()
+    nose.tools.assert_equal(e.pass_counters, dict(full=2, skipped=1))
+
+def test_pass_fingerprint_standby():
+    from occo.enactor.scaling import ScalingSnapshot
+    import copy
+    infra = copy.deepcopy(infracfg.infrastructures[0])
+    statd = compiler.StaticDescription(infra)
+    e = enactor.Enactor(statd.infra_id, None, upkeep_strategy='noop')
+    snapshot = ScalingSnapshot(statd.infra_id, UDS.instantiate(protocol='dict'))
+    standby = dict(node_id='s1', state=nodestate.READY)
+    e.standby_instances = dict(A=dict(s1=standby))
+    fingerprint = e.pass_fingerprint(statd, dict(), dict(), snapshot)
+    # A standby instance disappearing requires a pass to replenish the pool
+    e.standby_instances = dict(A=dict())
+    nose.tools.assert_not_equal(
+        e.pass_fingerprint(statd, dict(), dict(), snapshot), fingerprint)
+
+def test_description_index_cache():
+    import copy
+    infra = copy.deepcopy(infracfg.infrastructures[0])
+    uds = UDS.instantiate(protocol='dict')
+    e, buf, statd = make_enactor_pass(infra, uds)
+    e.make_a_pass()
+    index = e.describe(statd)
+    nose.tools.assert_true(index.started)
+    nose.tools.assert_equal(index.node_names,
+                            set(node['name'] for node in statd.nodes))
+    e.make_a_pass()
+    nose.tools.assert_is(e.describe(statd), index)
+    # The digest is calculated once per description object
+    from occo.enactor.description import description_version
+    statd.nodes = None
+    nose.tools.assert_equal(description_version(statd), index.version)
+
+def test_scaling_snapshot_bulk_read():
+    from occo.enactor.scaling import ScalingSnapshot
+    class BulkUDS(object):
+        def __init__(self, uds):
+            self.uds = uds
+            self.bulk_reads = 0
+        def __getattr__(self, name):
+            return getattr(self.uds, name)
+        def get_scaling_requests(self, infraid, nodenames):
+            self.bulk_reads += 1
+            return dict(
+                (nodename,
+                 (self.uds.get_scaling_target_count(infraid, nodename),
+                  self.uds.get_scaling_createnode(infraid, nodename),
+                  self.uds.get_scaling_destroynode(infraid, nodename)))
+                for nodename in nodenames)
+    uds = BulkUDS(UDS.instantiate(protocol='dict'))
+    uds.set_scaling_createnode('infra', 'A', 1)
+    snapshot = ScalingSnapshot.load('infra', ['A', 'B'], uds)
+    nose.tools.assert_equal(uds.bulk_reads, 1)
+    # Requests added after loading are only seen in the next pass
+    uds.set_scaling_createnode('infra', 'A', 1)
+    uds.set_scaling_destroynode('infra', 'B', '')
+    nose.tools.assert_equal(len(snapshot.get_createnode('A')), 1)
+    nose.tools.assert_equal(snapshot.get_destroynode('B'), dict())
+    snapshot = ScalingSnapshot.load('infra', ['A', 'B'], uds)
+    nose.tools.assert_equal(uds.bulk_reads, 2)
+    nose.tools.assert_equal(len(snapshot.get_createnode('A')), 2)
+    nose.tools.assert_equal(list(snapshot.get_destroynode('B').values()),
+                            [''])
+
+def test_merged_drop_batch():
+    from occo.enactor.scaling import ScalingSnapshot
+    import copy
+    infra = copy.deepcopy(infracfg.infrastructures[0])
+    statd = compiler.StaticDescription(infra)
+    class DropIP(object):
+        def cri_drop_node(self, instance_data):
+            return instance_data['node_id']
+    e = enactor.Enactor(statd.infra_id, DropIP(), upkeep_strategy='noop')
+    def instance(node_id, name):
+        return dict(node_id=node_id, infra_id=statd.infra_id,
+                    state=nodestate.READY, instance_start_time=len(node_id),
+                    resolved_node_definition=dict(name=name),
+                    node_description=dict(name=name))
+    # A downscaled node type, a node type removed from the description and
+    # a failed node
+    dynamic_state = dict(
+        A=dict(a1=instance('a1', 'A')),
+        C=dict((node_id, instance(node_id, 'C'))
+               for node_id in ['c1', 'c2', 'c333']),
+        E=dict(e1=instance('e1', 'E')))
+    failed_nodes = [instance('a2', 'A')]
+    snapshot = ScalingSnapshot.load(statd.infra_id, ['A', 'B', 'C', 'D'],
+                                    UDS.instantiate(protocol='dict'))
+    delta = list(e.calculate_delta(statd, dynamic_state, failed_nodes,
+                                   snapshot, include_creations=False))
+    drops = [batch for batch in delta if batch.kind == 'drop']
+    nose.tools.assert_equal(len(drops), 1)
+    nose.tools.assert_equal(sorted(drops[0]), ['a2', 'c333', 'e1'])
+
+def test_stored_description_version():
+    import copy
+    infra = copy.deepcopy(infracfg.infrastructures[0])
+    uds = UDS.instantiate(protocol='dict')
+    e, buf, statd = make_enactor_pass(infra, uds)
+    fetched = []
+    infobroker = e.infobroker
+    class RecordingInfoBroker(object):
+        def get(self, key, *args, **kwargs):
+            fetched.append(key)
+            return infobroker.get(key, *args, **kwargs)
+    e.infobroker = RecordingInfoBroker()
+    # Not fetched again while the stored version is unchanged
+    e.make_a_pass()
+    e.make_a_pass()
+    nose.tools.assert_not_in('infrastructure.static_description', fetched)
+    touch_description(statd.infra_id, uds)
+    e.make_a_pass()
+    nose.tools.assert_equal(
+        fetched.count('infrastructure.static_description'), 1)
+
+def test_request_queue_drain():
+    from occo.enactor.requestqueue import ScalingRequestQueue
+    from occo.enactor.scaling import ScalingSnapshot
+    uds = UDS.instantiate(protocol='dict')
+    queue = ScalingRequestQueue.instantiate('dict')
+    queue.add_create('infra', 'A', 3)
+    queue.add_drop('infra', 'A')
+    queue.add_drop('infra', 'A', 'node-1')
+    snapshot = ScalingSnapshot.load('infra', ['A', 'B'], uds, queue)
+    nose.tools.assert_equal(len(snapshot.get_createnode('A')), 3)
+    nose.tools.assert_equal(sorted(snapshot.get_destroynode('A').values()),
+                            ['', 'node-1'])
+    for keyid in list(snapshot.get_createnode('A')):
+        snapshot.del_createnode('A', keyid)
+    snapshot.acknowledge()
+    nose.tools.assert_equal(queue.drain('infra', ['A'])['A'],
+                            (0, 1, set(['node-1'])))
+
+def test_request_queue_redelivery():
+    from occo.enactor.requestqueue import ScalingRequestQueue
+    from occo.enactor.scaling import ScalingSnapshot
+    uds = UDS.instantiate(protocol='dict')
+    queue = ScalingRequestQueue.instantiate('dict')
+    queue.add_create('infra', 'A', 2)
+    # The pass draining the requests dies before acknowledging them
+    ScalingSnapshot.load('infra', ['A'], uds, queue)
+    nose.tools.assert_equal(queue.pending('infra', 'A'), (2, 0, set()))
+    queue.add_create('infra', 'A')
+    snapshot = ScalingSnapshot.load('infra', ['A'], uds, queue)
+    nose.tools.assert_equal(len(snapshot.get_createnode('A')), 3)
+    snapshot.acknowledge()
+    nose.tools.assert_equal(queue.pending('infra', 'A'), (3, 0, set()))
+    snapshot = ScalingSnapshot.load('infra', ['A'], uds, queue)
+    for keyid in list(snapshot.get_createnode('A')):
+        snapshot.del_createnode('A', keyid)
+    snapshot.acknowledge()
+    nose.tools.assert_equal(queue.pending('infra', 'A'), (0, 0, set()))
+
+def test_request_queue_drains_uds_entries():
+    from occo.enactor.requestqueue import ScalingRequestQueue
+    from occo.enactor.scaling import ScalingSnapshot, entries_key
+    uds = UDS.instantiate(protocol='dict')
+    queue = ScalingRequestQueue.instantiate('dict')
+    queue.add_create('infra', 'A')
+    uds.set_scaling_createnode('infra', 'A', 1)
+    uds.set_scaling_destroynode('infra', 'A', 'node-1')
+    nose.tools.assert_equal(queue.pending('infra', 'A'), (1, 0, set()))
+    # Entries are only looked for if flagged
+    snapshot = ScalingSnapshot.load('infra', ['A'], uds, queue)
+    nose.tools.assert_equal(len(snapshot.get_createnode('A')), 1)
+    snapshot.acknowledge()
+    uds.kvstore.set_item(entries_key('infra'), True)
+    snapshot = ScalingSnapshot.load('infra', ['A'], uds, queue)
+    nose.tools.assert_equal(len(snapshot.get_createnode('A')), 2)
+    nose.tools.assert_equal(list(snapshot.get_destroynode('A').values()),
+                            ['node-1'])
+    nose.tools.assert_equal(uds.get_scaling_createnode('infra', 'A'), dict())
+    nose.tools.assert_equal(uds.get_scaling_destroynode('infra', 'A'), dict())
+    nose.tools.assert_false(uds.kvstore.query_item(entries_key('infra'), None))
+    # Unconsumed requests are kept in the queue
+    snapshot.acknowledge()
+    nose.tools.assert_equal(queue.pending('infra', 'A'),
+                            (2, 0, set(['node-1'])))
+
+def test_standby_pool():
+    from occo.enactor.standby import StandbyPool, standby_node
+    uds = UDS.instantiate(protocol='dict')
+    pool = StandbyPool(uds)
+    node = dict(name='worker', scaling=dict(standby=2))
+    def instance(node_id, node_description, state=nodestate.READY):
+        return dict(node_id=node_id, state=state, instance_start_time=0,
+                    node_description=node_description)
+    dynamic_state = dict(worker=dict(
+        a=instance('a', node),
+        b=instance('b', standby_node(node), nodestate.PENDING),
+        c=instance('c', standby_node(node))))
+    active, standby = pool.partition('infra', ['worker'], dynamic_state)
+    nose.tools.assert_equal(sorted(active['worker']), ['a'])
+    nose.tools.assert_equal(sorted(standby['worker']), ['b', 'c'])
+    promoted = pool.promote('infra', 'worker', standby['worker'], 1)
+    nose.tools.assert_equal([i['node_id'] for i in promoted], ['c'])
+    active, standby = pool.partition('infra', ['worker'], dynamic_state)
+    nose.tools.assert_equal(sorted(active['worker']), ['a', 'c'])
+    nose.tools.assert_equal(sorted(standby['worker']), ['b'])
+
+def test_enactor_pool_round_robin():
+    import threading, time
+    from occo.enactor.pool import EnactorPool
+    release = threading.Event()
+    class BlockingEnactor(object):
+        def __init__(self, infra_id):
+            self.infra_id = infra_id
+        def make_a_pass(self):
+            release.wait()
+    pool = EnactorPool(BlockingEnactor, max_workers=2, pass_interval=0)
+    for infra_id in ['a', 'b', 'c']:
+        pool.add_infrastructure(infra_id)
+    nose.tools.assert_equal(pool.schedule(), ['a', 'b'])
+    nose.tools.assert_equal(pool.schedule(), [])
+    release.set()
+    while pool.running:
+        time.sleep(0.01)
+    nose.tools.assert_equal(pool.schedule(), ['c', 'a'])
+    pool.stop()
+
+def test_enactor_pool_trigger_during_pass():
+    import threading, time
+    from occo.enactor.pool import EnactorPool
+    started, release = threading.Event(), threading.Event()
+    passes = []
+    class BlockingEnactor(object):
+        def __init__(self, infra_id):
+            self.infra_id = infra_id
+        def make_a_pass(self):
+            passes.append(self.infra_id)
+            started.set()
+            release.wait()
+    pool = EnactorPool(BlockingEnactor, max_workers=2, pass_interval=100)
+    pool.add_infrastructure('a')
+    nose.tools.assert_equal(pool.schedule(), ['a'])
+    started.wait(1)
+    pool.trigger('a')
+    # Passes of the same infrastructure never overlap
+    nose.tools.assert_equal(pool.schedule(), [])
+    release.set()
+    while pool.running:
+        time.sleep(0.01)
+    # The triggered pass follows, regardless of the pass interval
+    nose.tools.assert_equal(pool.schedule(), ['a'])
+    while pool.running:
+        time.sleep(0.01)
+    nose.tools.assert_equal(passes, ['a', 'a'])
+    nose.tools.assert_equal(pool.schedule(), [])
+    pool.stop()
+
+def test_enactor_pool_continues_interrupted_pass():
+    import time
+    from occo.enactor.pool import EnactorPool
+    outcomes = dict(a=['interrupted', 'full'], b=['full'])
+    class BudgetedEnactor(object):
+        def __init__(self, infra_id):
+            self.infra_id = infra_id
+        def make_a_pass(self):
+            return outcomes[self.infra_id].pop(0)
+    pool = EnactorPool(BudgetedEnactor, max_workers=1, pass_interval=100)
+    for infra_id in ['a', 'b']:
+        pool.add_infrastructure(infra_id)
+    def schedule():
+        submitted = pool.schedule()
+        while pool.running:
+            time.sleep(0.01)
+        return submitted
+    nose.tools.assert_equal(schedule(), ['a'])
+    # The interrupted pass is continued after the other ones due
+    nose.tools.assert_equal(schedule(), ['b'])
+    nose.tools.assert_equal(schedule(), ['a'])
+    nose.tools.assert_equal(schedule(), [])
+    pool.stop()
+
+def test_event_trigger_debounce():
+    import time
+    from occo.enactor.trigger import EventSource, EventTrigger
+    from occo.enactor.requestqueue import ScalingRequestQueue
+    from occo.enactor import scaling
+    fired = []
+    trigger = EventTrigger(EventSource.from_config('local'), fired.append,
+                           debounce=0.2)
+    trigger.start()
+    queue = ScalingRequestQueue.from_config('dict')
+    try:
+        # The first event triggers a pass immediately
+        scaling.add_createnode_request('a', 'node', request_queue=queue)
+        nose.tools.assert_equal(fired, ['a'])
+        # Events within the debounce window are coalesced into a single
+        # pass at the end of the window
+        for i in range(3):
+            scaling.add_dropnode_request('a', 'node', '', request_queue=queue)
+        scaling.add_createnode_request('b', 'node', request_queue=queue)
+        nose.tools.assert_equal(fired, ['a', 'b'])
+        time.sleep(0.3)
+        nose.tools.assert_equal(fired, ['a', 'b', 'a'])
+        # No further events: the window closes without a pass
+        time.sleep(0.3)
+        nose.tools.assert_equal(fired, ['a', 'b', 'a'])
+    finally:
+        trigger.stop()
+
+def test_redis_event_source_patterns():
+    from occo.enactor.trigger import RedisEventSource
+    from occo.enactor.requestqueue import RedisScalingRequestQueue
+    from occo.enactor.lease import RedisLeaseManager
+    from occo.enactor.standby import StandbyPool
+    from occo.enactor.upkeep import RedisStateChangeLog
+    from occo.enactor.description import stored_version_key
+    import fnmatch
+    def triggers(key):
+        return any(fnmatch.fnmatchcase(key, pattern)
+                   for pattern in RedisEventSource.PATTERNS)
+    for key in [RedisScalingRequestQueue.key('i', 'A', 'create'),
+                'infra:i:state',
+                RedisStateChangeLog.key('i') + ':version',
+                stored_version_key('i')]:
+        nose.tools.assert_true(triggers(key), key)
+    # The enactor's own writes do not trigger further passes
+    e = enactor.Enactor('i', None, upkeep_strategy='noop')
+    for key in [RedisLeaseManager.key('i'), e.resume_key(), e.teardown_key(),
+                StandbyPool.key('i', 'A')]:
+        nose.tools.assert_false(triggers(key), key)
+    # Not even when subscribing to every key of the infrastructures
+    nose.tools.assert_false(
+        fnmatch.fnmatchcase(RedisLeaseManager.key('i'), 'infra:*'))
+
+def test_enactment_waves():
+    from occo.enactor.enactment import EnactmentLimiter
+    limiter = EnactmentLimiter(max_inflight_creates=3, drop_rate=100, burst=2)
+    nose.tools.assert_equal(list(limiter.waves('create', list(range(7)))),
+                            [[0, 1, 2], [3, 4, 5], [6]])
+    nose.tools.assert_equal(list(limiter.waves('drop', list(range(3)))),
+                            [[0, 1], [2]])
+    nose.tools.assert_equal(list(limiter.waves('bootstrap', [0])), [[0]])
+    # Waves are weighted by the number of operations of the instructions
+    nose.tools.assert_equal(
+        list(limiter.waves('create', [2, 1, 1, 3, 1], lambda i: i)),
+        [[2, 1], [1], [3], [1]])
+    with limiter.acquire('create', 3):
+        nose.tools.assert_equal(limiter.inflight['create'], 3)
+    nose.tools.assert_equal(limiter.inflight['create'], 0)
+
+def test_dataflow_failure_blocks_dependents():
+    from occo.enactor.dataflow import enact_dataflow
+    enacted = []
+    def push_instructions(name, instruction_list):
+        if name == 'B':
+            raise RuntimeError('B failed')
+        enacted.append(name)
+    graph = [('A', set(), [1]), ('B', set(['A']), [1]),
+             ('C', set(['A']), [1]), ('D', set(['B']), [1]),
+             ('E', set(['C']), [1])]
+    with nose.tools.assert_raises(RuntimeError):
+        enact_dataflow(push_instructions, graph)
+    nose.tools.assert_equal(sorted(enacted), ['A', 'C', 'E'])
+
+def test_retry_policy_budget():
+    from occo.enactor.enactment import RetryPolicy
+    policy = RetryPolicy(max_retries=5, backoff=1, budget=6)
+    nose.tools.assert_equal([policy.delay(i) for i in range(4)],
+                            [1, 2, None, None])
+    policy.reset()
+    nose.tools.assert_equal(policy.delay(0), 1)
+
+def test_retry_per_node_type():
+    class FlakyIP(object):
+        def __init__(self):
+            self.pushed = []
+        def push_instructions(self, infra_id, instructions):
+            # Batches containing creations of B fail persistently
+            if 'B' in instructions:
+                raise RuntimeError('B failed')
+            self.pushed.extend(instructions)
+    ip = FlakyIP()
+    e = enactor.Enactor('retry', ip, upkeep_strategy='noop',
+                        retry_policy=dict(backoff=0))
+    e.remaining_operations = lambda kind, items: \
+        [(node, i) for node, i in items if i not in ip.pushed]
+    items = [(dict(name=name), name) for name in ['A', 'B', 'B', 'C']]
+    count, unenacted, error = e.push_batch('create', items)
+    nose.tools.assert_equal(sorted(ip.pushed), ['A', 'C'])
+    nose.tools.assert_equal(unenacted, [dict(name='B'), dict(name='B')])
+    nose.tools.assert_equal(str(error), 'B failed')
+
+def test_deadline_bounds_waits():
+    from occo.enactor.enactment import TokenBucket, DeadlineReached
+    import time
+    bucket = TokenBucket(rate=1, burst=1)
+    bucket.take(1)
+    start = time.time()
+    with nose.tools.assert_raises(DeadlineReached):
+        bucket.take(1, deadline=start + 0.1)
+    class FailingIP(object):
+        def push_instructions(self, infra_id, instructions):
+            raise RuntimeError('failed')
+    e = enactor.Enactor('deadline', FailingIP(), upkeep_strategy='noop',
+                        retry_policy=dict(backoff=10))
+    e.remaining_operations = lambda kind, items: items
+    e.deadline = start + 0.1
+    with nose.tools.assert_raises(DeadlineReached):
+        e.push_batch('create', [(dict(name='A'), 'A')])
+    nose.tools.assert_true(time.time() - start < 1)
+
+def test_compact_instance_records():
+    from occo.enactor.compact import SharedDefinitions, compact_state
+    def instance(node_id, state):
+        return dict(node_id=node_id, state=state, infra_id='i',
+                    resolved_node_definition=dict(name='A', attributes=[1]),
+                    node_description=dict(name='A'))
+    shared = SharedDefinitions()
+    state = compact_state(dict(A=dict(a1=instance('a1', 'ready'),
+                                      a2=instance('a2', 'ready'))), shared)
+    a1, a2 = state['A']['a1'], state['A']['a2']
+    nose.tools.assert_equal(dict(a1), instance('a1', 'ready'))
+    nose.tools.assert_is(a1['resolved_node_definition'],
+                         a2['resolved_node_definition'])
+    nose.tools.assert_is(a1.as_dict(), a1.as_dict())
+    state = compact_state(dict(A=dict(a1=instance('a1', 'ready'),
+                                      a2=instance('a2', 'fail'))),
+                          shared, state)
+    nose.tools.assert_is(state['A']['a1'], a1)
+    nose.tools.assert_equal(state['A']['a2']['state'], 'fail')
+    # Definitions of new instances are looked up by identity first
+    shared = SharedDefinitions()
+    a3 = instance('a3', 'ready')
+    a3['node_description'] = a1['node_description']
+    a3['resolved_node_definition'] = a1['resolved_node_definition']
+    nose.tools.assert_is(shared.intern('A', a3), shared.intern('A', dict(a3)))
+
+def test_enactor_lease_rebalancing():
+    from occo.enactor.lease import \
+        DictLeaseManager, EnactorLease, assigned_member
+    manager = DictLeaseManager()
+    first = EnactorLease(manager, 'first')
+    nose.tools.assert_true(first.hold('infra'))
+    second = EnactorLease(manager, 'second')
+    winner, loser = (first, second) \
+        if assigned_member('infra', ['first', 'second']) == 'first' \
+        else (second, first)
+    nose.tools.assert_false(loser.hold('infra'))
+    # The previous holder releases the lease in its next pass
+    winner.hold('infra')
+    loser.hold('infra')
+    nose.tools.assert_true(winner.hold('infra'))
+    nose.tools.assert_equal(manager.holder('infra'), winner.owner)
+    winner.leave()
+    nose.tools.assert_true(loser.hold('infra'))
+
+def test_time_budgeted_pass_resumes():
+    from occo.enactor.enactment import InstructionBatch
+    import time
+    class SlowIP(object):
+        def __init__(self):
+            self.pushed = []
+        def cri_create_node(self, node):
+            return node['name']
+        def push_instructions(self, infra_id, instructions):
+            time.sleep(0.02)
+            self.pushed.extend(instructions)
+    ip = SlowIP()
+    e = enactor.Enactor('budget', ip, upkeep_strategy='noop')
+    e.deadline = time.time()
+    batches = [InstructionBatch('create', [(dict(name=name), name)])
+               for name in 'ABC']
+    e.enact_delta(iter(batches))
+    nose.tools.assert_equal(ip.pushed, ['A'])
+    nose.tools.assert_equal(e.interrupted_at, 1)
+    # The next pass resumes at the interrupted level
+    e.progressed, e.interrupted_at = False, None
+    e.enact_delta(iter(batches), resume_level=1)
+    nose.tools.assert_equal(ip.pushed, ['A', 'B'])
+    nose.tools.assert_equal(e.interrupted_at, 2)
+
+def check_benchmark_counts(upkeep_strategy, key):
+    from occo_test import benchmark
+    import yaml
+    with open(benchmark.BASELINE_FILE) as f:
+        baseline = yaml.safe_load(f)[key]
+    results = benchmark.run_scenarios(upkeep_strategy=upkeep_strategy,
+                                      **benchmark.SIZES['small'])
+    nose.tools.assert_equal(benchmark.compare(results, baseline), [])
+
+def test_benchmark_counts():
+    for upkeep_strategy, key in [('basic', 'small'),
+                                 ('compact', 'small:compact'),
+                                 ('incremental', 'small:incremental')]:
+        yield check_benchmark_counts, upkeep_strategy, key
+
 def setup_module():
     import os
     log.info('PID: %d', os.getpid())
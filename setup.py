@@ -36,5 +36,8 @@ setuptools.setup(
         'OCCO-Compiler',
         'OCCO-InfoBroker',
         'OCCO-Util',
-    ]
+    ],
+    extras_require={
+        'predictive': ['numpy'],
+    },
 )